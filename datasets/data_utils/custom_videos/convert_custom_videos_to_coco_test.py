@@ -1,17 +1,21 @@
 # convert videos into COCO annotation format
 import os
+import sys
 import json
-import torch
-import torchvision
 import argparse
 import cv2
 import glob
 
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '../../..'))
+
+from univs.data.video_reader import get_video_metadata
+
 def parse_args():
     parser = argparse.ArgumentParser("image to video converter")
     parser.add_argument("--video_dir", default="datasets/custom_videos/raw", type=str, help="")
     parser.add_argument("--out_json", default="datasets/custom_videos/raw/test.json", type=str, help="")
     parser.add_argument("--is_256p", default=False, type=bool, help="compressed videos with 256p (short edge)")
+    parser.add_argument("--frame_stride", default=1, type=int, help="take a single frame with every N frames")
     return parser.parse_args()
 
 
@@ -84,18 +88,16 @@ if __name__ == "__main__":
                 continue
         
             path = os.path.join(args.video_dir, video_name)
-            # read all frames in the video
-            vframes, aframes, info = torchvision.io.read_video(
-                filename=path, pts_unit="sec", output_format="TCHW"
-            )
-            total_frames = len(vframes)
-            height, width = vframes.shape[-2:]
+            # the frames are decoded from the video in the dataloader, no need to extract them
+            metadata = get_video_metadata(path)
+            num_frames, height, width = metadata["length"], metadata["height"], metadata["width"]
 
-            # generated frame names with '000001.jpg'
+            # generated frame names with '000001.jpg', which are the frame indices in the video
             file_names = [
                 os.path.join(video_name, ''.join((6-len(str(t))) * ['0']) + str(t)+'.jpg')
-                for t in range(total_frames)
+                for t in range(0, num_frames, args.frame_stride)
             ]
+            total_frames = len(file_names)
             vid_dict = {
                 "length": total_frames,
                 "file_names": file_names,
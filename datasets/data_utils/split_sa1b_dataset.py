@@ -9,7 +9,7 @@ def parse_args():
     parser.add_argument("--data_path", default='datasets/sa_1b/', type=str, help="path of SA-1B dataset")
     parser.add_argument("--num_frames_per_file", default=100000, type=int, help="the number of images in per file")
     parser.add_argument("--num_files_merged", default=5, type=int, help="the number of images in per file")
-    parser.add_argument("--task_type", default='split', type=str, help="")
+    parser.add_argument("--task_type", default='split', type=str, help="'split', 'merge' or 'compact'")
     return parser.parse_args()
 
 
@@ -71,9 +71,30 @@ def split_sa1b_dataset(args):
     print('Done!')
 
 
+def compact_sa1b_dataset(args):
+    # pre-filter annotations of each subset into a compact index, so that the dataloader
+    # does not need to parse the json file of each image
+    from univs.data.datasets.sa_1b import build_sa_1b_compact_index
+
+    num_k = int(args.num_frames_per_file / 1000)
+    subset_root = os.path.join(args.data_path, 'annotations_{}k'.format(str(num_k)))
+    anno_root = os.path.join(args.data_path, 'annotations')
+
+    filenames = next(walk(subset_root), (None, None, []))[2]
+    for file in sorted(filenames):
+        if not file.endswith('.json'):
+            continue
+        print(os.path.join(subset_root, file))
+        build_sa_1b_compact_index(os.path.join(subset_root, file), anno_root)
+
+    print('Done!')
+
+
 if __name__ == '__main__':
     args = parse_args()
     if args.task_type == 'split':
         split_sa1b_dataset(args)
+    elif args.task_type == 'compact':
+        compact_sa1b_dataset(args)
     else:
         merge_sa1b_dataset(args)
\ No newline at end of file
@@ -3,27 +3,36 @@ import argparse
 import glob
 import multiprocessing as mp
 import os
+import queue
+import threading
 import time
+from collections import deque
 import cv2
 import tqdm
 
 from detectron2.config import get_cfg
 from detectron2.data.detection_utils import read_image
+from detectron2.projects.deeplab import add_deeplab_config
 from detectron2.utils.logger import setup_logger
 from detectron2.utils.file_io import PathManager
 
-from predictor import VisualizationDemo
+from predictor import VisualizationDemo, prefetch
 from mask2former import add_maskformer2_config
 from mask2former_video import add_maskformer2_video_config
-from boxvis import add_boxvis_config
+from regionclip import add_regionclip_config
+from univs import add_univs_config
+
+_VIDEO_EXTS = (".mp4", ".avi", ".mov", ".mkv")
 
 
 def setup_cfg(args):
     # load config from file and command-line arguments
     cfg = get_cfg()
+    add_deeplab_config(cfg)
     add_maskformer2_config(cfg)
     add_maskformer2_video_config(cfg)
-    add_boxvis_config(cfg)
+    add_regionclip_config(cfg)
+    add_univs_config(cfg)
     cfg.merge_from_file(args.config_file)
     cfg.merge_from_list(args.opts)
     cfg.MODEL.WEIGHTS = args.checkpoint
@@ -39,7 +48,9 @@ def get_parser():
         metavar="FILE",
         help="path to config file",
     )
-    parser.add_argument("--input", nargs="+", help="A list of space separated input images")
+    parser.add_argument(
+        "--input", nargs="+", help="A list of space separated input videos, either frame dirs or video files"
+    )
     parser.add_argument(
         "--output", required=True, help="A file or directory to save output visualizations."
     )
@@ -54,6 +65,23 @@ def get_parser():
         default=False,
         help="Save frame level image outputs.",
     )
+    parser.add_argument(
+        "--clip-len",
+        type=int,
+        default=30,
+        help="Number of frames per clip fed into the model.",
+    )
+    parser.add_argument(
+        "--num-vis-workers",
+        type=int,
+        default=4,
+        help="Number of threads to draw the visualized frames.",
+    )
+    parser.add_argument(
+        "--parallel",
+        action="store_true",
+        help="Run the model in separate processes, one per gpu.",
+    )
     parser.add_argument(
         "--opts",
         help="Modify config options using the command-line 'KEY VALUE' pairs",
@@ -63,6 +91,75 @@ def get_parser():
     return parser
 
 
+def read_frames(vid_path):
+    """
+    Yield (frame_name, BGR frame) of a video, which is either a dir of frames or a video file.
+    """
+    if vid_path.lower().endswith(_VIDEO_EXTS):
+        cap = cv2.VideoCapture(vid_path)
+        idx = 0
+        while True:
+            success, frame = cap.read()
+            if not success:
+                break
+            yield "{:05d}.jpg".format(idx), frame
+            idx += 1
+        cap.release()
+    else:
+        for img_file in sorted(PathManager.ls(vid_path)):
+            # use PIL, to be consistent with evaluation
+            yield img_file, read_image(os.path.join(vid_path, img_file), format="BGR")
+
+
+class AsyncVideoWriter:
+    """
+    Encode the visualized frames into a mp4 file incrementally in a background thread.
+    The writer is opened with the size of the first frame.
+    """
+
+    def __init__(self, out_path, fps=10.0, frame_dir=None, max_pending=32):
+        self.out_path = out_path
+        self.fps = fps
+        self.frame_dir = frame_dir
+        self._frames = queue.Queue(maxsize=max_pending)
+        self._errors = []
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        writer = None
+        try:
+            while True:
+                item = self._frames.get()
+                if item is None:
+                    break
+                frame_name, frame = item
+                if writer is None:
+                    H, W = frame.shape[:2]
+                    fourcc = cv2.VideoWriter_fourcc(*"mp4v")
+                    writer = cv2.VideoWriter(self.out_path, fourcc, self.fps, (W, H), True)
+                writer.write(frame)
+                if self.frame_dir is not None:
+                    cv2.imwrite(os.path.join(self.frame_dir, frame_name), frame)
+        except BaseException as e:
+            self._errors.append(e)
+            # keep draining, so that `write` never blocks forever
+            while self._frames.get() is not None:
+                pass
+        finally:
+            if writer is not None:
+                writer.release()
+
+    def write(self, frame_name, frame):
+        self._frames.put((frame_name, frame))
+
+    def close(self):
+        self._frames.put(None)
+        self._thread.join()
+        if len(self._errors):
+            raise self._errors[0]
+
+
 if __name__ == "__main__":
     mp.set_start_method("spawn", force=True)
     args = get_parser().parse_args()
@@ -72,7 +169,7 @@ if __name__ == "__main__":
 
     cfg = setup_cfg(args)
 
-    demo = VisualizationDemo(cfg)
+    demo = VisualizationDemo(cfg, parallel=args.parallel, num_vis_workers=args.num_vis_workers)
 
     if args.input:
         if len(args.input) == 1:
@@ -83,39 +180,38 @@ if __name__ == "__main__":
             PathManager.mkdirs(args.output)
 
         for vid_path in tqdm.tqdm(args.input, disable=not args.output):
+            vid_path = vid_path.rstrip("/")
             vid_file = vid_path.split("/")[-1]
             out_vid_path = os.path.join(args.output, vid_file)
             if args.save_frames and not os.path.isdir(out_vid_path):
                 PathManager.mkdirs(out_vid_path)
 
-            vid_frame_paths = sorted(PathManager.ls(vid_path))
-            vid_frames = []
-            for img_file in vid_frame_paths:
-                img_path = os.path.join(vid_path, img_file)
-                # use PIL, to be consistent with evaluation
-                img = read_image(img_path, format="BGR")
-                vid_frames.append(img)
+            fps = 10.0
+            if vid_path.lower().endswith(_VIDEO_EXTS):
+                out_vid_path = os.path.splitext(out_vid_path)[0]
+                cap = cv2.VideoCapture(vid_path)
+                fps = cap.get(cv2.CAP_PROP_FPS) or fps
+                cap.release()
+
+            # reader -> clip-wise inference -> visualization workers -> mp4 writer, with bounded queues
+            frame_names = deque()
 
+            def frames():
+                for frame_name, frame in prefetch(read_frames(vid_path), max_size=2 * args.clip_len):
+                    frame_names.append(frame_name)
+                    yield frame
+
+            writer = AsyncVideoWriter(
+                out_vid_path + ".mp4", fps=fps, frame_dir=out_vid_path if args.save_frames else None
+            )
             start_time = time.time()
-            predictions, visualized_output = demo.run_on_video(vid_frames)
+            num_frames = 0
+            try:
+                for vis_frame in demo.run_on_video_stream(frames(), clip_len=args.clip_len):
+                    writer.write(frame_names.popleft(), vis_frame)
+                    num_frames += 1
+            finally:
+                writer.close()
             logger.info(
-                "{}: detected {} instances per frame in {:.2f}s".format(
-                    vid_path, len(predictions["pred_scores"]), time.time() - start_time
-                )
+                "{}: visualized {} frames in {:.2f}s".format(vid_path, num_frames, time.time() - start_time)
             )
-
-            if args.save_frames:
-                for img_file, _vis_output in zip(vid_frame_paths, visualized_output):
-                    out_filename = os.path.join(out_vid_path, img_file)
-                    _vis_output.save(out_filename)
-
-            H, W = visualized_output[0].height, visualized_output[0].width
-
-            cap = cv2.VideoCapture(-1)
-            fourcc = cv2.VideoWriter_fourcc(*"mp4v")
-            out = cv2.VideoWriter(out_vid_path + ".mp4" , fourcc, 10.0, (W, H), True)
-            for _vis_output in visualized_output:
-                frame = _vis_output.get_image()[:, :, ::-1]
-                out.write(frame)
-            cap.release()
-            out.release()
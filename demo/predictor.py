@@ -2,23 +2,128 @@
 import atexit
 import bisect
 import multiprocessing as mp
+import queue
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
 import torch
 
 from detectron2.data import MetadataCatalog
 from detectron2.engine.defaults import DefaultPredictor
 from detectron2.structures import Instances
-from detectron2.utils.visualizer import ColorMode
+from detectron2.utils.colormap import random_color
+from detectron2.utils.visualizer import ColorMode, Visualizer, _create_text_labels
 from detectron2.utils.video_visualizer import VideoVisualizer
 
 
+def prefetch(iterable, max_size=8):
+    """
+    Iterate over `iterable` in a background thread, at most `max_size` items are read ahead.
+    It is used as the reader stage of the streaming demo, e.g. to decode frames while the
+    model runs on the previous clip.
+    """
+    items = queue.Queue(maxsize=max_size)
+    end = object()
+    errors = []
+
+    def _read():
+        try:
+            for item in iterable:
+                items.put(item)
+        except BaseException as e:
+            errors.append(e)
+        finally:
+            items.put(end)
+
+    threading.Thread(target=_read, daemon=True).start()
+    while True:
+        item = items.get()
+        if item is end:
+            break
+        yield item
+    if len(errors):
+        raise errors[0]
+
+
+def draw_frame(frame, metadata, masks=None, scores=None, classes=None, colors=None, instance_mode=ColorMode.IMAGE):
+    """
+    Draw the instance masks of one frame, the same as `VideoVisualizer.draw_instance_predictions`
+    but with the given colors, thus the frames can be drawn in parallel.
+
+    Args:
+        frame (ndarray): an image of shape (H, W, C) in BGR order
+        masks (Tensor): bool masks of shape (N, H, W) on cpu
+        scores, classes (list or Tensor): N scores and category ids
+        colors (list[tuple]): N RGB colors in range (0, 1)
+
+    Returns:
+        ndarray: the visualized frame in BGR order
+    """
+    if masks is None or len(masks) == 0:
+        return frame
+
+    frame_visualizer = Visualizer(frame[:, :, ::-1], metadata)
+    labels = _create_text_labels(classes, scores, metadata.get("thing_classes", None))
+    if instance_mode == ColorMode.IMAGE_BW:
+        frame_visualizer.output.img = frame_visualizer._create_grayscale_image(masks.any(dim=0).numpy())
+        alpha = 0.3
+    else:
+        alpha = 0.5
+    frame_visualizer.overlay_instances(masks=masks, labels=labels, assigned_colors=colors, alpha=alpha)
+    return frame_visualizer.output.get_image()[:, :, ::-1]
+
+
+class _ClipColorAssigner:
+    """
+    Assign colors to the instances of consecutive clips. An instance inherits the color of the
+    instance in the previous clip whose mask on the last frame overlaps most with its mask on the
+    first frame (IoU above `iou_thresh`), otherwise a new random color is assigned.
+    """
+
+    def __init__(self, iou_thresh=0.5):
+        self.iou_thresh = iou_thresh
+        self._last_masks = None
+        self._last_colors = []
+
+    def __call__(self, first_masks, last_masks):
+        """
+        Args:
+            first_masks, last_masks (Tensor): bool masks of shape (N, H, W) of the instances
+                on the first and the last frame of the clip
+        Returns:
+            list[tuple]: N RGB colors in range (0, 1)
+        """
+        colors = [None] * len(first_masks)
+        if self._last_masks is not None and len(self._last_masks) and len(first_masks):
+            prev = self._last_masks.flatten(1).float()
+            cur = first_masks.flatten(1).float()
+            inter = cur @ prev.t()
+            union = cur.sum(1)[:, None] + prev.sum(1)[None] - inter
+            ious = inter / union.clamp(min=1)
+            # greedy matching by iou
+            ious[ious < self.iou_thresh] = 0
+            while ious.max() > 0:
+                idx = int(ious.argmax())
+                i, j = idx // ious.shape[1], idx % ious.shape[1]
+                colors[i] = self._last_colors[j]
+                ious[i], ious[:, j] = 0, 0
+
+        colors = [random_color(rgb=True, maximum=1) if c is None else c for c in colors]
+        self._last_masks, self._last_colors = last_masks, colors
+        return colors
+
+
 class VisualizationDemo(object):
-    def __init__(self, cfg, instance_mode=ColorMode.IMAGE, parallel=False):
+    def __init__(self, cfg, instance_mode=ColorMode.IMAGE, parallel=False, num_vis_workers=4):
         """
         Args:
             cfg (CfgNode):
             instance_mode (ColorMode):
             parallel (bool): whether to run the model in different processes from visualization.
                 Useful since the visualization logic can be slow.
+            num_vis_workers (int): the number of threads to draw frames in `run_on_video_stream`
         """
         self.metadata = MetadataCatalog.get(
             cfg.DATASETS.TEST[0] if len(cfg.DATASETS.TEST) else "__unused"
@@ -34,6 +139,7 @@ class VisualizationDemo(object):
             self.predictor = VideoPredictor(cfg)
 
         self.VideoVisualizer = VideoVisualizer(self.metadata)
+        self.num_vis_workers = num_vis_workers
 
     def run_on_video(self, frames):
         """
@@ -66,6 +172,71 @@ class VisualizationDemo(object):
 
         return predictions, total_vis_output
 
+    def run_on_video_stream(self, frames, clip_len=30):
+        """
+        Run the model clip by clip and visualize the frames in a pool of workers, so that
+        the memory is constant in the video length and the first visualized frames are
+        available before the entire video is processed.
+
+        Args:
+            frames (Iterable[np.ndarray]): images of shape (H, W, C) in BGR order, e.g.
+                wrapped by `prefetch` to be decoded in the background.
+            clip_len (int): the number of frames per clip fed into the model
+        Yields:
+            ndarray: the visualized frames in BGR order, in the input order
+        """
+        assign_colors = _ClipColorAssigner()
+        pending = deque()  # futures of the visualized frames, in order
+        max_pending = max(2 * clip_len, self.num_vis_workers)
+
+        def clips():
+            clip = []
+            for frame in frames:
+                clip.append(frame)
+                if len(clip) == clip_len:
+                    yield clip
+                    clip = []
+            if len(clip):
+                yield clip
+
+        def submit(clip, predictions):
+            pred_masks = [m.cpu() for m in predictions["pred_masks"]]  # N x (T, H, W)
+            colors = None
+            if len(pred_masks):
+                colors = assign_colors(
+                    torch.stack([m[0] for m in pred_masks]) > 0, torch.stack([m[-1] for m in pred_masks]) > 0
+                )
+            for t, frame in enumerate(clip):
+                masks = torch.stack([m[t] for m in pred_masks]) > 0 if len(pred_masks) else None
+                pending.append(executor.submit(
+                    draw_frame, frame, self.metadata, masks, predictions["pred_scores"],
+                    predictions["pred_labels"], colors, self.instance_mode,
+                ))
+
+        with ThreadPoolExecutor(max_workers=max(self.num_vis_workers, 1)) as executor:
+            if self.parallel:
+                # keep several clips in flight, like `run_on_video` of detectron2 demo
+                buffer_size = self.predictor.default_buffer_size
+                clip_data = deque()
+                for clip in clips():
+                    clip_data.append(clip)
+                    self.predictor.put(clip)
+                    if len(clip_data) >= buffer_size:
+                        submit(clip_data.popleft(), self.predictor.get())
+                    while len(pending) > max_pending:
+                        yield pending.popleft().result()
+                while len(clip_data):
+                    submit(clip_data.popleft(), self.predictor.get())
+            else:
+                for clip in clips():
+                    submit(clip, self.predictor(clip))
+                    # the frames of this clip are drawn while the model runs on the next clip
+                    while len(pending) > max_pending:
+                        yield pending.popleft().result()
+
+            while len(pending):
+                yield pending.popleft().result()
+
 
 class VideoPredictor(DefaultPredictor):
     """
@@ -103,27 +274,44 @@ class VideoPredictor(DefaultPredictor):
                 See :doc:`/tutorials/models` for details about the format.
         """
         with torch.no_grad():  # https://github.com/sphinx-doc/sphinx/issues/4258
-            input_frames = []
-            for original_image in frames:
-                # Apply pre-processing to image.
-                if self.input_format == "RGB":
-                    # whether the model expects BGR inputs or RGB
-                    original_image = original_image[:, :, ::-1]
-                height, width = original_image.shape[:2]
-                image = self.aug.get_transform(original_image).apply_image(original_image)
-                image = torch.as_tensor(image.astype("float32").transpose(2, 0, 1))
-                input_frames.append(image)
-
-            inputs = {"image": input_frames, "height": height, "width": width}
+            inputs = self.preprocess(frames)
             predictions = self.model([inputs])
             return predictions
 
+    def preprocess(self, frames):
+        """
+        Resize all frames of a clip with one transform, and convert them into tensors at once.
+
+        Args:
+            frames (list[np.ndarray]): images of shape (H, W, C) in BGR order, with the same size.
+        """
+        height, width = frames[0].shape[:2]
+        # the test-time resizing is deterministic, so the transform of the first frame applies to all
+        transform = self.aug.get_transform(frames[0])
+        images = np.stack([transform.apply_image(frame) for frame in frames])
+        if self.input_format == "RGB":
+            # whether the model expects BGR inputs or RGB
+            images = images[..., ::-1]
+        images = torch.from_numpy(np.ascontiguousarray(images.transpose(0, 3, 1, 2))).float()
+        return {"image": list(images.unbind(0)), "height": height, "width": width}
+
+
+def _to_cpu(data):
+    if isinstance(data, torch.Tensor):
+        return data.cpu()
+    if isinstance(data, dict):
+        return {k: _to_cpu(v) for k, v in data.items()}
+    if isinstance(data, (list, tuple)):
+        return type(data)(_to_cpu(v) for v in data)
+    return data
+
 
 class AsyncPredictor:
     """
     A predictor that runs the model asynchronously, possibly on >1 GPUs.
     Because rendering the visualization takes considerably amount of time,
     this helps improve throughput when rendering videos.
+    Each task is a video clip, i.e. a list of frames, see `VisualizationDemo.run_on_video_stream`.
     """
 
     class _StopToken:
@@ -145,7 +333,9 @@ class AsyncPredictor:
                     break
                 idx, data = task
                 result = predictor(data)
-                self.result_queue.put((idx, result))
+                # cuda tensors can not be shared with the main process safely, the results
+                # of video clips (e.g. masks) are moved to cpu
+                self.result_queue.put((idx, _to_cpu(result)))
 
     def __init__(self, cfg, num_gpus: int = 1):
         """
@@ -174,9 +364,9 @@ class AsyncPredictor:
             p.start()
         atexit.register(self.shutdown)
 
-    def put(self, image):
+    def put(self, frames):
         self.put_idx += 1
-        self.task_queue.put((self.put_idx, image))
+        self.task_queue.put((self.put_idx, frames))
 
     def get(self):
         self.get_idx += 1  # the index needed for this request
@@ -197,8 +387,8 @@ class AsyncPredictor:
     def __len__(self):
         return self.put_idx - self.get_idx
 
-    def __call__(self, image):
-        self.put(image)
+    def __call__(self, frames):
+        self.put(frames)
         return self.get()
 
     def shutdown(self):
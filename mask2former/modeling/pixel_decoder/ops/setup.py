@@ -10,6 +10,7 @@
 # Modified by Bowen Cheng from https://github.com/fundamentalvision/Deformable-DETR
 
 import os
+import sys
 import glob
 
 import torch
@@ -33,7 +34,9 @@ def get_extensions():
 
     sources = main_file + source_cpu
     extension = CppExtension
-    extra_compile_args = {"cxx": []}
+    # the CPU kernels are multi-threaded with at::parallel_for
+    openmp_args = ["-fopenmp"] if sys.platform.startswith("linux") else []
+    extra_compile_args = {"cxx": ["-O3"] + openmp_args}
     define_macros = []
 
     # Force cuda since torch ask for a device, not if cuda is in fact available.
@@ -47,11 +50,12 @@ def get_extensions():
             "-D__CUDA_NO_HALF_CONVERSIONS__",
             "-D__CUDA_NO_HALF2_OPERATORS__",
         ]
+    elif os.environ.get('FORCE_CUDA'):
+        raise NotImplementedError('CUDA_HOME is None. Please set environment variable CUDA_HOME.')
     else:
-        if CUDA_HOME is None:
-            raise NotImplementedError('CUDA_HOME is None. Please set environment variable CUDA_HOME.')
-        else:
-            raise NotImplementedError('No CUDA runtime is found. Please set FORCE_CUDA=1 or test it by running torch.cuda.is_available().')
+        # CPU-only build, e.g. for CI and inference on machines without GPUs
+        print('No CUDA runtime is found, only the CPU kernels of MultiScaleDeformableAttention are compiled. '
+              'Please set FORCE_CUDA=1 and CUDA_HOME to compile the CUDA kernels.')
 
     sources = [os.path.join(extensions_dir, s) for s in sources]
     include_dirs = [extensions_dir]
@@ -62,6 +66,7 @@ def get_extensions():
             include_dirs=include_dirs,
             define_macros=define_macros,
             extra_compile_args=extra_compile_args,
+            extra_link_args=openmp_args,
         )
     ]
     return ext_modules
@@ -14,9 +14,236 @@
 */
 
 #include <vector>
+#include <cmath>
 
 #include <ATen/ATen.h>
-#include <ATen/cuda/CUDAContext.h>
+#include <ATen/Parallel.h>
+
+
+// Same bilinear sampling as ms_deform_attn_im2col_bilinear in the CUDA kernel, but vectorized over
+// the channels of a head. The corners out of the feature map point to a zero row, so that the 
+// inner loop has no branch and sums the same terms as the CUDA kernel.
+template <typename scalar_t>
+static inline void ms_deform_attn_im2col_bilinear_cpu(
+    const scalar_t* bottom_data, const scalar_t* zeros,
+    const int height, const int width, const int nheads, const int channels,
+    const scalar_t h, const scalar_t w, const scalar_t attn_weight,
+    scalar_t* __restrict__ col)
+{
+  const int h_low = std::floor(h);
+  const int w_low = std::floor(w);
+  const int h_high = h_low + 1;
+  const int w_high = w_low + 1;
+
+  const scalar_t lh = h - h_low;
+  const scalar_t lw = w - w_low;
+  const scalar_t hh = 1 - lh, hw = 1 - lw;
+
+  const int w_stride = nheads * channels;
+  const int h_stride = width * w_stride;
+  const int h_low_ptr_offset = h_low * h_stride;
+  const int h_high_ptr_offset = h_low_ptr_offset + h_stride;
+  const int w_low_ptr_offset = w_low * w_stride;
+  const int w_high_ptr_offset = w_low_ptr_offset + w_stride;
+
+  const scalar_t* v1 = (h_low >= 0 && w_low >= 0) ? bottom_data + h_low_ptr_offset + w_low_ptr_offset : zeros;
+  const scalar_t* v2 = (h_low >= 0 && w_high <= width - 1) ? bottom_data + h_low_ptr_offset + w_high_ptr_offset : zeros;
+  const scalar_t* v3 = (h_high <= height - 1 && w_low >= 0) ? bottom_data + h_high_ptr_offset + w_low_ptr_offset : zeros;
+  const scalar_t* v4 = (h_high <= height - 1 && w_high <= width - 1) ? bottom_data + h_high_ptr_offset + w_high_ptr_offset : zeros;
+
+  const scalar_t w1 = hh * hw, w2 = hh * lw, w3 = lh * hw, w4 = lh * lw;
+  for (int c = 0; c < channels; ++c)
+  {
+    col[c] += (w1 * v1[c] + w2 * v2[c] + w3 * v3[c] + w4 * v4[c]) * attn_weight;
+  }
+}
+
+
+// Same gradients as ms_deform_attn_col2im_bilinear in the CUDA kernel, where the gradients of 
+// the sampling location and attention weight are reduced over the channels of a head.
+template <typename scalar_t>
+static inline void ms_deform_attn_col2im_bilinear_cpu(
+    const scalar_t* bottom_data, const scalar_t* zeros, scalar_t* sink,
+    const int height, const int width, const int nheads, const int channels,
+    const scalar_t h, const scalar_t w,
+    const scalar_t* top_grad, const scalar_t attn_weight,
+    scalar_t* grad_value,
+    scalar_t* grad_sampling_loc,
+    scalar_t* grad_attn_weight)
+{
+  const int h_low = std::floor(h);
+  const int w_low = std::floor(w);
+  const int h_high = h_low + 1;
+  const int w_high = w_low + 1;
+
+  const scalar_t lh = h - h_low;
+  const scalar_t lw = w - w_low;
+  const scalar_t hh = 1 - lh, hw = 1 - lw;
+
+  const int w_stride = nheads * channels;
+  const int h_stride = width * w_stride;
+  const int h_low_ptr_offset = h_low * h_stride;
+  const int h_high_ptr_offset = h_low_ptr_offset + h_stride;
+  const int w_low_ptr_offset = w_low * w_stride;
+  const int w_high_ptr_offset = w_low_ptr_offset + w_stride;
+
+  const bool valid1 = h_low >= 0 && w_low >= 0;
+  const bool valid2 = h_low >= 0 && w_high <= width - 1;
+  const bool valid3 = h_high <= height - 1 && w_low >= 0;
+  const bool valid4 = h_high <= height - 1 && w_high <= width - 1;
+  const int ptr1 = h_low_ptr_offset + w_low_ptr_offset;
+  const int ptr2 = h_low_ptr_offset + w_high_ptr_offset;
+  const int ptr3 = h_high_ptr_offset + w_low_ptr_offset;
+  const int ptr4 = h_high_ptr_offset + w_high_ptr_offset;
+
+  // the gradients of the corners out of the feature map are written into a sink row
+  const scalar_t* v1 = valid1 ? bottom_data + ptr1 : zeros;
+  const scalar_t* v2 = valid2 ? bottom_data + ptr2 : zeros;
+  const scalar_t* v3 = valid3 ? bottom_data + ptr3 : zeros;
+  const scalar_t* v4 = valid4 ? bottom_data + ptr4 : zeros;
+  scalar_t* g1 = valid1 ? grad_value + ptr1 : sink;
+  scalar_t* g2 = valid2 ? grad_value + ptr2 : sink;
+  scalar_t* g3 = valid3 ? grad_value + ptr3 : sink;
+  scalar_t* g4 = valid4 ? grad_value + ptr4 : sink;
+
+  const scalar_t w1 = hh * hw, w2 = hh * lw, w3 = lh * hw, w4 = lh * lw;
+  scalar_t grad_weight = 0, grad_loc_w = 0, grad_loc_h = 0;
+  for (int c = 0; c < channels; ++c)
+  {
+    const scalar_t top_grad_value = top_grad[c] * attn_weight;
+    const scalar_t grad_h_weight = - hw * v1[c] - lw * v2[c] + hw * v3[c] + lw * v4[c];
+    const scalar_t grad_w_weight = - hh * v1[c] + hh * v2[c] - lh * v3[c] + lh * v4[c];
+    const scalar_t val = w1 * v1[c] + w2 * v2[c] + w3 * v3[c] + w4 * v4[c];
+
+    g1[c] += w1 * top_grad_value;
+    g2[c] += w2 * top_grad_value;
+    g3[c] += w3 * top_grad_value;
+    g4[c] += w4 * top_grad_value;
+
+    grad_weight += top_grad[c] * val;
+    grad_loc_w += width * grad_w_weight * top_grad_value;
+    grad_loc_h += height * grad_h_weight * top_grad_value;
+  }
+
+  *grad_attn_weight += grad_weight;
+  *grad_sampling_loc += grad_loc_w;
+  *(grad_sampling_loc + 1) += grad_loc_h;
+}
+
+
+template <typename scalar_t>
+static void ms_deformable_im2col_cpu(
+    const scalar_t* data_value,
+    const int64_t* data_spatial_shapes,
+    const int64_t* data_level_start_index,
+    const scalar_t* data_sampling_loc,
+    const scalar_t* data_attn_weight,
+    const int batch_size, const int spatial_size, const int num_heads, const int channels,
+    const int num_levels, const int num_query, const int num_point,
+    scalar_t* data_col)
+{
+  // one task per (batch, query, head), which writes data_col[b, q, m, :] only
+  at::parallel_for(0, (int64_t)batch_size * num_query * num_heads, 0, [&](int64_t begin, int64_t end) {
+    std::vector<scalar_t> zeros(channels, 0);
+    for (int64_t index = begin; index < end; ++index)
+    {
+      const int m_col = index % num_heads;
+      const int b_col = index / (num_query * num_heads);
+      scalar_t* data_col_ptr = data_col + index * channels;
+      const scalar_t* data_loc_ptr = data_sampling_loc + index * num_levels * num_point * 2;
+      const scalar_t* data_weight_ptr = data_attn_weight + index * num_levels * num_point;
+
+      for (int l_col = 0; l_col < num_levels; ++l_col)
+      {
+        const int spatial_h = data_spatial_shapes[l_col * 2];
+        const int spatial_w = data_spatial_shapes[l_col * 2 + 1];
+        const scalar_t* data_value_ptr = data_value 
+          + ((int64_t)b_col * spatial_size + data_level_start_index[l_col]) * num_heads * channels
+          + m_col * channels;
+        for (int p_col = 0; p_col < num_point; ++p_col)
+        {
+          const scalar_t loc_w = data_loc_ptr[0];
+          const scalar_t loc_h = data_loc_ptr[1];
+          const scalar_t weight = *data_weight_ptr;
+
+          const scalar_t h_im = loc_h * spatial_h - 0.5;
+          const scalar_t w_im = loc_w * spatial_w - 0.5;
+          if (h_im > -1 && w_im > -1 && h_im < spatial_h && w_im < spatial_w)
+          {
+            ms_deform_attn_im2col_bilinear_cpu(
+              data_value_ptr, zeros.data(), spatial_h, spatial_w, num_heads, channels, h_im, w_im, weight, data_col_ptr);
+          }
+          data_loc_ptr += 2;
+          data_weight_ptr += 1;
+        }
+      }
+    }
+  });
+}
+
+
+template <typename scalar_t>
+static void ms_deformable_col2im_cpu(
+    const scalar_t* grad_col,
+    const scalar_t* data_value,
+    const int64_t* data_spatial_shapes,
+    const int64_t* data_level_start_index,
+    const scalar_t* data_sampling_loc,
+    const scalar_t* data_attn_weight,
+    const int batch_size, const int spatial_size, const int num_heads, const int channels,
+    const int num_levels, const int num_query, const int num_point,
+    scalar_t* grad_value,
+    scalar_t* grad_sampling_loc,
+    scalar_t* grad_attn_weight)
+{
+  // one task per (batch, head), so that the gradients of value[b, :, m, :] are accumulated 
+  // by one thread only, instead of the atomic additions in the CUDA kernel
+  at::parallel_for(0, (int64_t)batch_size * num_heads, 0, [&](int64_t begin, int64_t end) {
+    std::vector<scalar_t> zeros(channels, 0);
+    std::vector<scalar_t> sink(channels, 0);
+    for (int64_t bm = begin; bm < end; ++bm)
+    {
+      const int m_col = bm % num_heads;
+      const int b_col = bm / num_heads;
+      for (int q_col = 0; q_col < num_query; ++q_col)
+      {
+        const int64_t index = ((int64_t)b_col * num_query + q_col) * num_heads + m_col;
+        const scalar_t* top_grad = grad_col + index * channels;
+        int64_t data_loc_offset = index * num_levels * num_point * 2;
+        int64_t data_weight_offset = index * num_levels * num_point;
+
+        for (int l_col = 0; l_col < num_levels; ++l_col)
+        {
+          const int spatial_h = data_spatial_shapes[l_col * 2];
+          const int spatial_w = data_spatial_shapes[l_col * 2 + 1];
+          const int64_t value_offset = ((int64_t)b_col * spatial_size + data_level_start_index[l_col]) * num_heads * channels
+            + m_col * channels;
+          for (int p_col = 0; p_col < num_point; ++p_col)
+          {
+            const scalar_t loc_w = data_sampling_loc[data_loc_offset];
+            const scalar_t loc_h = data_sampling_loc[data_loc_offset + 1];
+            const scalar_t weight = data_attn_weight[data_weight_offset];
+
+            const scalar_t h_im = loc_h * spatial_h - 0.5;
+            const scalar_t w_im = loc_w * spatial_w - 0.5;
+            if (h_im > -1 && w_im > -1 && h_im < spatial_h && w_im < spatial_w)
+            {
+              ms_deform_attn_col2im_bilinear_cpu(
+                data_value + value_offset, zeros.data(), sink.data(),
+                spatial_h, spatial_w, num_heads, channels, h_im, w_im,
+                top_grad, weight,
+                grad_value + value_offset,
+                grad_sampling_loc + data_loc_offset,
+                grad_attn_weight + data_weight_offset);
+            }
+            data_loc_offset += 2;
+            data_weight_offset += 1;
+          }
+        }
+      }
+    }
+  });
+}
 
 
 at::Tensor
@@ -28,7 +255,45 @@ ms_deform_attn_cpu_forward(
     const at::Tensor &attn_weight,
     const int im2col_step)
 {
-    AT_ERROR("Not implement on cpu");
+    AT_ASSERTM(value.is_contiguous(), "value tensor has to be contiguous");
+    AT_ASSERTM(spatial_shapes.is_contiguous(), "spatial_shapes tensor has to be contiguous");
+    AT_ASSERTM(level_start_index.is_contiguous(), "level_start_index tensor has to be contiguous");
+    AT_ASSERTM(sampling_loc.is_contiguous(), "sampling_loc tensor has to be contiguous");
+    AT_ASSERTM(attn_weight.is_contiguous(), "attn_weight tensor has to be contiguous");
+
+    AT_ASSERTM(!value.is_cuda(), "value must be a CPU tensor");
+    AT_ASSERTM(!spatial_shapes.is_cuda(), "spatial_shapes must be a CPU tensor");
+    AT_ASSERTM(!level_start_index.is_cuda(), "level_start_index must be a CPU tensor");
+    AT_ASSERTM(!sampling_loc.is_cuda(), "sampling_loc must be a CPU tensor");
+    AT_ASSERTM(!attn_weight.is_cuda(), "attn_weight must be a CPU tensor");
+
+    const int batch = value.size(0);
+    const int spatial_size = value.size(1);
+    const int num_heads = value.size(2);
+    const int channels = value.size(3);
+
+    const int num_levels = spatial_shapes.size(0);
+
+    const int num_query = sampling_loc.size(1);
+    const int num_point = sampling_loc.size(4);
+
+    // im2col_step is only used to bound the memory of CUDA kernels
+    auto output = at::zeros({batch, num_query, num_heads, channels}, value.options());
+
+    AT_DISPATCH_FLOATING_TYPES(value.scalar_type(), "ms_deform_attn_forward_cpu", ([&] {
+        ms_deformable_im2col_cpu(
+            value.data_ptr<scalar_t>(),
+            spatial_shapes.data_ptr<int64_t>(),
+            level_start_index.data_ptr<int64_t>(),
+            sampling_loc.data_ptr<scalar_t>(),
+            attn_weight.data_ptr<scalar_t>(),
+            batch, spatial_size, num_heads, channels, num_levels, num_query, num_point,
+            output.data_ptr<scalar_t>());
+    }));
+
+    output = output.view({batch, num_query, num_heads*channels});
+
+    return output;
 }
 
 std::vector<at::Tensor>
@@ -41,6 +306,49 @@ ms_deform_attn_cpu_backward(
     const at::Tensor &grad_output,
     const int im2col_step)
 {
-    AT_ERROR("Not implement on cpu");
-}
+    AT_ASSERTM(value.is_contiguous(), "value tensor has to be contiguous");
+    AT_ASSERTM(spatial_shapes.is_contiguous(), "spatial_shapes tensor has to be contiguous");
+    AT_ASSERTM(level_start_index.is_contiguous(), "level_start_index tensor has to be contiguous");
+    AT_ASSERTM(sampling_loc.is_contiguous(), "sampling_loc tensor has to be contiguous");
+    AT_ASSERTM(attn_weight.is_contiguous(), "attn_weight tensor has to be contiguous");
+    AT_ASSERTM(grad_output.is_contiguous(), "grad_output tensor has to be contiguous");
+
+    AT_ASSERTM(!value.is_cuda(), "value must be a CPU tensor");
+    AT_ASSERTM(!spatial_shapes.is_cuda(), "spatial_shapes must be a CPU tensor");
+    AT_ASSERTM(!level_start_index.is_cuda(), "level_start_index must be a CPU tensor");
+    AT_ASSERTM(!sampling_loc.is_cuda(), "sampling_loc must be a CPU tensor");
+    AT_ASSERTM(!attn_weight.is_cuda(), "attn_weight must be a CPU tensor");
+    AT_ASSERTM(!grad_output.is_cuda(), "grad_output must be a CPU tensor");
 
+    const int batch = value.size(0);
+    const int spatial_size = value.size(1);
+    const int num_heads = value.size(2);
+    const int channels = value.size(3);
+
+    const int num_levels = spatial_shapes.size(0);
+
+    const int num_query = sampling_loc.size(1);
+    const int num_point = sampling_loc.size(4);
+
+    auto grad_value = at::zeros_like(value);
+    auto grad_sampling_loc = at::zeros_like(sampling_loc);
+    auto grad_attn_weight = at::zeros_like(attn_weight);
+
+    AT_DISPATCH_FLOATING_TYPES(value.scalar_type(), "ms_deform_attn_backward_cpu", ([&] {
+        ms_deformable_col2im_cpu(
+            grad_output.data_ptr<scalar_t>(),
+            value.data_ptr<scalar_t>(),
+            spatial_shapes.data_ptr<int64_t>(),
+            level_start_index.data_ptr<int64_t>(),
+            sampling_loc.data_ptr<scalar_t>(),
+            attn_weight.data_ptr<scalar_t>(),
+            batch, spatial_size, num_heads, channels, num_levels, num_query, num_point,
+            grad_value.data_ptr<scalar_t>(),
+            grad_sampling_loc.data_ptr<scalar_t>(),
+            grad_attn_weight.data_ptr<scalar_t>());
+    }));
+
+    return {
+        grad_value, grad_sampling_loc, grad_attn_weight
+    };
+}
@@ -13,6 +13,7 @@ from __future__ import absolute_import
 from __future__ import print_function
 from __future__ import division
 
+import sys
 import time
 import torch
 import torch.nn as nn
@@ -23,7 +24,7 @@ from functions.ms_deform_attn_func import MSDeformAttnFunction, ms_deform_attn_c
 
 N, M, D = 1, 2, 2
 Lq, L, P = 2, 2, 2
-shapes = torch.as_tensor([(6, 4), (3, 2)], dtype=torch.long).cuda()
+shapes = torch.as_tensor([(6, 4), (3, 2)], dtype=torch.long)
 level_start_index = torch.cat((shapes.new_zeros((1, )), shapes.prod(1).cumsum(0)[:-1]))
 S = sum([(H*W).item() for H, W in shapes])
 
@@ -31,44 +32,44 @@ S = sum([(H*W).item() for H, W in shapes])
 torch.manual_seed(3)
 
 
-@torch.no_grad()
-def check_forward_equal_with_pytorch_double():
-    value = torch.rand(N, S, M, D).cuda() * 0.01
-    sampling_locations = torch.rand(N, Lq, M, L, P, 2).cuda()
-    attention_weights = torch.rand(N, Lq, M, L, P).cuda() + 1e-5
+def get_inputs(channels=D, device='cpu'):
+    value = torch.rand(N, S, M, channels, device=device) * 0.01
+    sampling_locations = torch.rand(N, Lq, M, L, P, 2, device=device)
+    attention_weights = torch.rand(N, Lq, M, L, P, device=device) + 1e-5
     attention_weights /= attention_weights.sum(-1, keepdim=True).sum(-2, keepdim=True)
+    return value, sampling_locations, attention_weights
+
+
+@torch.no_grad()
+def check_forward_equal_with_pytorch_double(device='cuda'):
+    value, sampling_locations, attention_weights = get_inputs(device=device)
     im2col_step = 2
     output_pytorch = ms_deform_attn_core_pytorch(value.double(), shapes, sampling_locations.double(), attention_weights.double()).detach().cpu()
-    output_cuda = MSDeformAttnFunction.apply(value.double(), shapes, level_start_index, sampling_locations.double(), attention_weights.double(), im2col_step).detach().cpu()
-    fwdok = torch.allclose(output_cuda, output_pytorch)
-    max_abs_err = (output_cuda - output_pytorch).abs().max()
-    max_rel_err = ((output_cuda - output_pytorch).abs() / output_pytorch.abs()).max()
+    output_op = MSDeformAttnFunction.apply(value.double(), shapes.to(device), level_start_index.to(device), sampling_locations.double(), attention_weights.double(), im2col_step).detach().cpu()
+    fwdok = torch.allclose(output_op, output_pytorch)
+    max_abs_err = (output_op - output_pytorch).abs().max()
+    max_rel_err = ((output_op - output_pytorch).abs() / output_pytorch.abs()).max()
 
-    print(f'* {fwdok} check_forward_equal_with_pytorch_double: max_abs_err {max_abs_err:.2e} max_rel_err {max_rel_err:.2e}')
+    print(f'* {fwdok} check_forward_equal_with_pytorch_double({device}): max_abs_err {max_abs_err:.2e} max_rel_err {max_rel_err:.2e}')
+    return fwdok
 
 
 @torch.no_grad()
-def check_forward_equal_with_pytorch_float():
-    value = torch.rand(N, S, M, D).cuda() * 0.01
-    sampling_locations = torch.rand(N, Lq, M, L, P, 2).cuda()
-    attention_weights = torch.rand(N, Lq, M, L, P).cuda() + 1e-5
-    attention_weights /= attention_weights.sum(-1, keepdim=True).sum(-2, keepdim=True)
+def check_forward_equal_with_pytorch_float(device='cuda'):
+    value, sampling_locations, attention_weights = get_inputs(device=device)
     im2col_step = 2
     output_pytorch = ms_deform_attn_core_pytorch(value, shapes, sampling_locations, attention_weights).detach().cpu()
-    output_cuda = MSDeformAttnFunction.apply(value, shapes, level_start_index, sampling_locations, attention_weights, im2col_step).detach().cpu()
-    fwdok = torch.allclose(output_cuda, output_pytorch, rtol=1e-2, atol=1e-3)
-    max_abs_err = (output_cuda - output_pytorch).abs().max()
-    max_rel_err = ((output_cuda - output_pytorch).abs() / output_pytorch.abs()).max()
-
-    print(f'* {fwdok} check_forward_equal_with_pytorch_float: max_abs_err {max_abs_err:.2e} max_rel_err {max_rel_err:.2e}')
+    output_op = MSDeformAttnFunction.apply(value, shapes.to(device), level_start_index.to(device), sampling_locations, attention_weights, im2col_step).detach().cpu()
+    fwdok = torch.allclose(output_op, output_pytorch, rtol=1e-2, atol=1e-3)
+    max_abs_err = (output_op - output_pytorch).abs().max()
+    max_rel_err = ((output_op - output_pytorch).abs() / output_pytorch.abs()).max()
 
+    print(f'* {fwdok} check_forward_equal_with_pytorch_float({device}): max_abs_err {max_abs_err:.2e} max_rel_err {max_rel_err:.2e}')
+    return fwdok
 
-def check_gradient_numerical(channels=4, grad_value=True, grad_sampling_loc=True, grad_attn_weight=True):
 
-    value = torch.rand(N, S, M, channels).cuda() * 0.01
-    sampling_locations = torch.rand(N, Lq, M, L, P, 2).cuda()
-    attention_weights = torch.rand(N, Lq, M, L, P).cuda() + 1e-5
-    attention_weights /= attention_weights.sum(-1, keepdim=True).sum(-2, keepdim=True)
+def check_gradient_numerical(channels=4, grad_value=True, grad_sampling_loc=True, grad_attn_weight=True, device='cuda'):
+    value, sampling_locations, attention_weights = get_inputs(channels, device)
     im2col_step = 2
     func = MSDeformAttnFunction.apply
 
@@ -76,17 +77,54 @@ def check_gradient_numerical(channels=4, grad_value=True, grad_sampling_loc=True
     sampling_locations.requires_grad = grad_sampling_loc
     attention_weights.requires_grad = grad_attn_weight
 
-    gradok = gradcheck(func, (value.double(), shapes, level_start_index, sampling_locations.double(), attention_weights.double(), im2col_step))
+    gradok = gradcheck(func, (value.double(), shapes.to(device), level_start_index.to(device), sampling_locations.double(), attention_weights.double(), im2col_step))
 
-    print(f'* {gradok} check_gradient_numerical(D={channels})')
+    print(f'* {gradok} check_gradient_numerical(D={channels}, {device})')
+    return gradok
 
 
-if __name__ == '__main__':
-    check_forward_equal_with_pytorch_double()
-    check_forward_equal_with_pytorch_float()
+def check_cpu_equal_with_cuda(channels=4):
+    value, sampling_locations, attention_weights = [x.double() for x in get_inputs(channels)]
+    grad_output = torch.rand(N, Lq, M * channels).double()
+    im2col_step = 2
 
-    for channels in [30, 32, 64, 71, 1025, 2048, 3096]:
-        check_gradient_numerical(channels, True, True, True)
+    outputs, grads = [], []
+    for device in ['cpu', 'cuda']:
+        inputs = [x.to(device).requires_grad_() for x in (value, sampling_locations, attention_weights)]
+        output = MSDeformAttnFunction.apply(
+            inputs[0], shapes.to(device), level_start_index.to(device), inputs[1], inputs[2], im2col_step)
+        output.backward(grad_output.to(device))
+        outputs.append(output.detach().cpu())
+        grads.append([x.grad.cpu() for x in inputs])
 
+    fwdok = torch.allclose(outputs[0], outputs[1])
+    bwdok = all(torch.allclose(g_cpu, g_cuda) for g_cpu, g_cuda in zip(*grads))
+    max_abs_err = (outputs[0] - outputs[1]).abs().max()
 
+    print(f'* {fwdok and bwdok} check_cpu_equal_with_cuda(D={channels}): forward max_abs_err {max_abs_err:.2e}')
+    return fwdok and bwdok
 
+
+if __name__ == '__main__':
+    # the CPU kernels are checked on machines without GPUs, e.g. in CI
+    results = [
+        check_forward_equal_with_pytorch_double('cpu'),
+        check_forward_equal_with_pytorch_float('cpu'),
+    ]
+    for channels in [30, 32, 64, 71]:
+        results.append(check_gradient_numerical(channels, True, True, True, device='cpu'))
+
+    if torch.cuda.is_available():
+        results.append(check_forward_equal_with_pytorch_double('cuda'))
+        results.append(check_forward_equal_with_pytorch_float('cuda'))
+
+        for channels in [30, 32, 64, 71, 1025, 2048, 3096]:
+            results.append(check_gradient_numerical(channels, True, True, True, device='cuda'))
+
+        for channels in [30, 32, 64, 71]:
+            results.append(check_cpu_equal_with_cuda(channels))
+    else:
+        print('* CUDA is not available, skip the CUDA checks')
+
+    if not all(results):
+        sys.exit(1)
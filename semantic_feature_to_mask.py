@@ -1,10 +1,13 @@
 import os
+import glob
 import torch
 from torch import nn
 import torch.nn.functional as F
 from einops import rearrange
 import matplotlib.pyplot as plt
 
+from univs.data.semantic_feature_store import SemanticFeatureStore
+
 
 def calculate_mask_quality_scores(mask_pred, threshold=1):
     # mask_pred is the logits, before activation
@@ -135,17 +138,34 @@ def plot_masks(mask_logits):
         print(f"Figure saved as {output_path}")
 
 
+def load_semantic_features(video_dir, video_name, compression_ratio=32, compression_ratio_temporal=1, start=0, end=None):
+    """
+    Load the compressed mask features and object tokens of the frames [start, end) of a video,
+    from the shards in `video_dir` if any, otherwise from the per-video .pt files.
+    """
+    s_itv, t_itv = compression_ratio, compression_ratio_temporal
+    index_files = sorted(glob.glob(os.path.join(video_dir, f"semantic_features_{s_itv}_{t_itv}_*.index.jsonl")))
+    if len(index_files):
+        # only the shards of the given compression ratios
+        store = SemanticFeatureStore(index_files)
+        if video_name in store:
+            mask_feats = store.load(video_name, "compression_mask_features", start, end)
+            obj_tokens = store.load(video_name, "obj_tokens", start, end)
+            return mask_feats, obj_tokens
+
+    mask_feats = torch.load(os.path.join(video_dir, video_name + f"._compression_mask_features_{s_itv}_{t_itv}.pt"), map_location='cpu')
+    obj_tokens = torch.load(os.path.join(video_dir, video_name + f"._obj_tokens_{s_itv}_{t_itv}.pt"), map_location='cpu')
+    return mask_feats[start:end].float(), obj_tokens[start:end].float()
+
+
 if __name__  == "__main__":
     converter = ConvertSemanticFeatureToMask()
 
-    mask_feat_suffix = "_compression_mask_features_32_1.pt"
-    obj_token_suffix = "_obj_tokens_32_1.pt"
-
     video_name = "--hNhsGTd8s_00:02:04.680_00:02:14.680"
     video_dir = "datasets/internvid/semantic_extraction/InternVId-FLT_1"
 
-    mask_feats = torch.load(os.path.join(video_dir, video_name + mask_feat_suffix))
-    obj_tokens = torch.load(os.path.join(video_dir, video_name + obj_token_suffix))
+    mask_feats, obj_tokens = load_semantic_features(video_dir, video_name, compression_ratio=32, compression_ratio_temporal=1)
+    mask_feats, obj_tokens = mask_feats.to(converter.device), obj_tokens.to(converter.device)
 
     cls_logits, mask_logits, indices = converter.convert(mask_feats, obj_tokens)
-    plot_masks(mask_logits)
\ No newline at end of file
+    plot_masks(mask_logits)
@@ -0,0 +1,493 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmark the video inference engines of UniVS per stage on synthetic videos.
+
+Each engine is driven on random videos with moving objects. The wall time, the peak memory and the
+number of allocations are reported per stage:
+    backbone, pixel_decoder, transformer_decoder, tracker (trackers, memory pools and matching),
+    post_processing and output_writing,
+and saved into a json file, which can be compared with a previous run to catch performance regressions.
+
+By default, a tiny model with random weights runs on cpu, so no gpu, checkpoint or dataset is needed:
+    $ python tools/benchmark_inference.py --engine vos --num-frames 30 --height 240 --width 320 \\
+        --num-objects 5 --num-prompts 3 --output output/benchmark/vos.json
+    $ python tools/benchmark_inference.py --engine vos --compare output/benchmark/vos.json
+
+tools/test/test_benchmark_cpu.sh is a smoke test of all engines and of the comparison on cpu.
+"""
+import argparse
+import contextlib
+import json
+import logging
+import os
+import platform
+import resource
+import sys
+import tempfile
+import time
+from collections import OrderedDict, defaultdict
+from pathlib import Path
+
+import numpy as np
+import torch
+from torch.autograd.profiler import record_function
+
+from detectron2.config import get_cfg
+from detectron2.modeling import build_model
+from detectron2.projects.deeplab import add_deeplab_config
+from detectron2.structures import BitMasks, Boxes, Instances
+from detectron2.utils.logger import setup_logger
+
+sys.path.append(str(Path(__file__).resolve().parents[1]))
+
+from datasets.concept_emb.combined_datasets_category_info import combined_datasets_category_info
+from mask2former import add_maskformer2_config
+from mask2former_video import add_maskformer2_video_config
+from regionclip import add_regionclip_config
+from univs import add_univs_config, FastOverTracker_DET
+from univs.data.semantic_feature_store import SemanticFeatureShardWriter
+from univs.inference.comm import OnlineClipAverager
+from univs.modeling.tracking.mdqe_overtracker_efficient import MDQE_OverTrackerEfficient
+from univs.utils.async_writer import AsyncImageWriter
+
+logger = logging.getLogger("detectron2")
+
+STAGES = ["backbone", "pixel_decoder", "transformer_decoder", "tracker", "post_processing", "output_writing"]
+_STAGE_PREFIX = "univs_stage::"
+
+# engine: (attribute of the engine in UniVS_Prompt, dataset name, task, config options)
+ENGINES = OrderedDict([
+    ("entity", ("inference_video_entity", "vipseg_panoptic_val", "detection",
+                ["MODEL.UniVS.TEST.VIDEO_UNIFIED_INFERENCE_ENABLE", True])),
+    ("vos", ("inference_video_vos", "sot_davis17_val", "sot", [])),
+    ("vis", ("inference_video_vis_fast", "ytvis_2021_val", "detection",
+             ["MODEL.BoxVIS.TEST.TRACKER_TYPE", "minvis"])),
+    ("vps", ("inference_video_vps", "vipseg_panoptic_val", "detection", [])),
+    ("semantic_extraction", ("inference_video_semantic_extraction", "internvid-flt-1", "detection",
+                             ["MODEL.UniVS.TEST.SEMANTIC_EXTRACTION.ENABLE", True])),
+])
+
+# methods of the engines, their module-level functions and helper classes, grouped by stage
+_ENGINE_METHODS = {
+    "tracker": [
+        "write_prompt_predictions_into_annotations_per_clip",
+        "detect_newly_entities_per_clip_instance",
+        "detect_newly_entities_per_clip_pixel",
+        "write_newly_entities_into_annotations_per_clip",
+        "pad_zero_annotations_for_next_clip",
+        "write_targets_into_annotations_per_clip",
+        "write_predictions_into_annotations_per_clip",
+        "match_from_embds",
+    ],
+    "post_processing": [
+        "save_results_vis",
+        "save_results_vps",
+        "save_results_vss",
+        "save_vos_results",
+        "save_rvos_results",
+        "inference_video_vis_minvis_save_video",
+        "inference_video_vis_mdqe_save_window",
+        "inference_video_vps_save_results",
+    ],
+}
+_MODULE_FUNCTIONS = {
+    "tracker": ["match_from_learnable_embds", "check_consistency_with_prev_frames", "bisoftmax_similarity"],
+}
+_CLASS_METHODS = [
+    ("tracker", OnlineClipAverager, ["update", "finalize"]),
+    ("tracker", FastOverTracker_DET, ["init_memory", "update", "get_result", "get_query_embds"]),
+    ("tracker", MDQE_OverTrackerEfficient, ["init_memory", "update", "get_result", "get_query_embds"]),
+    ("output_writing", AsyncImageWriter, ["write", "flush"]),
+    ("output_writing", SemanticFeatureShardWriter, ["append", "end_video"]),
+    ("output_writing", torch, ["save"]),
+]
+
+
+class StageProfiler:
+    """
+    Measure the wall time of nested stages. The time of a stage excludes its inner stages ("self"),
+    e.g. the output writing called inside the post-processing is only counted once.
+    On gpu, the peak memory and the number of allocations are read from the cuda caching allocator,
+    otherwise they are computed from the memory events of `torch.profiler` in `memory_by_stage`.
+    """
+
+    def __init__(self, device):
+        self.device = torch.device(device)
+        self.is_cuda = self.device.type == "cuda"
+        self.stats = defaultdict(lambda: defaultdict(float))
+        self._stack = []
+
+    def _sync(self):
+        if self.is_cuda:
+            torch.cuda.synchronize(self.device)
+
+    def _cuda_stats(self):
+        stats = torch.cuda.memory_stats(self.device)
+        return stats.get("allocation.all.allocated", 0), stats.get("allocated_bytes.all.allocated", 0)
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        self._sync()
+        frame = {"name": name, "children_time": 0., "children_allocs": (0, 0), "peak": 0}
+        if self.is_cuda:
+            if len(self._stack):
+                parent = self._stack[-1]
+                parent["peak"] = max(parent["peak"], torch.cuda.max_memory_allocated(self.device))
+            torch.cuda.reset_peak_memory_stats(self.device)
+            frame["base"] = torch.cuda.memory_allocated(self.device)
+            frame["allocs"] = self._cuda_stats()
+        self._stack.append(frame)
+        start = time.perf_counter()
+        try:
+            with record_function(_STAGE_PREFIX + name):
+                yield
+        finally:
+            self._sync()
+            elapsed = time.perf_counter() - start
+            self._stack.pop()
+            stats = self.stats[name]
+            stats["calls"] += 1
+            stats["wall_ms"] += elapsed * 1e3
+            stats["self_ms"] += (elapsed - frame["children_time"]) * 1e3
+            if self.is_cuda:
+                peak = max(frame["peak"], torch.cuda.max_memory_allocated(self.device))
+                num_allocs, alloc_bytes = self._cuda_stats()
+                num_allocs, alloc_bytes = num_allocs - frame["allocs"][0], alloc_bytes - frame["allocs"][1]
+                stats["peak_mem_bytes"] = max(stats["peak_mem_bytes"], peak - frame["base"])
+                # the allocations are counted in the innermost stage only
+                stats["num_allocs"] += num_allocs - frame["children_allocs"][0]
+                stats["alloc_bytes"] += alloc_bytes - frame["children_allocs"][1]
+            if len(self._stack):
+                parent = self._stack[-1]
+                parent["children_time"] += elapsed
+                if self.is_cuda:
+                    parent["peak"] = max(parent["peak"], peak)
+                    children_allocs = parent["children_allocs"]
+                    parent["children_allocs"] = (children_allocs[0] + num_allocs, children_allocs[1] + alloc_bytes)
+
+    def wrap(self, name, func):
+        def _wrapped(*args, **kwargs):
+            with self.stage(name):
+                return func(*args, **kwargs)
+        _wrapped.__wrapped__ = func
+        return _wrapped
+
+
+def memory_by_stage(events):
+    """
+    Attribute the cpu memory events of `torch.profiler` to the innermost stage, returns
+    {stage: {"peak_mem_bytes", "num_allocs", "alloc_bytes"}}, where the peak is relative to
+    the memory in use when the stage starts.
+    """
+    points = []
+    for e in events:
+        if e.name.startswith(_STAGE_PREFIX):
+            points.append((e.time_range.start, 0, e))
+            points.append((e.time_range.end, 2, e))
+        elif e.name == "[memory]":
+            points.append((e.time_range.start, 1, e))
+    points.sort(key=lambda p: (p[0], p[1]))
+
+    stats = defaultdict(lambda: defaultdict(int))
+    active = []  # [stage name, event, memory at the start, peak]
+    current = 0
+    for _, kind, e in points:
+        if kind == 0:
+            active.append([e.name[len(_STAGE_PREFIX):], e, current, current])
+        elif kind == 1:
+            current += e.cpu_memory_usage
+            for a in active:
+                a[3] = max(a[3], current)
+            if e.cpu_memory_usage > 0 and len(active):
+                stats[active[-1][0]]["num_allocs"] += 1
+                stats[active[-1][0]]["alloc_bytes"] += e.cpu_memory_usage
+        else:
+            for i in range(len(active) - 1, -1, -1):
+                if active[i][1] is e:
+                    name, _, base, peak = active.pop(i)
+                    stats[name]["peak_mem_bytes"] = max(stats[name]["peak_mem_bytes"], peak - base)
+                    break
+    return stats
+
+
+@contextlib.contextmanager
+def instrument(profiler, model, engine):
+    """
+    Temporarily wrap the modules, the engine methods and the helper classes with the stages.
+    """
+    targets = [
+        ("backbone", model.backbone, "forward"),
+        ("pixel_decoder", model.sem_seg_head.pixel_decoder, "forward_features"),
+        ("transformer_decoder", model.sem_seg_head.predictor, "forward"),
+    ]
+    for stage, names in _ENGINE_METHODS.items():
+        targets += [(stage, engine, name) for name in names if hasattr(engine, name)]
+    engine_module = sys.modules[type(engine).__module__]
+    for stage, names in _MODULE_FUNCTIONS.items():
+        targets += [(stage, engine_module, name) for name in names if hasattr(engine_module, name)]
+    for stage, owner, names in _CLASS_METHODS:
+        targets += [(stage, owner, name) for name in names if hasattr(owner, name)]
+
+    originals = []
+    try:
+        for stage, owner, name in targets:
+            raw = vars(owner).get(name, None)
+            originals.append((owner, name, name in vars(owner), raw))
+            wrapped = profiler.wrap(stage, getattr(owner, name))
+            setattr(owner, name, staticmethod(wrapped) if isinstance(raw, staticmethod) else wrapped)
+        yield
+    finally:
+        for owner, name, existed, raw in reversed(originals):
+            if existed:
+                setattr(owner, name, raw)
+            else:
+                delattr(owner, name)
+
+
+def setup(args, tmp_dir):
+    attr, dataset_name, _, engine_opts = ENGINES[args.engine]
+    cfg = get_cfg()
+    add_deeplab_config(cfg)
+    add_maskformer2_config(cfg)
+    add_maskformer2_video_config(cfg)
+    add_regionclip_config(cfg)
+    add_univs_config(cfg)
+    cfg.merge_from_file(args.config_file)
+
+    # random class embeddings of all datasets, instead of the offline CLIP text embeddings
+    num_classes = max(n + start for n, start in combined_datasets_category_info.values())
+    clip_class_embed_path = os.path.join(tmp_dir, "cls_emb.pth")
+    torch.save(torch.randn(num_classes, cfg.MODEL.SEM_SEG_HEAD.LANG_DIM), clip_class_embed_path)
+
+    cfg.merge_from_list([
+        "MODEL.DEVICE", args.device,
+        "MODEL.UniVS.CLIP_CLASS_EMBED_PATH", clip_class_embed_path,
+        "MODEL.UniVS.TEST.SEMANTIC_EXTRACTION.OUTPUT_DIR", os.path.join(tmp_dir, "semantic_extraction"),
+        "DATASETS.TEST", (dataset_name,),
+        "OUTPUT_DIR", tmp_dir + "/",
+    ] + engine_opts)
+    cfg.merge_from_list(args.opts or [])
+    cfg.freeze()
+    return cfg
+
+
+def make_synthetic_video(args, cfg, rng, video_idx, tmp_dir):
+    """
+    A video of random noise with `num_objects` moving rectangles, in the format of the dataset mappers.
+    The first `num_prompts` objects are given as the visual prompts on the first frame for vos.
+    """
+    _, dataset_name, task, _ = ENGINES[args.engine]
+    T, H, W = args.num_frames, args.height, args.width
+
+    frames = rng.randint(0, 256, size=(T, H, W, 3)).astype(np.uint8)
+    obj_masks = np.zeros((args.num_objects, T, H, W), dtype=bool)
+    for k in range(args.num_objects):
+        h, w = rng.randint(H // 8, H // 3), rng.randint(W // 8, W // 3)
+        y, x = rng.randint(0, H - h), rng.randint(0, W - w)
+        vy, vx = rng.randint(-3, 4), rng.randint(-3, 4)
+        color = rng.randint(0, 256, size=3)
+        for t in range(T):
+            y_t = int(np.clip(y + vy * t, 0, H - h))
+            x_t = int(np.clip(x + vx * t, 0, W - w))
+            obj_masks[k, t, y_t:y_t + h, x_t:x_t + w] = True
+            frames[t, y_t:y_t + h, x_t:x_t + w] = color
+
+    video_id = f"synthetic_{video_idx:05d}"
+    video_dir = os.path.join(tmp_dir, "raw", dataset_name, video_id)
+    video = {
+        "dataset_name": dataset_name,
+        "task": task,
+        "video_id": video_id,
+        "video_len": T,
+        "length": T,
+        "height": H,
+        "width": W,
+        "is_raw_video": False,
+        "has_mask": True,
+        "frame_indices": list(range(T)),
+        "file_names": [os.path.join(video_dir, f"{t:05d}.jpg") for t in range(T)],
+        "image": [torch.as_tensor(np.ascontiguousarray(f.transpose(2, 0, 1))) for f in frames],
+        "mask_palette": [c for i in range(256) for c in (i, i, i)],
+    }
+
+    if task == "sot":
+        instances = []
+        num_prompts = min(args.num_prompts, args.num_objects)
+        for t in range(T):
+            if t == 0 and num_prompts > 0:
+                masks = torch.as_tensor(obj_masks[:num_prompts, 0])
+                inst = Instances((H, W))
+                inst.gt_masks = BitMasks(masks)
+                inst.gt_boxes = inst.gt_masks.get_bounding_boxes()
+                inst.gt_classes = torch.zeros(num_prompts, dtype=torch.int64)
+                inst.ori_ids = list(range(1, num_prompts + 1))
+            else:
+                inst = Instances((H, W))
+                inst.gt_masks = BitMasks(torch.zeros((0, H, W), dtype=torch.bool))
+                inst.gt_boxes = Boxes(torch.zeros((0, 4)))
+                inst.gt_classes = torch.zeros(0, dtype=torch.int64)
+                inst.ori_ids = []
+            instances.append(inst)
+        video["instances"] = instances
+    return [video]
+
+
+def run_benchmark(args, cfg, tmp_dir):
+    torch.manual_seed(args.seed)
+    rng = np.random.RandomState(args.seed)
+    model = build_model(cfg)  # random weights
+    model.eval()
+    engine = getattr(model, ENGINES[args.engine][0])
+
+    with torch.no_grad():
+        for i in range(args.warmup):
+            model(make_synthetic_video(args, cfg, rng, i, tmp_dir))
+
+        videos = [make_synthetic_video(args, cfg, rng, args.warmup + i, tmp_dir) for i in range(args.num_videos)]
+        profiler = StageProfiler(cfg.MODEL.DEVICE)
+        if profiler.is_cuda:
+            torch.cuda.reset_peak_memory_stats(profiler.device)
+        memory_profile = contextlib.nullcontext()
+        if not profiler.is_cuda and args.profile_memory:
+            memory_profile = torch.profiler.profile(
+                activities=[torch.profiler.ProfilerActivity.CPU], profile_memory=True
+            )
+
+        start = time.perf_counter()
+        with memory_profile as prof, instrument(profiler, model, engine):
+            for video in videos:
+                with profiler.stage("total"):
+                    model(video)
+        total_time = time.perf_counter() - start
+
+    stages = OrderedDict()
+    cpu_memory = memory_by_stage(prof.events()) if prof is not None else {}
+    for name in STAGES:
+        stats = dict(profiler.stats.get(name, {}))
+        stats.update(cpu_memory.get(name, {}))
+        stages[name] = {
+            "calls": int(stats.get("calls", 0)),
+            "wall_ms": stats.get("wall_ms", 0.),
+            "self_ms": stats.get("self_ms", 0.),
+            "self_ms_per_video": stats.get("self_ms", 0.) / args.num_videos,
+            "peak_mem_bytes": int(stats.get("peak_mem_bytes", 0)),
+            "num_allocs": int(stats.get("num_allocs", 0)),
+            "alloc_bytes": int(stats.get("alloc_bytes", 0)),
+        }
+    stages["other"] = {
+        "self_ms": profiler.stats["total"]["self_ms"],
+        "self_ms_per_video": profiler.stats["total"]["self_ms"] / args.num_videos,
+    }
+
+    if profiler.is_cuda:
+        peak_memory = torch.cuda.max_memory_allocated(profiler.device)
+    else:
+        # ru_maxrss is in kilobytes on linux, in bytes on macos
+        peak_memory = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        peak_memory *= 1 if platform.system() == "Darwin" else 1024
+    return {
+        "engine": args.engine,
+        "config_file": args.config_file,
+        "opts": args.opts or [],
+        "device": cfg.MODEL.DEVICE,
+        "torch_version": torch.__version__,
+        "num_threads": torch.get_num_threads(),
+        "video": {
+            "num_videos": args.num_videos,
+            "num_frames": args.num_frames,
+            "height": args.height,
+            "width": args.width,
+            "num_objects": args.num_objects,
+            "num_prompts": args.num_prompts,
+        },
+        "total": {
+            "wall_s": total_time,
+            "fps": args.num_videos * args.num_frames / total_time,
+            "peak_mem_bytes": int(peak_memory),
+        },
+        "stages": stages,
+    }
+
+
+def compare_results(results, baseline, tolerance):
+    """
+    Return the stages whose time or peak memory is larger than the baseline by `tolerance` (relative).
+    """
+    regressions = []
+    for name, stats in results["stages"].items():
+        base = baseline["stages"].get(name)
+        if base is None:
+            continue
+        for key in ("self_ms_per_video", "peak_mem_bytes"):
+            if key in stats and key in base and base[key] > 0 and stats[key] > base[key] * (1 + tolerance):
+                regressions.append(f"{name}.{key}: {base[key]:.1f} -> {stats[key]:.1f}")
+    return regressions
+
+
+def log_results(results):
+    lines = ["{:<20s} {:>6s} {:>12s} {:>14s} {:>12s} {:>10s}".format(
+        "stage", "calls", "self ms", "ms / video", "peak MB", "allocs")]
+    for name, stats in results["stages"].items():
+        lines.append("{:<20s} {:>6d} {:>12.1f} {:>14.1f} {:>12.1f} {:>10d}".format(
+            name, stats.get("calls", 0), stats["self_ms"], stats["self_ms_per_video"],
+            stats.get("peak_mem_bytes", 0) / 2**20, stats.get("num_allocs", 0),
+        ))
+    total = results["total"]
+    lines.append("total: {:.2f}s, {:.2f} fps, peak memory {:.1f} MB".format(
+        total["wall_s"], total["fps"], total["peak_mem_bytes"] / 2**20))
+    logger.info("Benchmark of {} on {}:\n".format(results["engine"], results["device"]) + "\n".join(lines))
+
+
+def get_parser():
+    parser = argparse.ArgumentParser(description="Per-stage benchmark of the UniVS video inference engines")
+    parser.add_argument("--engine", choices=list(ENGINES.keys()), required=True)
+    parser.add_argument("--config-file", default="configs/benchmark/univs_R18_tiny_cpu.yaml", metavar="FILE")
+    parser.add_argument("--device", default="cpu")
+    parser.add_argument("--num-videos", type=int, default=3, help="number of timed videos")
+    parser.add_argument("--warmup", type=int, default=1, help="number of untimed videos")
+    parser.add_argument("--num-frames", type=int, default=20)
+    parser.add_argument("--height", type=int, default=192)
+    parser.add_argument("--width", type=int, default=320)
+    parser.add_argument("--num-objects", type=int, default=5, help="number of moving objects per video")
+    parser.add_argument("--num-prompts", type=int, default=3, help="number of visual prompts (vos only)")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument(
+        "--no-profile-memory", dest="profile_memory", action="store_false",
+        help="skip the cpu memory profiling, which slows down the timed run",
+    )
+    parser.add_argument("--output", default="", help="path of the json results")
+    parser.add_argument("--compare", default="", help="json results of a baseline run")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="relative tolerance of --compare")
+    parser.add_argument(
+        "opts",
+        help="Modify config options using the command-line 'KEY VALUE' pairs",
+        default=None,
+        nargs=argparse.REMAINDER,
+    )
+    return parser
+
+
+if __name__ == "__main__":
+    args = get_parser().parse_args()
+    setup_logger()
+    setup_logger(name="univs")
+
+    with tempfile.TemporaryDirectory(prefix="univs_benchmark_") as tmp_dir:
+        cfg = setup(args, tmp_dir)
+        results = run_benchmark(args, cfg, tmp_dir)
+    log_results(results)
+
+    if len(args.output):
+        os.makedirs(os.path.dirname(os.path.abspath(args.output)), exist_ok=True)
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+        logger.info(f"Saved benchmark results to {args.output}")
+
+    if len(args.compare):
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        regressions = compare_results(results, baseline, args.tolerance)
+        if len(regressions):
+            logger.error("Performance regressions against {}:\n{}".format(args.compare, "\n".join(regressions)))
+            sys.exit(1)
+        logger.info(f"No performance regressions against {args.compare}")
@@ -0,0 +1,151 @@
+"""
+A content-addressed cache of concept embeddings, so that a new vocabulary only encodes
+the concepts that have never been encoded before.
+
+The key of a concept is sha1(encoder weights hash, prompt templates hash, normalized concept).
+The cache dir stores append-only shards "concept_emb_<timestamp>.pth", each is a dict with
+"keys", "concepts" and "embeddings" (N x d_text), one shard per extraction run.
+"""
+import glob
+import hashlib
+import os
+import time
+
+import torch
+
+from univs.modeling.language import pre_tokenize, clean_strings
+from univs.modeling.language.clip_prompt_utils import get_prompt_templates
+
+__all__ = [
+    "normalize_concept",
+    "hash_file",
+    "hash_templates",
+    "ConceptEmbeddingCache",
+    "encode_concepts",
+    "build_concept_embeddings",
+]
+
+
+def normalize_concept(concept):
+    # the same cleaning as the encoded strings, thus it decides the embedding
+    return ' '.join(clean_strings(concept.strip()).split())
+
+
+def hash_file(path, chunk_size=1 << 20):
+    sha1 = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            sha1.update(chunk)
+    return sha1.hexdigest()
+
+
+def hash_templates(templates=None):
+    templates = get_prompt_templates() if templates is None else templates
+    return hashlib.sha1('\n'.join(templates).encode('utf-8')).hexdigest()
+
+
+class ConceptEmbeddingCache:
+    """
+    Args:
+        cache_dir (str): the dir of the cache shards, shared by different encoders and templates
+        encoder_hash (str): the hash of the language encoder weights, see `hash_file`
+        template_hash (str): the hash of the prompt templates, see `hash_templates`
+    """
+
+    def __init__(self, cache_dir, encoder_hash, template_hash):
+        self.cache_dir = cache_dir
+        self.encoder_hash = encoder_hash
+        self.template_hash = template_hash
+        self._index = {}  # key -> (shard path, row)
+        self._shards = {}
+
+        for shard_path in sorted(glob.glob(os.path.join(cache_dir, 'concept_emb_*.pth'))):
+            shard = torch.load(shard_path, map_location='cpu')
+            for row, key in enumerate(shard['keys']):
+                self._index[key] = (shard_path, row)
+            self._shards[shard_path] = shard['embeddings']
+
+    def key(self, concept):
+        content = '\n'.join([self.encoder_hash, self.template_hash, concept])
+        return hashlib.sha1(content.encode('utf-8')).hexdigest()
+
+    def __len__(self):
+        return len(self._index)
+
+    def __contains__(self, concept):
+        return self.key(concept) in self._index
+
+    def get(self, concepts):
+        """
+        Args:
+            concepts (list[str]): normalized concepts, all of them should be in the cache
+        Returns:
+            Tensor: len(concepts) x d_text
+        """
+        rows = [self._index[self.key(concept)] for concept in concepts]
+        return torch.stack([self._shards[shard_path][row] for shard_path, row in rows])
+
+    def add(self, concepts, embeddings):
+        """
+        Save the embeddings of new concepts into a new shard.
+        """
+        if len(concepts) == 0:
+            return
+        assert len(concepts) == embeddings.shape[0]
+        os.makedirs(self.cache_dir, exist_ok=True)
+        keys = [self.key(concept) for concept in concepts]
+        shard_path = os.path.join(self.cache_dir, 'concept_emb_{}_{}.pth'.format(time.strftime('%Y%m%d%H%M%S'), keys[0][:8]))
+        embeddings = embeddings.detach().float().cpu()
+        # write to a temporary file first, a partially written shard would break the cache
+        torch.save({'keys': keys, 'concepts': list(concepts), 'embeddings': embeddings}, shard_path + '.tmp')
+        os.replace(shard_path + '.tmp', shard_path)
+
+        for row, key in enumerate(keys):
+            self._index[key] = (shard_path, row)
+        self._shards[shard_path] = embeddings
+
+
+@torch.no_grad()
+def encode_concepts(lang_encoder, concepts, batch_size=8):
+    """
+    Encode concepts in batches, the embedding of a concept is averaged over all prompt templates.
+
+    Args:
+        concepts (list[str]): normalized concepts
+        batch_size (int): the number of concepts per forward pass, each has 81 templates
+    Returns:
+        Tensor: len(concepts) x d_text
+    """
+    concept_feats = []
+    for i in range(0, len(concepts), batch_size):
+        batch = concepts[i:i + batch_size]
+        print('processing the class embeddings of concepts [{}, {}) / {}'.format(i, i + len(batch), len(concepts)))
+        # num_concepts x num_templates x length_of_text, i.e. B x 81 x 77
+        token_embeddings = pre_tokenize([[concept] for concept in batch]).to(lang_encoder.device)
+        B, num_templates = token_embeddings.shape[:2]
+        # input: (B x 81) x 77, output: (B x 81) x d_text
+        text_features = lang_encoder.encode_text(token_embeddings.flatten(0, 1))
+        # average over all templates
+        concept_feats.append(text_features.view(B, num_templates, -1).mean(1).cpu())
+    return torch.cat(concept_feats)
+
+
+def build_concept_embeddings(concepts, cache, lang_encoder=None, batch_size=8):
+    """
+    Build the embedding table of a vocabulary, only the concepts missing in the cache are encoded.
+
+    Args:
+        concepts (list[str]): raw concepts, e.g. the lines of a concept file
+        cache (ConceptEmbeddingCache):
+        lang_encoder: the CLIP language encoder, None to only assemble the table from the cache
+    Returns:
+        Tensor: len(concepts) x d_text
+    """
+    concepts = [normalize_concept(concept) for concept in concepts]
+    missing = list(dict.fromkeys(concept for concept in concepts if concept not in cache))
+    print('{} concepts, {} of them are missing in the cache'.format(len(concepts), len(missing)))
+    if len(missing):
+        if lang_encoder is None:
+            raise ValueError('Concepts missing in the cache {}: {}...'.format(cache.cache_dir, missing[:10]))
+        cache.add(missing, encode_concepts(lang_encoder, missing, batch_size))
+    return cache.get(concepts)
@@ -13,4 +13,10 @@ def add_clip_text_config(cfg):
     cfg.MODEL.CLIP.WEIGHTS = "pretrained/regionclip/regionclip/regionclip_pretrained-cc_rn50x4_only_lang_encoder.pth"
     cfg.INPUT_DIR = "./datasets/concept_emb/"
     cfg.OUTPUT_DIR = './pretrained/regionclip/concept_emb/'
-    cfg.CONCEPTS_FILE = 'coco_133.txt'
\ No newline at end of file
+    cfg.CONCEPTS_FILE = 'coco_133.txt'
+
+    # concepts are encoded in batches, each concept has 81 prompt templates
+    cfg.CONCEPT_BATCH_SIZE = 8
+    # the cache of concept embeddings, keyed by the concept, the prompt templates and the encoder weights,
+    # thus only new concepts are encoded, "" to disable it
+    cfg.CONCEPT_CACHE_DIR = './datasets/concept_emb/cache/'
@@ -22,9 +22,12 @@ from detectron2.checkpoint import DetectionCheckpointer
 from detectron2.config import get_cfg
 from detectron2.engine import default_argument_parser, default_setup, launch
 
-from univs.modeling.language import build_clip_language_encoder, pre_tokenize, clean_strings
+from univs.modeling.language import build_clip_language_encoder
 from config import add_clip_text_config
 from convert_lang_encoder_weights import convert_lang_encoder_weights
+from concept_cache import (
+    ConceptEmbeddingCache, build_concept_embeddings, encode_concepts, hash_file, hash_templates, normalize_concept
+)
 
 
 def build_lang_encoder(cfg):
@@ -53,24 +56,16 @@ def build_lang_encoder(cfg):
 def extract_concept_embeddings(cfg, lang_encoder):
     # input concepts
     concept_file = os.path.join(cfg.INPUT_DIR, cfg.CONCEPTS_FILE)
-
-    concept_feats = []
     with open(concept_file, 'r') as f:
-        for line in f:
-            concept = line.strip()
-            with torch.no_grad():
-                concept = [clean_strings(concept)]
-                print('processing the class embedding of ', concept[0])
-                # num_category x num_templates x length_of_text, i.e. 1 x 81 x 77
-                token_embeddings = pre_tokenize([concept]).to(lang_encoder.device)[0]
-                # input: 81 x 77, output: 81 x d_text
-                text_features = lang_encoder.encode_text(token_embeddings)
-                # average over all templates
-                text_features = text_features.mean(0, keepdim=True)
-                concept_feats.append(text_features)
-
-    concept_feats = torch.stack(concept_feats, 0)  # N x d_text
-    concept_feats = torch.squeeze(concept_feats)  # 1 x N x d_text
+        concepts = [line.strip() for line in f]
+
+    if cfg.CONCEPT_CACHE_DIR:
+        cache = ConceptEmbeddingCache(cfg.CONCEPT_CACHE_DIR, hash_file(cfg.MODEL.CLIP.WEIGHTS), hash_templates())
+        concept_feats = build_concept_embeddings(concepts, cache, lang_encoder, cfg.CONCEPT_BATCH_SIZE)
+    else:
+        concepts = [normalize_concept(concept) for concept in concepts]
+        concept_feats = encode_concepts(lang_encoder, concepts, cfg.CONCEPT_BATCH_SIZE)  # N x d_text
+
     saved_path = os.path.join(cfg.OUTPUT_DIR, cfg.CONCEPTS_FILE.replace('.txt', '_cls_emb_rn50x4.pth'))
     torch.save(concept_feats, saved_path)
 
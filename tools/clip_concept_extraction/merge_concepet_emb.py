@@ -1,14 +1,52 @@
+"""
+Merge the concept embeddings of several concept files into one table, e.g.
+    python tools/clip_concept_extraction/merge_concepet_emb.py \
+        --concept-files datasets/concept_emb/combined_datasets.txt datasets/concept_emb/ytvis19_40.txt \
+        --output datasets/concept_emb/combined_datasets_cls_emb_rn50x4.pth
+
+The table is assembled from the concept embedding cache written by extract_concept_emb.py,
+thus the concepts should have been extracted with the same encoder weights before.
+"""
+import argparse
 import os
+import sys
+
 import torch
 
-root_dir = 'datasets/concept_emb'
-input_path1 = 'combined_datasets_cls_emb_rn50x4.pth'
-input_path2 = 'ytvis19_40_cls_emb_rn50x4.pth'
-out_path = 'combined_datasets_cls_emb_rn50x4.pth'
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'extract_concept_emb'))
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '../..'))
+
+from concept_cache import ConceptEmbeddingCache, build_concept_embeddings, hash_file, hash_templates
+
+
+def get_parser():
+    parser = argparse.ArgumentParser(description="Merge concept embeddings from the cache")
+    parser.add_argument("--concept-files", nargs="+", required=True, help="concept files, one concept per line")
+    parser.add_argument("--cache-dir", default="datasets/concept_emb/cache/")
+    parser.add_argument(
+        "--weights",
+        default="pretrained/regionclip/regionclip/regionclip_pretrained-cc_rn50x4_only_lang_encoder.pth",
+        help="the weights of the language encoder, which the cached embeddings are extracted with",
+    )
+    parser.add_argument("--output", required=True, help="the path of the merged embeddings (.pth)")
+    return parser
+
+
+def main(args):
+    cache = ConceptEmbeddingCache(args.cache_dir, hash_file(args.weights), hash_templates())
+
+    concepts = []
+    for concept_file in args.concept_files:
+        with open(concept_file, 'r') as f:
+            concepts_per_file = [line.strip() for line in f]
+        print(concept_file, len(concepts_per_file))
+        concepts += concepts_per_file
+
+    # raise an error if some concepts have not been extracted yet
+    out_emb = build_concept_embeddings(concepts, cache)
+    print(out_emb.shape)
+    torch.save(out_emb, args.output)
 
-emb1 = torch.load(os.path.join(root_dir, input_path1))
-emb2 = torch.load(os.path.join(root_dir, input_path2))
-out_emb = torch.cat([emb1, emb2])
 
-print(emb1.shape, emb2.shape, out_emb.shape)
-torch.save(out_emb, os.path.join(root_dir, out_path))
\ No newline at end of file
+if __name__ == "__main__":
+    main(get_parser().parse_args())
@@ -0,0 +1,240 @@
+# -*- coding: utf-8 -*-
+"""
+CPU test of the serving mode (univs/inference/batched_inference.py) with a dummy backbone and engine,
+no checkpoint, dataset or gpu is needed:
+    $ python tools/test/test_batched_inference.py
+or
+    $ python -m pytest tools/test/test_batched_inference.py
+"""
+import random
+import sys
+import threading
+import time
+from pathlib import Path
+
+import torch
+from torch import nn
+
+sys.path.append(str(Path(__file__).resolve().parents[2]))
+
+from univs.inference.batched_inference import BatchedBackbone, fork_inference_engine, run_batched_inference
+
+# any test that takes longer is considered as deadlocked
+TIMEOUT_S = 30
+CLIP_LEN = 2
+
+
+class DummyBackbone(nn.Module):
+    """
+    Per-frame features, which do not depend on the other frames of a batch.
+    """
+    size_divisibility = 32
+
+    def __init__(self, fail_value=None):
+        super().__init__()
+        self.fail_value = fail_value
+        self.batch_shapes = []
+        self._lock = threading.Lock()
+
+    def forward(self, x):
+        with self._lock:
+            self.batch_shapes.append(tuple(x.shape))
+        if self.fail_value is not None and (x == self.fail_value).any():
+            raise ValueError("dummy backbone failure")
+        return {"res2": x * 2 + 1, "res3": x.flip(-1)}
+
+
+class DummyEngine(nn.Module):
+    """
+    Runs the backbone clip by clip and keeps its per-video state in a registered buffer and a
+    registered submodule, which are assigned during inference as the memory pools of real engines.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.register_buffer("memory", torch.zeros(1), False)
+        self.state = nn.Identity()
+
+    def eval(self, model, batched_inputs):
+        video = batched_inputs[0]
+        frames = torch.stack(video["image"])
+        self.memory = torch.zeros(1)
+        self.state = nn.Linear(1, 1)
+        outputs = []
+        for i in range(0, len(frames), CLIP_LEN):
+            features = model.backbone(frames[i:i + CLIP_LEN])
+            self.memory = self.memory + features["res2"].sum() + features["res3"][..., 0].sum()
+            self.state.video_id = video["video_id"]
+            # interleave the videos at random
+            time.sleep(random.uniform(0, 0.005))
+            outputs.append({k: v.clone() for k, v in features.items()})
+        return {
+            "video_id": self.state.video_id,
+            "memory": self.memory.clone(),
+            "features": outputs,
+        }
+
+
+class DummyModel(nn.Module):
+    def __init__(self, backbone):
+        super().__init__()
+        self.backbone = backbone
+        self.engine = DummyEngine()
+        self.inference_video_semantic_extraction = None
+        self.device = torch.device("cpu")
+        self.inference_dtype = None
+
+    def get_inference_engine(self, batched_inputs):
+        return self.engine
+
+    def forward(self, batched_inputs):
+        return fork_inference_engine(self.engine).eval(self, batched_inputs)
+
+
+def make_video(video_id, num_frames, height=8, width=12, value=None):
+    frames = [torch.rand(3, height, width) if value is None else torch.full((3, height, width), value)
+              for _ in range(num_frames)]
+    return {"video_id": video_id, "image": frames, "dataset_name": "dummy"}
+
+
+def run_with_timeout(func, *args, **kwargs):
+    outputs = {}
+
+    def _run():
+        try:
+            outputs["result"] = func(*args, **kwargs)
+        except BaseException as e:
+            outputs["error"] = e
+
+    thread = threading.Thread(target=_run, daemon=True)
+    start = time.monotonic()
+    thread.start()
+    thread.join(TIMEOUT_S)
+    assert not thread.is_alive(), f"{getattr(func, '__name__', type(func).__name__)} is deadlocked"
+    if "error" in outputs:
+        raise outputs["error"]
+    return outputs["result"], time.monotonic() - start
+
+
+def assert_same_results(results, expected):
+    assert len(results) == len(expected)
+    for r, e in zip(results, expected):
+        assert r["video_id"] == e["video_id"]
+        assert torch.allclose(r["memory"], e["memory"])
+        assert len(r["features"]) == len(e["features"])
+        for f_r, f_e in zip(r["features"], e["features"]):
+            assert f_r.keys() == f_e.keys()
+            for k in f_r:
+                assert torch.equal(f_r[k], f_e[k])
+
+
+def test_same_results_as_single_video():
+    torch.manual_seed(0)
+    model = DummyModel(DummyBackbone())
+    # the videos finish at different clips, and two of them have a different frame size
+    videos = [
+        make_video("a", 8),
+        make_video("b", 3),
+        make_video("c", 6, height=16),
+        make_video("d", 1),
+        make_video("e", 5, height=16),
+    ]
+    expected = [model([video]) for video in videos]
+    memory = model.engine.memory.clone()
+
+    model.backbone.batch_shapes.clear()
+    results, _ = run_with_timeout(run_batched_inference, model, videos, max_batch_frames=32, max_wait_ms=50)
+    assert_same_results(results, expected)
+
+    # the backbone is restored, and the state of the engine is not touched by the forks
+    assert isinstance(model.backbone, DummyBackbone)
+    assert torch.equal(model.engine.memory, memory)
+    assert isinstance(model.engine.state, nn.Identity)
+    # some clips are packed into one forward pass, and never with the clips of another frame size
+    assert any(shape[0] > CLIP_LEN for shape in model.backbone.batch_shapes)
+    assert all(shape[-2] in {8, 16} for shape in model.backbone.batch_shapes)
+
+
+def test_all_clients_submitted():
+    # with a very long wait, the batches can only be launched once all active videos have submitted a clip,
+    # or once a video is finished, thus the inference would hang if either condition were missed
+    model = DummyModel(DummyBackbone())
+    videos = [make_video(str(i), num_frames) for i, num_frames in enumerate([6, 2, 4])]
+    expected = [model([video]) for video in videos]
+
+    model.backbone.batch_shapes.clear()
+    results, elapsed = run_with_timeout(run_batched_inference, model, videos, max_batch_frames=32, max_wait_ms=60000)
+    assert_same_results(results, expected)
+    assert elapsed < TIMEOUT_S
+    # the first batch has the first clip of every video
+    assert model.backbone.batch_shapes[0][0] == CLIP_LEN * len(videos)
+
+
+def test_max_batch_frames():
+    model = DummyModel(DummyBackbone())
+    videos = [make_video(str(i), 4) for i in range(4)]
+    expected = [model([video]) for video in videos]
+
+    model.backbone.batch_shapes.clear()
+    results, _ = run_with_timeout(run_batched_inference, model, videos, max_batch_frames=5, max_wait_ms=60000)
+    assert_same_results(results, expected)
+    # a clip is never split, so at most 2 clips (4 frames) fit in a forward pass
+    assert all(shape[0] <= 4 for shape in model.backbone.batch_shapes)
+
+
+def test_timeout():
+    # two clients, but only one of them submits a clip: the batch is launched after max_wait_ms
+    backbone = DummyBackbone()
+    batched_backbone = BatchedBackbone(backbone, num_clients=2, max_wait_ms=200)
+    x = torch.rand(CLIP_LEN, 3, 8, 12)
+    output, elapsed = run_with_timeout(batched_backbone, x)
+    assert elapsed >= 0.2
+    assert torch.equal(output["res2"], x * 2 + 1)
+    assert backbone.batch_shapes == [tuple(x.shape)]
+
+
+def test_release_client():
+    # a client that leaves unblocks the client waiting for it
+    backbone = DummyBackbone()
+    batched_backbone = BatchedBackbone(backbone, num_clients=2, max_wait_ms=60000)
+    threading.Timer(0.1, batched_backbone.release_client).start()
+    x = torch.rand(CLIP_LEN, 3, 8, 12)
+    output, elapsed = run_with_timeout(batched_backbone, x)
+    assert elapsed < TIMEOUT_S
+    assert torch.equal(output["res3"], x.flip(-1))
+
+
+def test_error_propagation():
+    model = DummyModel(DummyBackbone(fail_value=-1.))
+    videos = [make_video("a", 6), make_video("b", 4, value=-1.), make_video("c", 2, height=16)]
+    try:
+        run_with_timeout(run_batched_inference, model, videos, max_batch_frames=32, max_wait_ms=60000)
+    except ValueError as e:
+        assert "dummy backbone failure" in str(e)
+    else:
+        raise AssertionError("the error of the backbone is not raised")
+    assert isinstance(model.backbone, DummyBackbone)
+
+
+def test_fork_inference_engine():
+    engine = DummyEngine()
+    forked = fork_inference_engine(engine)
+    forked.memory = torch.ones(1)
+    forked.state = nn.Linear(1, 1)
+    assert torch.equal(engine.memory, torch.zeros(1))
+    assert isinstance(engine.state, nn.Identity)
+    # the registered tensors are shared until they are assigned
+    assert fork_inference_engine(engine).memory is engine.memory
+
+
+if __name__ == "__main__":
+    tests = [v for k, v in list(globals().items()) if k.startswith("test_") and callable(v)]
+    failed = 0
+    for test in tests:
+        try:
+            test()
+            print(f"* True {test.__name__}")
+        except Exception as e:
+            failed += 1
+            print(f"* False {test.__name__}: {type(e).__name__}: {e}")
+    sys.exit(1 if failed else 0)
@@ -0,0 +1,43 @@
+# Smoke test of tools/benchmark_inference.py on cpu, run from the root of the repo:
+#   sh tools/test/test_benchmark_cpu.sh
+# It builds the CPU kernels of MSDeformAttn if needed, checks them without CUDA, then runs every engine
+# on a tiny synthetic video and compares it with itself, so that the regression gate is known to work.
+set -e
+
+OUT_DIR=output/benchmark/smoke
+mkdir -p $OUT_DIR
+
+if ! python -c "import MultiScaleDeformableAttention" 2>/dev/null; then
+    (cd mask2former/modeling/pixel_decoder/ops && sh make.sh)
+fi
+(cd mask2former/modeling/pixel_decoder/ops && CUDA_VISIBLE_DEVICES= python test.py)
+
+for ENGINE in entity vos vis vps semantic_extraction; do
+    CUDA_VISIBLE_DEVICES= python tools/benchmark_inference.py \
+        --engine $ENGINE \
+        --num-videos 1 \
+        --warmup 0 \
+        --num-frames 6 \
+        --height 96 \
+        --width 128 \
+        --num-objects 2 \
+        --num-prompts 2 \
+        --no-profile-memory \
+        --output $OUT_DIR/$ENGINE.json
+
+    # a large tolerance, only the compare path is checked here, not the timings of a shared machine
+    CUDA_VISIBLE_DEVICES= python tools/benchmark_inference.py \
+        --engine $ENGINE \
+        --num-videos 1 \
+        --warmup 0 \
+        --num-frames 6 \
+        --height 96 \
+        --width 128 \
+        --num-objects 2 \
+        --num-prompts 2 \
+        --no-profile-memory \
+        --compare $OUT_DIR/$ENGINE.json \
+        --tolerance 100
+done
+
+echo "Benchmark smoke test passed, results are saved in $OUT_DIR"
@@ -8,6 +8,7 @@ except:
 
 import copy
 import itertools
+import json
 import logging
 import os
 
@@ -44,6 +45,7 @@ from detectron2.evaluation import (
 
 from detectron2.projects.deeplab import add_deeplab_config, build_lr_scheduler
 from detectron2.solver.build import maybe_add_gradient_clipping
+from detectron2.utils.file_io import PathManager
 from detectron2.utils.logger import setup_logger
 
 import datasets.concept_emb
@@ -60,11 +62,14 @@ from univs import (
     PVOSEvaluator,
     DAVISEvaluator,
     build_combined_loader,
+    build_combined_train_loader,
     build_detection_train_loader,
     build_detection_test_loader,
     add_univs_config,
     copy_TeacherNet_weights
 )
+from univs.utils.comm import get_inference_dtype, inference_autocast
+from univs.utils.profiling import profiler
 
 
 class Trainer(DefaultTrainer):
@@ -141,9 +146,13 @@ class Trainer(DefaultTrainer):
         elif evaluator_type == "ytvis":
             evaluator_list.append(YTVISEvaluator(dataset_name, cfg, True, output_folder))
         elif evaluator_type == "video_panoptic_seg":
-            evaluator_list.append(VPSEvaluator(dataset_name, cfg, True, output_folder))
+            evaluator_list.append(VPSEvaluator(
+                dataset_name, cfg, True, output_folder, num_writer_workers=cfg.MODEL.UniVS.TEST.NUM_WRITER_WORKERS
+            ))
         elif evaluator_type == "video_semantic_seg":
-            evaluator_list.append(VSSEvaluator(dataset_name, cfg, True, output_folder))
+            evaluator_list.append(VSSEvaluator(
+                dataset_name, cfg, True, output_folder, num_writer_workers=cfg.MODEL.UniVS.TEST.NUM_WRITER_WORKERS
+            ))
         elif evaluator_type == "davis":
             evaluator_list.append(DAVISEvaluator(dataset_name, cfg, True, output_folder))
         elif evaluator_type == "pvos":
@@ -182,6 +191,8 @@ class Trainer(DefaultTrainer):
         if len(mappers) == 1:
             mapper = mappers[0]
             return build_detection_train_loader(cfg, mapper=mapper, dataset_name=cfg.DATASETS.TRAIN[0])
+        elif cfg.DATASETS.DATALOADER_SHARED_WORKERS:
+            return build_combined_train_loader(cfg, mappers, cfg.DATASETS.TRAIN, cfg.DATASETS.DATASET_RATIO)
         else:
             loaders = [
                 build_detection_train_loader(cfg, mapper=mapper, dataset_name=dataset_name)
@@ -305,7 +316,6 @@ class Trainer(DefaultTrainer):
         Returns:
             dict: a dict of result metrics
         """
-        from torch.cuda.amp import autocast
         logger = logging.getLogger(__name__)
         if isinstance(evaluators, DatasetEvaluator):
             evaluators = [evaluators]
@@ -314,6 +324,10 @@ class Trainer(DefaultTrainer):
                 len(cfg.DATASETS.TEST), len(evaluators)
             )
 
+        if cfg.MODEL.UniVS.TEST.PROFILING.ENABLE:
+            profiler.enable(accurate=cfg.MODEL.UniVS.TEST.PROFILING.ACCURATE)
+
+        inference_dtype = get_inference_dtype(cfg.MODEL.UniVS.TEST.PRECISION)
         results = OrderedDict()
         for idx, dataset_name in enumerate(cfg.DATASETS.TEST):
             data_loader = cls.build_test_loader(cfg, dataset_name)
@@ -331,7 +345,10 @@ class Trainer(DefaultTrainer):
                     )
                     results[dataset_name] = {}
                     continue
-            with autocast():
+            # the stats of a previous evaluation, e.g. the periodic evaluation during training
+            profiler.reset(dataset_name)
+            # fp32 disables autocast, see MODEL.UniVS.TEST.PRECISION
+            with inference_autocast(cfg.MODEL.DEVICE, inference_dtype), profiler.evaluating(dataset_name):
                 results_i = inference_on_dataset(model, data_loader, evaluator)
             results[dataset_name] = results_i
             if comm.is_main_process():
@@ -340,6 +357,14 @@ class Trainer(DefaultTrainer):
                 ), "Evaluator must return a dict on the main process. Got {} instead.".format(
                     results_i
                 )
+                if profiler.enabled:
+                    # the stats of the main process only
+                    results_i["hot_path"] = profiler.flat_summary(dataset_name)
+                    profile_file = os.path.join(cfg.OUTPUT_DIR, "inference", f"hot_path_profile_{dataset_name}.json")
+                    PathManager.mkdirs(os.path.dirname(profile_file))
+                    with PathManager.open(profile_file, "w") as f:
+                        json.dump(profiler.summary(dataset_name), f)
+                    logger.info("Hot path profile of {} is saved to {}".format(dataset_name, profile_file))
                 logger.info("Evaluation results for {} in csv format:".format(dataset_name))
                 print_csv_format(results_i)
 
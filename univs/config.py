@@ -4,6 +4,8 @@ from detectron2.config import CfgNode as CN
 def add_univs_config(cfg):
     cfg.DATASETS.DATASET_RATIO = []
     cfg.DATASETS.DATALOADER_TYPE = 'iter'
+    # one pool of dataloader workers for all training datasets, instead of one dataloader per dataset
+    cfg.DATASETS.DATALOADER_SHARED_WORKERS = False
 
     # DataLoader
     cfg.INPUT.FORMAT = "RGB"
@@ -16,6 +18,12 @@ def add_univs_config(cfg):
     cfg.INPUT.SAMPLING_INTERVAL = 1
     cfg.INPUT.SAMPLING_FRAME_SHUFFLE = False
     cfg.INPUT.AUGMENTATIONS = []  # "brightness", "contrast", "saturation", "rotation"
+    # sample clip-consistent transforms in the dataloader, and apply them to the frames and
+    # masks on GPU in the model, so that workers only decode images and annotations
+    cfg.INPUT.GPU_AUGMENTATION = False
+    # pack the binary masks of instances into bits in the dataloader, and unpack them on GPU,
+    # which reduces the memory of masks passed from workers and transferred to GPU by 8x
+    cfg.INPUT.PACKED_MASKS = False
 
     cfg.INPUT.MIN_SIZE_TRAIN = (512, 544, 576, 608, 640, 672, 704, 736, 768, 800)
     cfg.INPUT.MIN_SIZE_TRAIN_SAMPLING = "choice"
@@ -35,6 +43,10 @@ def add_univs_config(cfg):
     cfg.INPUT.PSEUDO.CROP.ENABLED = True
     cfg.INPUT.PSEUDO.CROP.TYPE = "absolute_range"
     cfg.INPUT.PSEUDO.CROP.SIZE = (480, 1024)
+    # decode image and annotations once per sample, and derive pseudo frames from them
+    cfg.INPUT.PSEUDO.DECODE_ONCE = False
+    # maximum longer edge of the image and masks before augmentations in DECODE_ONCE mode, 0 to disable
+    cfg.INPUT.PSEUDO.WORKING_MAX_SIZE = 1024
 
     # LSJ
     cfg.INPUT.LSJ_AUG = CN()
@@ -87,6 +99,8 @@ def add_univs_config(cfg):
 
     # Mask2Former
     cfg.MODEL.MASK_FORMER.REID_WEIGHT = 0.25
+    # sample the points of gt masks once per iteration, shared by the mask losses of all decoder layers
+    cfg.MODEL.MASK_FORMER.SHARED_POINT_SAMPLING = False
     cfg.MODEL.MASK_FORMER.TEST.STABILITY_SCORE_THRESH = 0.0 # from SAM
     cfg.MODEL.MASK_FORMER.TEST.OVERLAP_THRESHOLD_ENTITY = 0.5
 
@@ -94,6 +108,7 @@ def add_univs_config(cfg):
     cfg.MODEL.BoxVIS = CN()
     cfg.MODEL.BoxVIS.BoxVIS_ENABLED = False
     cfg.MODEL.BoxVIS.EMA_ENABLED = False
+    cfg.MODEL.BoxVIS.EMA_UPDATE_PERIOD = 1  # update the teacher net every N iterations
     cfg.MODEL.BoxVIS.PSEUDO_MASK_SCORE_THRESH = 0.5
 
     # Inference
@@ -146,6 +161,25 @@ def add_univs_config(cfg):
     cfg.MODEL.UniVS.TEST.NUM_PREV_FRAMES_MEMORY = 5 
     cfg.MODEL.UniVS.TEST.ENABLED_PREV_FRAMES_MEMORY = True # False for stage2 but Ture for stage3
     cfg.MODEL.UniVS.TEST.ENABLED_PREV_VISUAL_PROMPTS_FOR_GROUNDING = False
+    # only compute the class logits of the categories in the test dataset, the others are filled with -inf
+    cfg.MODEL.UniVS.TEST.ACTIVE_CLASSES_ONLY = False
+    # "fp32", "fp16" or "bf16": the precision of the backbone and the decoders at inference,
+    # "fp32" disables autocast, and deformable attention and matching always run in fp32
+    cfg.MODEL.UniVS.TEST.PRECISION = "fp32"
+    # the number of threads to save per-frame masks (.png) in the background, 0 to save them synchronously
+    cfg.MODEL.UniVS.TEST.NUM_WRITER_WORKERS = 4
+    # opt-in timing regions and counters on the hot paths of inference (univs/utils/profiling.py),
+    # aggregated per video and per dataset into the evaluation results. ACCURATE synchronizes the device
+    # at both ends of each region, which gives the real GPU time of each region but slows down inference
+    cfg.MODEL.UniVS.TEST.PROFILING = CN()
+    cfg.MODEL.UniVS.TEST.PROFILING.ENABLE = False
+    cfg.MODEL.UniVS.TEST.PROFILING.ACCURATE = False
+    # serving mode (UniVS_Prompt.forward_inference_videos): the clips of several videos are packed into
+    # one backbone forward pass with at most MAX_BATCH_FRAMES frames, a clip waits for the clips of
+    # other videos at most MAX_WAIT_MS milliseconds
+    cfg.MODEL.UniVS.TEST.SERVING = CN()
+    cfg.MODEL.UniVS.TEST.SERVING.MAX_BATCH_FRAMES = 32
+    cfg.MODEL.UniVS.TEST.SERVING.MAX_WAIT_MS = 20
 
     # test for custom videos with .mp4 videos or a dir that includes all frames
     cfg.MODEL.UniVS.TEST.CUSTOM_VIDEOS_ENABLE = False
@@ -157,4 +191,12 @@ def add_univs_config(cfg):
     cfg.MODEL.UniVS.TEST.SEMANTIC_EXTRACTION.ENABLE = False
     cfg.MODEL.UniVS.TEST.SEMANTIC_EXTRACTION.COMPRESSION_RATIO = 32  
     cfg.MODEL.UniVS.TEST.SEMANTIC_EXTRACTION.COMPRESSION_RATIO_TEMPORAL = 1
-    cfg.MODEL.UniVS.TEST.SEMANTIC_EXTRACTION.OUTPUT_DIR = ''
\ No newline at end of file
+    cfg.MODEL.UniVS.TEST.SEMANTIC_EXTRACTION.OUTPUT_DIR = ''
+    # "shard": append all videos into chunked shards, see univs/data/semantic_feature_store.py
+    # "pt": save two float32 .pt files per video
+    cfg.MODEL.UniVS.TEST.SEMANTIC_EXTRACTION.OUTPUT_FORMAT = "shard"
+    # storage dtype of the shards: "float32", "float16", "bfloat16" or "int8" (with per-channel scales)
+    cfg.MODEL.UniVS.TEST.SEMANTIC_EXTRACTION.STORAGE_DTYPE = "float16"
+    # "" or "zlib", compressed chunks can not be memory-mapped
+    cfg.MODEL.UniVS.TEST.SEMANTIC_EXTRACTION.COMPRESSION = ""
+    cfg.MODEL.UniVS.TEST.SEMANTIC_EXTRACTION.SHARD_MAX_SIZE_MB = 4096
\ No newline at end of file
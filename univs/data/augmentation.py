@@ -2,6 +2,8 @@ import copy
 import numpy as np
 import logging
 import sys
+import torch
+import torch.nn.functional as F
 
 from PIL import Image
 from typing import Tuple
@@ -17,6 +19,9 @@ from fvcore.transforms.transform import (
 )
 
 from detectron2.data import transforms as T
+from detectron2.structures import BitMasks, Boxes, Instances
+
+from .detection_utils import PackedBitMasks
 
 
 class RandomApplyClip(T.Augmentation):
@@ -437,6 +442,280 @@ class RandomFlipClip(T.Augmentation):
             return NoOpTransform()
 
 
+def _pil_nearest_indices(in_size, out_size, device=None):
+    # PIL NEAREST samples the source pixel that contains the center of the output pixel
+    scale = in_size / out_size
+    idx = torch.floor((torch.arange(out_size, dtype=torch.float64, device=device) + 0.5) * scale).long()
+    return idx.clamp(max=in_size - 1)
+
+
+def _rotation_grid(t, device):
+    # cv2.warpAffine samples dst(x, y) = src(M^-1 (x, y)) in pixel coordinates
+    rm = torch.eye(3, dtype=torch.float64)
+    rm[:2] = torch.as_tensor(t.rm_image, dtype=torch.float64)
+    rm_inv = torch.linalg.inv(rm)[:2].to(device)
+    ys, xs = torch.meshgrid(
+        torch.arange(t.bound_h, dtype=torch.float64, device=device),
+        torch.arange(t.bound_w, dtype=torch.float64, device=device),
+        indexing="ij",
+    )
+    coords = torch.stack([xs, ys, torch.ones_like(xs)], dim=-1) @ rm_inv.t()  # bound_h, bound_w, 2
+    # normalize to [-1, 1] with align_corners=True, i.e. -1 and 1 are the centers of the corner pixels
+    scale = torch.tensor([max(t.w - 1, 1), max(t.h - 1, 1)], dtype=torch.float64, device=device)
+    return (2 * coords / scale - 1)[None].float()
+
+
+def _rotate_tensor(x, t, mode="bilinear"):
+    """
+    Apply a RotationTransform to a tensor with shape (N, H, W) with grid_sample,
+    the out-of-image regions are filled with 0 as cv2.warpAffine does.
+    """
+    if x.shape[-2:].numel() == 0 or t.angle % 360 == 0:
+        return x
+    if len(x) == 0:
+        return x.new_zeros((0, int(t.bound_h), int(t.bound_w)))
+    grid = _rotation_grid(t, x.device)
+    dtype = x.dtype
+    out = F.grid_sample(x[None].float(), grid, mode=mode, padding_mode="zeros", align_corners=True)[0]
+    if dtype == torch.uint8:
+        out = out.round().clamp(0, 255)
+    return out.to(dtype)
+
+
+def _gather_bitmasks(masks, idx_y, idx_x):
+    out = masks[:, idx_y.clamp(min=0)[:, None], idx_x.clamp(min=0)[None, :]]
+    out[:, idx_y < 0] = 0
+    out[:, :, idx_x < 0] = 0
+    return out
+
+
+def apply_transforms_to_bitmasks(masks, transforms):
+    """
+    Apply the transforms of one frame to a stack of binary masks in a single pass.
+    Flip, crop, pad and resize are separable, so they are composed into per-axis
+    index maps and applied with one gather, without materializing intermediate
+    (e.g. 4x up-scaled) masks. Other transforms (e.g. rotation) fall back to
+    `apply_segmentation` on the materialized masks.
+
+    Args:
+        masks (Tensor): uint8 masks with shape (N, H, W)
+        transforms (TransformList or list[Transform]): transforms returned by the augmentations
+
+    Returns:
+        Tensor: uint8 masks with shape (N, H', W'), same as applying
+            `transforms.apply_segmentation` on each mask
+    """
+    if isinstance(transforms, TransformList):
+        transforms = transforms.transforms
+
+    device = masks.device
+    idx_y = torch.arange(masks.shape[-2], device=device)
+    idx_x = torch.arange(masks.shape[-1], device=device)
+    for t in transforms:
+        if isinstance(t, TransformList):
+            masks = apply_transforms_to_bitmasks(_gather_bitmasks(masks, idx_y, idx_x), t)
+            idx_y = torch.arange(masks.shape[-2], device=device)
+            idx_x = torch.arange(masks.shape[-1], device=device)
+        elif isinstance(t, (NoOpTransform, BlendTransform, T.ColorTransform)):
+            # photometric transforms do not change masks
+            continue
+        elif isinstance(t, HFlipTransform):
+            idx_x = idx_x.flip(0)
+        elif isinstance(t, VFlipTransform):
+            idx_y = idx_y.flip(0)
+        elif isinstance(t, CropTransform):
+            idx_y = idx_y[int(t.y0): int(t.y0 + t.h)]
+            idx_x = idx_x[int(t.x0): int(t.x0 + t.w)]
+        elif isinstance(t, PadTransform) and t.seg_pad_value == 0:
+            idx_y = torch.cat([idx_y.new_full((int(t.y0),), -1), idx_y, idx_y.new_full((int(t.y1),), -1)])
+            idx_x = torch.cat([idx_x.new_full((int(t.x0),), -1), idx_x, idx_x.new_full((int(t.x1),), -1)])
+        elif isinstance(t, T.ResizeTransform):
+            idx_y = idx_y[_pil_nearest_indices(len(idx_y), int(t.new_h), device)]
+            idx_x = idx_x[_pil_nearest_indices(len(idx_x), int(t.new_w), device)]
+        elif isinstance(t, T.RotationTransform) and device.type != "cpu":
+            masks = _rotate_tensor(_gather_bitmasks(masks, idx_y, idx_x), t, mode="nearest")
+            idx_y = torch.arange(masks.shape[-2], device=device)
+            idx_x = torch.arange(masks.shape[-1], device=device)
+        else:
+            num_masks = len(masks)
+            masks = _gather_bitmasks(masks, idx_y, idx_x).numpy()
+            if num_masks == 0:
+                # a dummy mask to get the output size
+                masks = np.zeros((1, *masks.shape[1:]), dtype=np.uint8)
+            # cv2 based transforms support at most 4 channels
+            masks = [
+                t.apply_segmentation(np.ascontiguousarray(masks[i:i+4].transpose(1, 2, 0)))
+                for i in range(0, len(masks), 4)
+            ]
+            masks = torch.cat([
+                torch.from_numpy(np.ascontiguousarray(m.reshape(*m.shape[:2], -1).transpose(2, 0, 1)))
+                for m in masks
+            ])[:num_masks]
+            idx_y, idx_x = torch.arange(masks.shape[-2]), torch.arange(masks.shape[-1])
+
+    return _gather_bitmasks(masks, idx_y, idx_x)
+
+
+def _transform_output_shape(t, shape):
+    h, w = shape
+    if isinstance(t, TransformList):
+        for _t in t.transforms:
+            h, w = _transform_output_shape(_t, (h, w))
+        return h, w
+    if isinstance(t, (NoOpTransform, BlendTransform, T.ColorTransform, HFlipTransform, VFlipTransform)):
+        return h, w
+    if isinstance(t, T.ResizeTransform):
+        return int(t.new_h), int(t.new_w)
+    if isinstance(t, CropTransform):
+        return len(range(h)[int(t.y0): int(t.y0 + t.h)]), len(range(w)[int(t.x0): int(t.x0 + t.w)])
+    if isinstance(t, PadTransform):
+        return h + int(t.y0) + int(t.y1), w + int(t.x0) + int(t.x1)
+    if isinstance(t, T.RotationTransform):
+        return int(t.bound_h), int(t.bound_w)
+    return t.apply_image(np.zeros((h, w, 3), dtype=np.uint8)).shape[:2]
+
+
+class _ShapeAugInput(T.AugInput):
+    """
+    An AugInput that only tracks the image shape: the image is a zero-strided
+    view, and transforms update its shape instead of being applied to pixels.
+    """
+
+    def __init__(self, image_shape):
+        super().__init__(self._proxy(image_shape))
+
+    @staticmethod
+    def _proxy(image_shape):
+        return np.broadcast_to(np.zeros((1, 1, 3), dtype=np.uint8), (*image_shape, 3))
+
+    def transform(self, tfm):
+        self.image = self._proxy(_transform_output_shape(tfm, self.image.shape[:2]))
+
+
+def sample_transforms(augmentations, image_shape):
+    """
+    Sample the transforms of the augmentations for an image of `image_shape`
+    without applying them, so that they can be applied later on GPU by
+    :func:`apply_clip_transforms_on_device`. The clip-level states of the
+    augmentations (e.g. `_cnt % clip_frame_cnt`) are updated as usual.
+
+    NOTE: augmentations whose transforms depend on pixel values (e.g. contrast
+    and saturation) are not supported.
+
+    Args:
+        augmentations (AugmentationList):
+        image_shape (tuple): height, width
+
+    Returns:
+        TransformList
+    """
+    return augmentations(_ShapeAugInput(image_shape))
+
+
+def apply_transforms_to_image_tensor(image, transforms):
+    """
+    Apply the transforms of one frame to an image tensor with torch ops,
+    so that it can run on GPU after the frame has been transferred.
+
+    Args:
+        image (Tensor): image with shape (C, H, W)
+        transforms (TransformList or list[Transform]):
+
+    Returns:
+        Tensor: float image with shape (C, H', W') in [0, 255]
+    """
+    if isinstance(transforms, TransformList):
+        transforms = transforms.transforms
+
+    image = image.float()
+    for t in transforms:
+        if isinstance(t, TransformList):
+            image = apply_transforms_to_image_tensor(image, t)
+        elif isinstance(t, NoOpTransform):
+            continue
+        elif isinstance(t, HFlipTransform):
+            image = image.flip(-1)
+        elif isinstance(t, VFlipTransform):
+            image = image.flip(-2)
+        elif isinstance(t, CropTransform):
+            image = image[:, int(t.y0): int(t.y0 + t.h), int(t.x0): int(t.x0 + t.w)]
+        elif isinstance(t, PadTransform):
+            image = F.pad(image, (int(t.x0), int(t.x1), int(t.y0), int(t.y1)), value=float(t.pad_value))
+        elif isinstance(t, T.ResizeTransform):
+            new_size = (int(t.new_h), int(t.new_w))
+            if t.interp == Image.NEAREST:
+                image = F.interpolate(image[None], size=new_size, mode="nearest")[0]
+            else:
+                # antialias follows PIL, which filters the image when down-scaling
+                image = F.interpolate(
+                    image[None], size=new_size, mode="bilinear", align_corners=False, antialias=True
+                )[0].clamp(0, 255)
+        elif isinstance(t, T.RotationTransform):
+            image = _rotate_tensor(image, t, mode="bilinear")
+        elif isinstance(t, BlendTransform) and np.isscalar(t.src_image):
+            image = (t.src_weight * t.src_image + t.dst_weight * image).clamp(0, 255)
+        else:
+            raise NotImplementedError(f"{type(t).__name__} is not supported in GPU augmentation.")
+
+    return image
+
+
+def apply_clip_transforms_on_device(batched_inputs, device):
+    """
+    Apply the transforms sampled by the dataset mapper (see :func:`sample_transforms`)
+    to the frames and per-frame instances of each video after transferring them to
+    `device`. Videos without the "transforms" field have been augmented in the
+    dataloader and are left untouched. The outputs are the same fields as the
+    dataset mapper produces on CPU: "image", "image_padding_mask" and "instances".
+    """
+    for video in batched_inputs:
+        if "transforms" not in video:
+            continue
+
+        transforms_per_frame = video.pop("transforms")
+        images, image_padding_masks = [], []
+        for f_i, (image, transforms) in enumerate(zip(video["image"], transforms_per_frame)):
+            image = image.to(device, non_blocking=True)
+            valid = torch.ones((1, *image.shape[-2:]), dtype=torch.uint8, device=device)
+            images.append(apply_transforms_to_image_tensor(image, transforms))
+            image_padding_masks.append(1 - apply_transforms_to_bitmasks(valid, transforms)[0])
+
+            if f_i >= len(video.get("instances", [])):
+                continue
+            instances = video["instances"][f_i]
+            image_size = tuple(images[-1].shape[-2:])
+            new_instances = Instances(image_size)
+            for k, v in instances.get_fields().items():
+                if k not in {"gt_masks", "gt_boxes"}:
+                    new_instances.set(k, v)
+
+            if instances.has("gt_masks"):
+                masks = instances.gt_masks
+                if isinstance(masks, PackedBitMasks):
+                    masks = masks.to(device, non_blocking=True).unpack()
+                masks = masks.tensor if isinstance(masks, BitMasks) else masks
+                masks = apply_transforms_to_bitmasks(masks.to(device, dtype=torch.uint8), transforms)
+                new_instances.gt_masks = BitMasks(masks)
+                new_instances.gt_boxes = new_instances.gt_masks.get_bounding_boxes()
+                keep = new_instances.gt_boxes.nonempty() & new_instances.gt_masks.nonempty()
+            else:
+                boxes = transforms.apply_box(instances.gt_boxes.tensor.numpy())
+                new_instances.gt_boxes = Boxes(torch.as_tensor(boxes, dtype=torch.float32, device=device))
+                new_instances.gt_boxes.clip(image_size)
+                keep = new_instances.gt_boxes.nonempty()
+
+            # the instances cropped out of the frame are marked with -1, as the dataset mapper does
+            gt_ids = new_instances.gt_ids.clone()
+            gt_ids[~keep.cpu()] = -1
+            new_instances.gt_ids = gt_ids
+            video["instances"][f_i] = new_instances
+
+        video["image"] = images
+        video["image_padding_mask"] = image_padding_masks
+
+    return batched_inputs
+
+
 def build_augmentation(cfg, is_train):
     logger = logging.getLogger(__name__)
     aug_list = []
@@ -1,5 +1,6 @@
 import itertools
 import logging
+import operator
 import torch.utils.data
 from typing import Collection, Sequence
 
@@ -8,6 +9,7 @@ from detectron2.data.build import (
     build_batch_data_loader,
     load_proposals_into_dataset,
     trivial_batch_collator,
+    worker_init_reset_seed,
 )
 from detectron2.data.catalog import DatasetCatalog
 from detectron2.data.common import DatasetFromList, MapDataset
@@ -15,7 +17,15 @@ from detectron2.data.dataset_mapper import DatasetMapper
 from detectron2.data.samplers import InferenceSampler, TrainingSampler
 from detectron2.utils.comm import get_world_size
 
-from .combined_loader import CombinedDataLoader_Epoch, CombinedDataLoader_Iter, CombinedDataLoader_Mix, Loader
+from .combined_loader import (
+    CombinedDataLoader_Epoch,
+    CombinedDataLoader_Iter,
+    CombinedDataLoader_Mix,
+    CombinedDataLoader_Shared,
+    CombinedMapDataset,
+    CombinedTrainingSampler,
+    Loader,
+)
 
 
 def _compute_num_images_per_worker(cfg: CfgNode):
@@ -122,6 +132,63 @@ def build_combined_loader(cfg: CfgNode, loaders: Collection[Loader], ratios: Seq
         return CombinedDataLoader_Mix(loaders, images_per_worker, ratios)
 
 
+def build_combined_train_loader(cfg: CfgNode, mappers: Sequence, dataset_names: Sequence[str], ratios: Sequence[float]):
+    """
+    Build a single dataloader for multiple datasets, where one sampler draws (dataset_idx, sample_idx)
+    pairs by `ratios` and one pool of `DATALOADER.NUM_WORKERS` workers maps them with the mapper of
+    each dataset. Unlike `build_combined_loader`, the number of workers and prefetch buffers does not
+    grow with the number of datasets.
+
+    Args:
+        mappers: a mapper for each dataset
+        dataset_names: names of the training datasets
+        ratios: sampling ratio of each dataset
+
+    Returns:
+        an infinite iterable of ``list[mapped_element]`` of length ``total_batch_size / num_workers``
+    """
+    assert len(mappers) == len(dataset_names)
+    datasets = [
+        MapDataset(
+            DatasetFromList(
+                get_detection_dataset_dicts(
+                    dataset_name,
+                    filter_empty=cfg.DATALOADER.FILTER_EMPTY_ANNOTATIONS,
+                    proposal_files=None,
+                ),
+                copy=False,
+            ),
+            mapper,
+        )
+        for mapper, dataset_name in zip(mappers, dataset_names)
+    ]
+
+    images_per_worker = _compute_num_images_per_worker(cfg)
+    sampler = CombinedTrainingSampler(
+        [len(d) for d in datasets], ratios, images_per_worker, cfg.DATASETS.DATALOADER_TYPE
+    )
+    logger = logging.getLogger(__name__)
+    logger.info(
+        "Using a shared pool of {} workers for {} training datasets".format(
+            cfg.DATALOADER.NUM_WORKERS, len(datasets)
+        )
+    )
+    data_loader = torch.utils.data.DataLoader(
+        CombinedMapDataset(datasets),
+        sampler=sampler,
+        batch_size=1,
+        num_workers=cfg.DATALOADER.NUM_WORKERS,
+        collate_fn=operator.itemgetter(0),  # don't batch, but yield individual elements
+        worker_init_fn=worker_init_reset_seed,
+    )
+    return CombinedDataLoader_Shared(
+        data_loader,
+        images_per_worker,
+        group_by_dataset=cfg.DATASETS.DATALOADER_TYPE != "mix",
+        aspect_ratio_grouping=cfg.DATALOADER.ASPECT_RATIO_GROUPING,
+    )
+
+
 def _train_loader_from_config(cfg, mapper, dataset_name=None, *, dataset=None, sampler=None):
     if dataset is None:
         dataset = get_detection_dataset_dicts(
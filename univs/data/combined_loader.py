@@ -3,6 +3,9 @@ import random
 from collections import deque
 from typing import Any, Collection, Deque, Iterable, Iterator, List, Sequence
 
+import torch.utils.data as data
+from detectron2.data.samplers import TrainingSampler
+
 Loader = Iterable[Any]
 
 
@@ -104,3 +107,85 @@ class CombinedDataLoader_Mix:
                 break
             indices = indices[self.batch_size:]
             yield batch
+
+
+class CombinedMapDataset(data.Dataset):
+    """
+    Map-style dataset over multiple datasets, which is indexed by (dataset_idx, sample_idx) pairs,
+    so that a single pool of dataloader workers can serve all datasets with their own mappers.
+    """
+
+    def __init__(self, datasets: Sequence[data.Dataset]):
+        """
+        Args:
+            datasets: map-style datasets, e.g. `MapDataset` with the mapper of each dataset
+        """
+        self.datasets = datasets
+
+    def __len__(self):
+        return sum(len(d) for d in self.datasets)
+
+    def __getitem__(self, idx):
+        dataset_idx, sample_idx = idx
+        return dataset_idx, self.datasets[dataset_idx][sample_idx]
+
+
+class CombinedTrainingSampler(data.Sampler):
+    """
+    Infinite sampler that draws (dataset_idx, sample_idx) pairs by the provided sampling ratios.
+    Sample indices of each dataset are shuffled and sharded across ranks as :class:`TrainingSampler`.
+    The dataset is drawn once per batch for 'iter', once per `BATCH_COUNT` batches for 'epoch',
+    and once per sample for 'mix', which is the same as CombinedDataLoader_Iter/Epoch/Mix.
+    """
+
+    BATCH_COUNT = 1000
+
+    def __init__(self, sizes: Sequence[int], ratios: Sequence[float], batch_size: int, dataloader_type: str = "iter"):
+        assert dataloader_type in {"iter", "epoch", "mix"}, dataloader_type
+        assert len(ratios) == 0 or len(ratios) == len(sizes), \
+            "DATASETS.DATASET_RATIO should have the same length as DATASETS.TRAIN"
+        self.samplers = [TrainingSampler(size) for size in sizes]
+        self.ratios = ratios if len(ratios) else [1.] * len(sizes)
+        self.batch_size = batch_size
+        self.dataloader_type = dataloader_type
+
+    def __iter__(self) -> Iterator[Any]:
+        iters = [iter(sampler) for sampler in self.samplers]
+        dataset_range = range(len(iters))
+        # infinite iterator, as in D2
+        while True:
+            if self.dataloader_type == "mix":
+                dataset_indices = random.choices(dataset_range, self.ratios, k=self.batch_size)
+            elif self.dataloader_type == "epoch":
+                dataset_indices = random.choices(dataset_range, self.ratios, k=1) * (self.batch_size * self.BATCH_COUNT)
+            else:
+                dataset_indices = random.choices(dataset_range, self.ratios, k=1) * self.batch_size
+            for i in dataset_indices:
+                yield i, next(iters[i])
+
+
+class CombinedDataLoader_Shared:
+    """
+    Groups the (dataset_idx, mapped_data) outputs of a single dataloader, which shares its workers
+    among all datasets, into batches. Imgs per batch come from the same dataset unless `group_by_dataset`
+    is False, and optionally from the same aspect ratio group as :class:`AspectRatioGroupedDataset`.
+    """
+
+    def __init__(self, loader: Loader, batch_size: int, group_by_dataset: bool = True, aspect_ratio_grouping: bool = False):
+        self.loader = loader
+        self.batch_size = batch_size
+        self.group_by_dataset = group_by_dataset
+        self.aspect_ratio_grouping = aspect_ratio_grouping
+
+    def __iter__(self) -> Iterator[List[Any]]:
+        buckets = {}
+        for dataset_idx, d in self.loader:
+            key = (
+                dataset_idx if self.group_by_dataset else -1,
+                int(d["width"] > d["height"]) if self.aspect_ratio_grouping else -1,
+            )
+            bucket = buckets.setdefault(key, [])
+            bucket.append(d)
+            if len(bucket) == self.batch_size:
+                yield bucket[:]
+                del bucket[:]
@@ -20,6 +20,7 @@ from detectron2.structures import (
     Boxes,
     BoxMode,
     Instances,
+    polygons_to_bitmask,
 )
 
 from detectron2.data import transforms as T
@@ -29,7 +30,8 @@ from pycocotools import mask as coco_mask
 
 from univs.data import detection_utils as utils
 from fvcore.transforms.transform import HFlipTransform
-from .augmentation import build_augmentation, build_pseudo_augmentation
+from .augmentation import build_augmentation, build_pseudo_augmentation, apply_transforms_to_bitmasks
+from .datasets.sa_1b import SA1BCompactIndex, filter_sa_1b_annotations
 
 import re
 
@@ -142,6 +144,58 @@ def convert_coco_poly_to_mask(segmentations, height, width):
     return masks
 
 
+def rasterize_annotations(annos, image_size, output_size, rle_chunk_size=32):
+    """
+    Rasterize the segmentation (polygons or RLE) of all annotations into bitmasks once,
+    directly at the (reduced) output size.
+
+    Args:
+        annos (list[dict]): instance annotations of one image
+        image_size (tuple): height, width of the original image
+        output_size (tuple): height, width of the output bitmasks
+        rle_chunk_size (int): number of RLEs decoded at the original size together
+
+    Returns:
+        Tensor: uint8 masks with shape (N, output_h, output_w)
+    """
+    ori_h, ori_w = image_size
+    h, w = output_size
+    masks = torch.zeros((len(annos), h, w), dtype=torch.uint8)
+
+    rle_idxs, rles = [], []
+    for i, anno in enumerate(annos):
+        segm = anno.get("segmentation", [])
+        if isinstance(segm, list):
+            # polygons are scaled before rasterizing
+            polygons = [
+                (np.asarray(p, dtype=np.float64).reshape(-1, 2) * [w / ori_w, h / ori_h]).reshape(-1)
+                for p in segm if len(p) >= 6
+            ]
+            if len(polygons):
+                masks[i] = torch.from_numpy(polygons_to_bitmask(polygons, h, w))
+        elif isinstance(segm, dict):
+            if isinstance(segm["counts"], list):
+                # uncompressed RLE
+                segm = coco_mask.frPyObjects(segm, *segm["size"])
+            rle_idxs.append(i)
+            rles.append(segm)
+        else:
+            raise ValueError(
+                "Cannot rasterize segmentation of type '{}'!"
+                "Supported types are: polygons as list[list[float] or ndarray],"
+                " COCO-style RLE as a dict.".format(type(segm))
+            )
+
+    # decode RLEs in chunks to bound the memory of masks at the original size
+    resize = [] if (h, w) == (ori_h, ori_w) else [T.ResizeTransform(ori_h, ori_w, h, w)]
+    for start in range(0, len(rles), rle_chunk_size):
+        decoded = coco_mask.decode(rles[start:start+rle_chunk_size])  # H x W x n
+        decoded = torch.from_numpy(decoded).permute(2, 0, 1)
+        masks[rle_idxs[start:start+rle_chunk_size]] = apply_transforms_to_bitmasks(decoded, resize)
+
+    return masks
+
+
 class YTVISDatasetMapper:
     """
     Similar to YTVISDatasetMapper, only add text expressions
@@ -360,6 +414,9 @@ class CocoClipDatasetMapper:
         dataset_name: str = 'coco_2017_train',
         num_pos_queries: int = 20,
         eval_load_annotations: bool = False,
+        decode_once: bool = False,
+        working_max_size: int = 1024,
+        packed_masks: bool = False,
     ):
         """
         NOTE: this interface is experimental.
@@ -367,6 +424,12 @@ class CocoClipDatasetMapper:
             is_train: whether it's used in training or inference
             augmentations: a list of augmentations or deterministic transforms to apply
             image_format: an image format supported by :func:`detection_utils.read_image`.
+            decode_once: whether to decode the image and annotations only once per sample during training,
+                and derive pseudo frames from them, see `generate_pseudo_frames_decode_once`
+            working_max_size: the maximum size of the longer edge of the image and masks in decode_once mode,
+                larger images are downscaled once before augmentations, 0 to keep the original size
+            packed_masks: whether to pack the binary masks of instances into bits during training,
+                see :class:`detection_utils.PackedBitMasks`
         """
         # fmt: off
         self.is_train               = is_train
@@ -376,6 +439,10 @@ class CocoClipDatasetMapper:
         self.sampling_frame_range   = sampling_frame_range
         self.dataset_name = dataset_name
         self.num_pos_queries = num_pos_queries
+        self.decode_once            = decode_once
+        self.working_max_size       = working_max_size
+        self.packed_masks           = packed_masks
+        self._sa_1b_compact_indexes = {}
 
         # fmt: on
         logger = logging.getLogger(__name__)
@@ -401,6 +468,9 @@ class CocoClipDatasetMapper:
             "sampling_frame_range": sampling_frame_range,
             "dataset_name": dataset_name,
             "num_pos_queries": cfg.MODEL.UniVS.NUM_POS_QUERIES,
+            "decode_once": cfg.INPUT.PSEUDO.DECODE_ONCE,
+            "working_max_size": cfg.INPUT.PSEUDO.WORKING_MAX_SIZE,
+            "packed_masks": cfg.INPUT.PACKED_MASKS,
         }
 
         return ret
@@ -414,7 +484,26 @@ class CocoClipDatasetMapper:
             dict: a format that builtin models in detectron2 accept
         """
         is_sa1b = False
-        if isinstance(dataset_dict, str):
+        if isinstance(dataset_dict, dict) and "sa_1b_compact_index" in dataset_dict:
+            is_sa1b = True
+            # for SA-1B with pre-filtered annotations, see `build_sa_1b_compact_index`
+            compact_prefix = dataset_dict["sa_1b_compact_index"]
+            if compact_prefix not in self._sa_1b_compact_indexes:
+                self._sa_1b_compact_indexes[compact_prefix] = SA1BCompactIndex(compact_prefix)
+            annotations = self._sa_1b_compact_indexes[compact_prefix][dataset_dict["sa_1b_index"]]
+            image_root = dataset_dict["image_root"]
+
+            dataset_dict = annotations["image"]
+            dataset_dict["file_name"] = os.path.join(image_root, dataset_dict["file_name"])
+            dataset_dict["annotations"] = annotations["annotations"]
+            for anno_dict in dataset_dict["annotations"]:
+                anno_dict["bbox_mode"] = BoxMode.XYWH_ABS
+
+            dataset_dict["dataset_name"] = "sa_1b"
+            dataset_dict["task"] = "sot"
+            dataset_dict["has_stuff"] = True
+
+        elif isinstance(dataset_dict, str):
             is_sa1b = True
             # for SA-1B, where dataset_dict is the name of annotation file
             image_root = 'datasets/sa_1b/images'
@@ -450,7 +539,8 @@ class CocoClipDatasetMapper:
 
             dataset_dict = annotations["image"]
             dataset_dict["file_name"] = os.path.join(image_root, dataset_dict["file_name"])
-            dataset_dict["annotations"] = annotations["annotations"]
+            # remove masks with low stability_score or predicted_iou
+            dataset_dict["annotations"] = filter_sa_1b_annotations(annotations["annotations"])
             for anno_dict in dataset_dict["annotations"]:
                 anno_dict["bbox_mode"] = BoxMode.XYWH_ABS
 
@@ -467,12 +557,9 @@ class CocoClipDatasetMapper:
                 else:
                     dataset_dict["dataset_name"] = "coco"
             dataset_dict["task"] = "detection"
-        dataset_dict = copy.deepcopy(dataset_dict)  # it will be modified by code below
+            dataset_dict = copy.deepcopy(dataset_dict)  # it will be modified by code below
 
         img_annos = dataset_dict.pop("annotations", None)
-        if is_sa1b and img_annos is not None and len(img_annos) > 100:
-            # remove masks with low stability_score or predicted_iou
-            img_annos= [anno for anno in img_annos if anno["stability_score"] > 0.97 and anno["predicted_iou"] > 0.9]
 
         file_name = dataset_dict.pop("file_name", None)
         original_image = utils.read_image(file_name, format=self.image_format)
@@ -505,75 +592,78 @@ class CocoClipDatasetMapper:
             # panoptic evaluator needs file_name
             dataset_dict["file_name"] = file_name
 
-        for i in range(self.sampling_frame_num):
-            utils.check_image_size(dataset_dict, original_image)
-            image_padding_mask = np.ones_like(original_image)
-
-            aug_input = T.AugInput(original_image)
-            transforms = self.augmentations(aug_input)
-            image = aug_input.image
-            image_shape = image.shape[:2]  # h, w
-
-            image_padding_mask = transforms.apply_segmentation(image_padding_mask)
-
-            # Pytorch's dataloader is efficient on torch.Tensor due to shared-memory,
-            # but not efficient on large generic data structures due to the use of pickle & mp.Queue.
-            # Therefore, it's important to use torch.Tensor.
-            dataset_dict["image"].append(torch.as_tensor(np.ascontiguousarray(image.transpose(2, 0, 1))))
-            dataset_dict["image_padding_mask"].append(torch.as_tensor(
-                np.ascontiguousarray(1 - image_padding_mask[:, :, 0])
-            ))
-
-            if (img_annos is None) or (not self.is_train):
-                continue
+        if self.decode_once and self.is_train:
+            self.generate_pseudo_frames_decode_once(dataset_dict, original_image, img_annos)
+        else:
+            for i in range(self.sampling_frame_num):
+                utils.check_image_size(dataset_dict, original_image)
+                image_padding_mask = np.ones_like(original_image)
+
+                aug_input = T.AugInput(original_image)
+                transforms = self.augmentations(aug_input)
+                image = aug_input.image
+                image_shape = image.shape[:2]  # h, w
+
+                image_padding_mask = transforms.apply_segmentation(image_padding_mask)
+
+                # Pytorch's dataloader is efficient on torch.Tensor due to shared-memory,
+                # but not efficient on large generic data structures due to the use of pickle & mp.Queue.
+                # Therefore, it's important to use torch.Tensor.
+                dataset_dict["image"].append(torch.as_tensor(np.ascontiguousarray(image.transpose(2, 0, 1))))
+                dataset_dict["image_padding_mask"].append(torch.as_tensor(
+                    np.ascontiguousarray(1 - image_padding_mask[:, :, 0])
+                ))
+
+                if (img_annos is None) or (not self.is_train):
+                    continue
                 
-            _img_annos = []
-            for obj_i, anno in enumerate(img_annos):
-                _anno = {}
-                for k, v in anno.items():
-                    _anno[k] = copy.deepcopy(v)
-                _img_annos.append(_anno)
+                _img_annos = []
+                for obj_i, anno in enumerate(img_annos):
+                    _anno = {}
+                    for k, v in anno.items():
+                        _anno[k] = copy.deepcopy(v)
+                    _img_annos.append(_anno)
+
+                # USER: Implement additional transformations if you have other types of data
+                annos = [
+                    utils.transform_instance_annotations(obj, transforms, image_shape)
+                    for obj in _img_annos
+                    if obj.get("iscrowd", 0) == 0
+                ]
+
+                _gt_ids = list(range(len(annos)))
+                for idx in range(len(annos)):
+                    if len(annos[idx]["segmentation"]) == 0:
+                        annos[idx]["segmentation"] = [np.array([0.0] * 6)]
+
+                mask_format = "bitmask" if is_sa1b else "polygon"
+                instances = utils.annotations_to_instances(annos, image_shape, mask_format)
+                instances.gt_ids = torch.tensor(_gt_ids)
+                if len(annos) == 0:
+                    dataset_dict["instances"].append(instances)
+                    continue
+
+                # After transforms such as cropping are applied, the bounding box may no longer
+                # tightly bound the object. As an example, imagine a triangle object
+                # [(0,0), (2,0), (0,2)] cropped by a box [(1,0),(2,2)] (XYXY format). The tight
+                # bounding box of the cropped triangle should be [(1,0),(2,1)], which is not equal to
+                # the intersection of original bounding box and the cropping box.
+                if hasattr(instances, 'gt_masks'):
+                    instances.gt_boxes = instances.gt_masks.get_bounding_boxes()  # NOTE we don't need boxes
+                instances = filter_empty_instances(instances)
 
-            # USER: Implement additional transformations if you have other types of data
-            annos = [
-                utils.transform_instance_annotations(obj, transforms, image_shape)
-                for obj in _img_annos
-                if obj.get("iscrowd", 0) == 0
-            ]
+                h, w = instances.image_size
+                if hasattr(instances, 'gt_masks'):
+                    if not is_sa1b:
+                        gt_masks = instances.gt_masks
+                        gt_masks = convert_coco_poly_to_mask(gt_masks.polygons, h, w)
+                        instances.gt_masks = gt_masks
 
-            _gt_ids = list(range(len(annos)))
-            for idx in range(len(annos)):
-                if len(annos[idx]["segmentation"]) == 0:
-                    annos[idx]["segmentation"] = [np.array([0.0] * 6)]
+                # no classes in sa1b data
+                if not instances.has("gt_classes"):
+                    instances.gt_classes = torch.ones_like(instances.gt_ids) * -1
 
-            mask_format = "bitmask" if is_sa1b else "polygon"
-            instances = utils.annotations_to_instances(annos, image_shape, mask_format)
-            instances.gt_ids = torch.tensor(_gt_ids)
-            if len(annos) == 0:
                 dataset_dict["instances"].append(instances)
-                continue
-
-            # After transforms such as cropping are applied, the bounding box may no longer
-            # tightly bound the object. As an example, imagine a triangle object
-            # [(0,0), (2,0), (0,2)] cropped by a box [(1,0),(2,2)] (XYXY format). The tight
-            # bounding box of the cropped triangle should be [(1,0),(2,1)], which is not equal to
-            # the intersection of original bounding box and the cropping box.
-            if hasattr(instances, 'gt_masks'):
-                instances.gt_boxes = instances.gt_masks.get_bounding_boxes()  # NOTE we don't need boxes
-            instances = filter_empty_instances(instances)
-
-            h, w = instances.image_size
-            if hasattr(instances, 'gt_masks'):
-                if not is_sa1b:
-                    gt_masks = instances.gt_masks
-                    gt_masks = convert_coco_poly_to_mask(gt_masks.polygons, h, w)
-                    instances.gt_masks = gt_masks
-
-            # no classes in sa1b data
-            if not instances.has("gt_classes"):
-                instances.gt_classes = torch.ones_like(instances.gt_ids) * -1
-
-            dataset_dict["instances"].append(instances)
 
         if self.is_train:
             # remove empty objects from Instance
@@ -592,11 +682,68 @@ class CocoClipDatasetMapper:
             dataset_dict["instances"] = [
                 targets_per_frame[valid_idxs] for targets_per_frame in dataset_dict["instances"]
             ]
+            if self.packed_masks:
+                utils.pack_instances_masks(dataset_dict["instances"])
 
         # display_pseudo_clip_from_coco(dataset_dict["image"], file_name)
         return dataset_dict
 
 
+    def generate_pseudo_frames_decode_once(self, dataset_dict, original_image, img_annos):
+        """
+        Generate pseudo frames from a single image, where the image and annotations are decoded only once:
+        annotations are filtered and rasterized into bitmasks at the reduced working resolution, and each
+        pseudo frame is derived from them by the clip-consistent augmentations, in which masks are
+        cropped, flipped and scaled by index views (see `apply_transforms_to_bitmasks`).
+        """
+        utils.check_image_size(dataset_dict, original_image)
+        ori_h, ori_w = original_image.shape[:2]
+        image = original_image
+        if self.working_max_size > 0 and max(ori_h, ori_w) > self.working_max_size:
+            scale = self.working_max_size / max(ori_h, ori_w)
+            h, w = int(ori_h * scale + 0.5), int(ori_w * scale + 0.5)
+            image = T.ResizeTransform(ori_h, ori_w, h, w).apply_image(original_image)
+        h, w = image.shape[:2]
+
+        if img_annos is not None:
+            img_annos = [obj for obj in img_annos if obj.get("iscrowd", 0) == 0]
+            masks = rasterize_annotations(img_annos, (ori_h, ori_w), (h, w))
+            gt_classes = None
+            if len(img_annos) and "category_id" in img_annos[0]:
+                gt_classes = torch.tensor([int(obj["category_id"]) for obj in img_annos], dtype=torch.int64)
+        else:
+            masks = torch.zeros((0, h, w), dtype=torch.uint8)
+        # the last mask is the valid region of the image, which is transformed into the padding mask
+        masks = torch.cat([masks, torch.ones((1, h, w), dtype=torch.uint8)])
+
+        for i in range(self.sampling_frame_num):
+            aug_input = T.AugInput(image)
+            transforms = self.augmentations(aug_input)
+            image_aug = aug_input.image
+            image_shape = image_aug.shape[:2]  # h, w
+
+            masks_aug = apply_transforms_to_bitmasks(masks, transforms)
+            dataset_dict["image"].append(torch.as_tensor(np.ascontiguousarray(image_aug.transpose(2, 0, 1))))
+            dataset_dict["image_padding_mask"].append(1 - masks_aug[-1])
+
+            if img_annos is None:
+                continue
+
+            instances = Instances(image_shape)
+            instances.gt_masks = BitMasks(masks_aug[:-1])
+            instances.gt_boxes = instances.gt_masks.get_bounding_boxes()
+            instances.gt_ids = torch.arange(len(img_annos))
+            if gt_classes is not None:
+                instances.gt_classes = gt_classes.clone()
+            instances = filter_empty_instances(instances)
+
+            # no classes in sa1b data
+            if not instances.has("gt_classes"):
+                instances.gt_classes = torch.ones_like(instances.gt_ids) * -1
+
+            dataset_dict["instances"].append(instances)
+
+
 def display_pseudo_clip_from_coco(images_list, file_name, output_path='output/pseudo_clip_from_coco/'):
     imgs = torch.stack(images_list)  # T, 3, H, W
     plt.imshow(rearrange(imgs.cpu().numpy(), 'T C H W -> H (T W) C'))
@@ -5,7 +5,6 @@ import numpy as np
 from typing import List, Union
 import torch
 import torch.nn.functional as F
-import torchvision
 
 import os
 from PIL import Image
@@ -25,7 +24,8 @@ from detectron2.data import transforms as T
 from detectron2.data import MetadataCatalog
 
 from fvcore.transforms.transform import HFlipTransform
-from .augmentation import build_augmentation
+from .augmentation import build_augmentation, sample_transforms
+from .video_reader import read_video_frames
 
 from univs.data import detection_utils as utils
 from univs.modeling.language import clean_string_exp
@@ -168,6 +168,8 @@ class UniVidDatasetMapper:
         test_categories=None,
         multidataset=False,
         prompt_type: str = "",
+        gpu_augmentation: bool = False,
+        packed_masks: bool = False,
     ):
         """
         NOTE: this interface is experimental.
@@ -176,6 +178,10 @@ class UniVidDatasetMapper:
             augmentations: a list of augmentations or deterministic transforms to apply
             image_format: an image format supported by :func:`detection_utils.read_image`.
             use_instance_mask: whether to process instance segmentation annotations, if available
+            gpu_augmentation: whether to only sample the transforms of augmentations here and
+                apply them to the frames and masks on GPU in the model
+            packed_masks: whether to pack the binary masks of instances into bits during training,
+                see :class:`detection_utils.PackedBitMasks`
         """
         # fmt: off
         self.is_train               = is_train
@@ -193,6 +199,8 @@ class UniVidDatasetMapper:
         self.num_classes            = num_classes
         self.dataset_name           = dataset_name
         self.prompt_type            = prompt_type
+        self.gpu_augmentation       = gpu_augmentation
+        self.packed_masks           = packed_masks
 
         # fmt: on
         logger = logging.getLogger(__name__)
@@ -211,6 +219,13 @@ class UniVidDatasetMapper:
         sampling_frame_range_sot = cfg.INPUT.SAMPLING_FRAME_RANGE_SOT
         sampling_interval = cfg.INPUT.SAMPLING_INTERVAL
 
+        gpu_augmentation = cfg.INPUT.GPU_AUGMENTATION and is_train
+        # build_augmentation reads INPUT.PSEUDO.AUGMENTATIONS with LSJ and INPUT.AUGMENTATIONS otherwise
+        augmentation_names = set(cfg.INPUT.AUGMENTATIONS) | set(cfg.INPUT.PSEUDO.AUGMENTATIONS)
+        if gpu_augmentation and {"contrast", "saturation"} & augmentation_names:
+            raise ValueError("Contrast and saturation augmentations depend on pixel values, "
+                             "which are not supported by INPUT.GPU_AUGMENTATION.")
+
         ret = {
             "is_train": is_train,
             "augmentations": augs,
@@ -228,6 +243,8 @@ class UniVidDatasetMapper:
             "test_categories": test_categories,
             "multidataset": cfg.DATALOADER.SAMPLER_TRAIN == "MultiDatasetSampler",
             "prompt_type": cfg.MODEL.UniVS.PROMPT_TYPE,
+            "gpu_augmentation": gpu_augmentation,
+            "packed_masks": cfg.INPUT.PACKED_MASKS,
         }
 
         return ret
@@ -321,6 +338,8 @@ class UniVidDatasetMapper:
         dataset_dict["image_padding_mask"] = []
         dataset_dict["instances"] = []
         dataset_dict["file_names"] = []
+        if self.gpu_augmentation:
+            dataset_dict["transforms"] = []
 
         task = dataset_dict["task"]
         selected_augmentations = self.augmentations
@@ -330,64 +349,47 @@ class UniVidDatasetMapper:
             if video_path.split('.')[-1] not in ("mp4", "avi", "mov", "mkv"):
                 dataset_dict["is_raw_video"] = False
             else:
+                # the frame names carry the frame indices in the video (relative to "start_sec"),
+                # e.g. 'xxx.mp4/000005.jpg', so that a frame stride can be set when converting videos
+                frame_idxs_ori = [int(file_names[i].split('/')[-1].split('.')[0]) for i in selected_idx]
                 try:
-                    start_sec = dataset_dict["start_sec"] if "start_sec" in dataset_dict else None
-                    end_sec = dataset_dict["end_sec"] if "end_sec" in dataset_dict else None
-                    # decord package can load videos with memory-efficient way
-                    if start_sec is not None and end_sec is not None:
-                        # # load videos with memory-efficient way
-                        # from decord import VideoReader, cpu, gpu
-                        # # Open the video file
-                        # vr = VideoReader(video_path, ctx=cpu(0))  # Use gpu(0) for GPU
-                        # # Get video framerate to calculate frame numbers
-                        # framerate = vr.get_avg_fps()
-                        # # Calculate frame indices
-                        # start_frame = int(start_sec * framerate)
-                        # end_frame = int(end_sec * framerate)
-                        # # Read frames from start to end
-                        # vframes = vr.get_batch(range(start_frame, end_frame)) 
-                        # vframes = vframes.permute(0,2,3,1)
-                        
-                        vframes, aframes, info = torchvision.io.read_video(
-                            filename=video_path, 
-                            start_pts=start_sec, end_pts=end_sec, pts_unit="sec", 
-                            output_format="TCHW"
-                        )
-                        if not self.is_train and len(vframes) < video_length:
-                            dataset_dict["video_len"] = len(vframes)
-                            selected_idx = selected_idx[:len(vframes)]
-                            selected_idx_map = selected_idx_map[:len(vframes)]
-                    else:
-                        vframes, aframes, info = torchvision.io.read_video(
-                            filename=video_path, 
-                            pts_unit="sec", 
-                            output_format="TCHW"
-                        )
+                    # only decode the needed range of the video rather than the entire video
+                    vframes = read_video_frames(
+                        video_path, frame_idxs_ori,
+                        start_sec=dataset_dict.get("start_sec", None),
+                        end_sec=dataset_dict.get("end_sec", None),
+                    )
                 except Exception as e:
                     print(f"An error occurred while loading the video {video_path}:", str(e))
                     return None
 
-                num_frames, _, height, width = vframes.shape
+                if len(vframes) < len(selected_idx):
+                    if self.is_train or len(vframes) == 0:
+                        print(f"Missing frames in the video {video_path}, reload...")
+                        return None
+                    dataset_dict["video_len"] = len(vframes)
+                    selected_idx = selected_idx[:len(vframes)]
+                    selected_idx_map = selected_idx_map[:len(vframes)]
+                    dataset_dict["frame_indices"] = selected_idx_map
+
+                height, width = vframes[0].shape[:2]
                 if dataset_dict["height"] != height or dataset_dict["width"] != width:
                     d_height, d_width = dataset_dict["height"], dataset_dict["width"]
                     print(f"Mismathed shapes: {d_height} != {height} or {d_width} != {width}")
                     # the compressed videos with 256p (short edge), we upsample it to 512p
                     vframes = F.interpolate(
-                        vframes, 
+                        torch.from_numpy(np.stack(vframes)).permute(0,3,1,2).float(),
                         size=(dataset_dict["height"], dataset_dict["width"]), 
                         mode="bilinear", 
                         align_corners=False
                     )
-                vframes = vframes.permute(0,2,3,1).numpy()
-                total_frames = len(vframes)
+                    vframes = list(vframes.permute(0,2,3,1).numpy())
 
-        for frame_idx in selected_idx:
+        for i, frame_idx in enumerate(selected_idx):
             dataset_dict["file_names"].append(file_names[frame_idx])
             if dataset_dict["is_raw_video"]:
                 # for efficiency, we usually take a single frame with every 5 frames (5-stride)
-                frame_idx_ori = int(file_names[frame_idx].split('/')[-1].split('.')[0])
-                assert frame_idx_ori < len(vframes), f"the frame index should be less than {len(vframes)}"
-                image = vframes[frame_idx_ori] 
+                image = vframes[i]
             else:
                 # Read image
                 try:
@@ -418,22 +420,32 @@ class UniVidDatasetMapper:
                     # eg. GOT10K/val/GOT-10k_Val_000137
                     return None
 
-            image_padding_mask = np.ones_like(image)
+            if self.gpu_augmentation:
+                # only sample the transforms here, the frame and its annotations are kept in the
+                # original resolution, and transformed on GPU by `apply_clip_transforms_on_device`
+                transforms = sample_transforms(selected_augmentations, image.shape[:2])
+                anno_transforms = T.TransformList([])
+                image_shape = image.shape[:2]  # h, w
+                dataset_dict["transforms"].append(transforms)
+                dataset_dict["image"].append(torch.as_tensor(np.ascontiguousarray(image.transpose(2, 0, 1))))
+            else:
+                image_padding_mask = np.ones_like(image)
 
-            aug_input = T.AugInput(image)
-            transforms = selected_augmentations(aug_input)
+                aug_input = T.AugInput(image)
+                transforms = selected_augmentations(aug_input)
+                anno_transforms = transforms
 
-            image = aug_input.image
-            image_shape = image.shape[:2]  # h, w
+                image = aug_input.image
+                image_shape = image.shape[:2]  # h, w
 
-            image_padding_mask = transforms.apply_segmentation(image_padding_mask)
-            # Pytorch's dataloader is efficient on torch.Tensor due to shared-memory,
-            # but not efficient on large generic data structures due to the use of pickle & mp.Queue.
-            # Therefore, it's important to use torch.Tensor.
-            dataset_dict["image"].append(torch.as_tensor(np.ascontiguousarray(image.transpose(2, 0, 1))))
-            dataset_dict["image_padding_mask"].append(torch.as_tensor(
-                np.ascontiguousarray(1 - image_padding_mask[:, :, 0])
-            ))
+                image_padding_mask = transforms.apply_segmentation(image_padding_mask)
+                # Pytorch's dataloader is efficient on torch.Tensor due to shared-memory,
+                # but not efficient on large generic data structures due to the use of pickle & mp.Queue.
+                # Therefore, it's important to use torch.Tensor.
+                dataset_dict["image"].append(torch.as_tensor(np.ascontiguousarray(image.transpose(2, 0, 1))))
+                dataset_dict["image_padding_mask"].append(torch.as_tensor(
+                    np.ascontiguousarray(1 - image_padding_mask[:, :, 0])
+                ))
 
             # for evaluation
             if not self.is_train:
@@ -508,7 +520,7 @@ class UniVidDatasetMapper:
             
             # USER: Implement additional transformations if you have other types of data
             annos = [
-                utils.transform_instance_annotations(obj, transforms, image_shape)
+                utils.transform_instance_annotations(obj, anno_transforms, image_shape)
                 for obj in _frame_annos
                 if obj.get("iscrowd", 0) == 0
             ]
@@ -526,7 +538,7 @@ class UniVidDatasetMapper:
                 dataset_dict["metadata"] = dataset_dict["metadata"]
 
                 # apply the same transformation to panoptic segmentation
-                pan_seg_gt = transforms.apply_segmentation(pan_seg_gt)
+                pan_seg_gt = anno_transforms.apply_segmentation(pan_seg_gt)
                 from panopticapi.utils import rgb2id
                 pan_seg_gt = rgb2id(pan_seg_gt).astype("long")
 
@@ -613,6 +625,9 @@ class UniVidDatasetMapper:
             if task == "grounding" and len(dataset_dict["expressions"]):
                 dataset_dict["expressions"] = [dataset_dict["expressions"][_i] for _i in valid_idxs.tolist()]
                 dataset_dict["exp_obj_ids"] = [dataset_dict["exp_obj_ids"][_i] for _i in valid_idxs.tolist()]
+
+            if self.packed_masks:
+                utils.pack_instances_masks(dataset_dict["instances"])
         
         return dataset_dict
 
@@ -2,12 +2,90 @@ import json
 import logging
 import numpy as np
 import os
+import pickle
 
 from detectron2.data import DatasetCatalog, MetadataCatalog
 
 logger = logging.getLogger(__name__)
 
 
+def filter_sa_1b_annotations(annotations, max_num_unfiltered=100, min_stability_score=0.97, min_predicted_iou=0.9):
+    """
+    Remove masks with low stability_score or predicted_iou, if there are too many masks in the image.
+    """
+    if len(annotations) <= max_num_unfiltered:
+        return annotations
+    return [
+        anno for anno in annotations
+        if anno["stability_score"] > min_stability_score and anno["predicted_iou"] > min_predicted_iou
+    ]
+
+
+def get_sa_1b_compact_index_prefix(anno_file_json):
+    return os.path.splitext(anno_file_json)[0] + "_compact"
+
+
+def build_sa_1b_compact_index(anno_file_json, anno_root, output_prefix=None):
+    """
+    Parse the per-image annotation files listed in `anno_file_json` once, filter low-quality masks and
+    save the kept annotations as a compact index: `{prefix}.bin` stores the pickled records one
+    after another and `{prefix}.idx.npy` stores their offsets. Only the fields used in training are kept,
+    and RLE counts are saved as bytes.
+
+    Args:
+        anno_file_json: json file with all names of annotation files, see `load_sa_1b_json`
+        anno_root: the directory of per-image annotation files
+        output_prefix: the prefix of output files, default to `get_sa_1b_compact_index_prefix(anno_file_json)`
+    """
+    if output_prefix is None:
+        output_prefix = get_sa_1b_compact_index_prefix(anno_file_json)
+    anno_names = json.load(open(anno_file_json, 'r'))["annotation_names"]
+
+    offsets = [0]
+    with open(output_prefix + ".bin", "wb") as f:
+        for anno_name in anno_names:
+            annotations = json.load(open(os.path.join(anno_root, anno_name), 'r'))
+            record = {
+                "image": annotations["image"],
+                "annotations": [
+                    {
+                        "id": anno["id"],
+                        "bbox": anno["bbox"],
+                        "area": anno["area"],
+                        "segmentation": {
+                            "size": anno["segmentation"]["size"],
+                            "counts": anno["segmentation"]["counts"].encode("ascii"),
+                        },
+                    }
+                    for anno in filter_sa_1b_annotations(annotations["annotations"])
+                ],
+            }
+            f.write(pickle.dumps(record, protocol=pickle.HIGHEST_PROTOCOL))
+            offsets.append(f.tell())
+    np.save(output_prefix + ".idx.npy", np.asarray(offsets, dtype=np.int64))
+    logger.info("Saved compact annotations of {} images in {}".format(len(anno_names), output_prefix))
+
+
+class SA1BCompactIndex:
+    """
+    Random access to the records saved by `build_sa_1b_compact_index`.
+    Only the offsets are loaded (memory-mapped), each record is read and unpickled on demand.
+    """
+
+    def __init__(self, prefix):
+        self.prefix = prefix
+        self.offsets = np.load(prefix + ".idx.npy", mmap_mode="r")
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, idx):
+        start, end = int(self.offsets[idx]), int(self.offsets[idx + 1])
+        with open(self.prefix + ".bin", "rb") as f:
+            f.seek(start)
+            return pickle.loads(f.read(end - start))
+
+
 def load_sa_1b_json(anno_file_json, image_root):
     """
     Args:
@@ -18,6 +96,15 @@ def load_sa_1b_json(anno_file_json, image_root):
         dataset_dicts: same format as COCO
 
     """
+    compact_prefix = get_sa_1b_compact_index_prefix(anno_file_json)
+    if os.path.exists(compact_prefix + ".idx.npy"):
+        # pre-filtered annotations built by `build_sa_1b_compact_index`, which are read in dataset_mapper.py
+        num_images = len(SA1BCompactIndex(compact_prefix))
+        logger.info("Using compact SA-1B annotations {} with {} images".format(compact_prefix, num_images))
+        return [
+            {"sa_1b_compact_index": compact_prefix, "sa_1b_index": i, "image_root": image_root}
+            for i in range(num_images)
+        ]
 
     # Load annotations of per image in dataset_mapper.py, cause SA-1B is too large!
     anno_files = json.load(open(anno_file_json, 'r'))
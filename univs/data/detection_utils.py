@@ -40,6 +40,8 @@ __all__ = [
     "create_keypoint_hflip_indices",
     "filter_empty_instances",
     "read_image",
+    "PackedBitMasks",
+    "pack_instances_masks",
 ]
 
 
@@ -526,6 +528,81 @@ def filter_empty_instances(
     return instances[m]
 
 
+class PackedBitMasks:
+    """
+    Binary masks of Instances, where every 8 pixels along the width are packed into one byte,
+    so that the masks take 1/8 of the memory of `BitMasks` when they are passed from dataloader
+    workers to the main process and transferred to GPU. Use :meth:`unpack` to get the dense
+    masks on the target device.
+
+    Attributes:
+        tensor: uint8 Tensor of N,H,ceil(W/8)
+        image_size (tuple): height, width of the unpacked masks
+    """
+
+    def __init__(self, tensor: torch.Tensor, image_size):
+        assert tensor.dtype == torch.uint8 and tensor.dim() == 3, tensor.shape
+        self.tensor = tensor
+        self.image_size = tuple(image_size)
+
+    @staticmethod
+    def from_bitmasks(masks):
+        """
+        Args:
+            masks (BitMasks or Tensor): bool or uint8 masks with shape (N, H, W)
+        """
+        masks = masks.tensor if isinstance(masks, BitMasks) else masks
+        n, h, w = masks.shape
+        masks = torch.nn.functional.pad(masks.to(torch.uint8), (0, -w % 8))
+        weights = torch.tensor([128, 64, 32, 16, 8, 4, 2, 1], dtype=torch.uint8, device=masks.device)
+        packed = (masks.view(n, h, (w + 7) // 8, 8) * weights).sum(-1, dtype=torch.uint8)
+        return PackedBitMasks(packed, (h, w))
+
+    def unpack(self) -> torch.Tensor:
+        """
+        Returns:
+            Tensor: bool masks with shape (N, H, W) on the device of the packed masks
+        """
+        shifts = torch.arange(7, -1, -1, dtype=torch.uint8, device=self.tensor.device)
+        bits = (self.tensor[..., None] >> shifts) & 1
+        h, w = self.image_size
+        return bits.view(*self.tensor.shape[:2], self.tensor.shape[2] * 8)[..., :w].bool()
+
+    def to(self, *args, **kwargs) -> "PackedBitMasks":
+        return PackedBitMasks(self.tensor.to(*args, **kwargs), self.image_size)
+
+    @property
+    def device(self) -> torch.device:
+        return self.tensor.device
+
+    def __getitem__(self, item) -> "PackedBitMasks":
+        if isinstance(item, int):
+            return PackedBitMasks(self.tensor[item].unsqueeze(0), self.image_size)
+        if isinstance(item, torch.Tensor):
+            item = item.to(self.tensor.device)
+        return PackedBitMasks(self.tensor[item], self.image_size)
+
+    def __len__(self) -> int:
+        return self.tensor.shape[0]
+
+    def nonempty(self) -> torch.Tensor:
+        return self.tensor.flatten(1).any(dim=1)
+
+    def __repr__(self) -> str:
+        return self.__class__.__name__ + "(num_instances={})".format(len(self.tensor))
+
+
+def pack_instances_masks(instances_list):
+    """
+    Replace the `BitMasks` of a list of Instances (e.g. the frames of a clip) with
+    `PackedBitMasks` in-place.
+    """
+    for instances in instances_list:
+        if instances.has("gt_masks") and isinstance(instances.gt_masks, BitMasks):
+            instances.gt_masks = PackedBitMasks.from_bitmasks(instances.gt_masks)
+    return instances_list
+
+
 def create_keypoint_hflip_indices(dataset_names: Union[str, List[str]]) -> List[int]:
     """
     Args:
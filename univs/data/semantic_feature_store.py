@@ -0,0 +1,262 @@
+"""
+A compact container of the semantic extraction outputs (object tokens and compressed mask features).
+Many videos are appended into one shard, which consists of two files:
+    * "<shard>.bin": the raw bytes of all chunks, append-only
+    * "<shard>.index.jsonl": one json line per video, with the shape, the storage dtype, the compression
+      and the byte ranges of the chunks of each array, e.g.
+        {"video_id": ..., "meta": {...}, "arrays": {"obj_tokens": {"shape": [T, C, N], "dtype": "float16",
+         "compression": "", "chunks": [[offset, nbytes, frame_start, frame_end], ...]}, ...}}
+
+Each array is split into chunks along the temporal axis (the first one). A chunk of an int8 array starts
+with the per-channel (the second axis) float32 scales, followed by the quantized values. The index line of
+a video is written after all its chunks, thus the videos interrupted by a crash are never visible.
+Uncompressed chunks are read from a memory map, so loading a frame range only reads the needed pages.
+"""
+
+import glob
+import json
+import os
+import zlib
+
+import numpy as np
+import torch
+
+from univs.utils.profiling import profiled
+
+__all__ = ["SemanticFeatureShardWriter", "SemanticFeatureStore"]
+
+
+_STORAGE_DTYPES = {
+    "float32": np.float32,
+    "float16": np.float16,
+    "bfloat16": np.int16,  # raw bits, numpy has no bfloat16
+    "int8": np.int8,
+}
+_COMPRESSIONS = ("", "zlib")
+
+
+def _encode_chunk(x, dtype, compression):
+    x = x.detach()
+    if dtype == "int8":
+        # symmetric quantization with per-channel scales
+        x = x.float()
+        reduce_dims = [d for d in range(x.dim()) if d != 1]
+        scales = x.abs().amax(dim=reduce_dims).clamp(min=1e-8) / 127.
+        scales_ = scales.view(1, -1, *([1] * (x.dim() - 2)))
+        q = (x / scales_).round().clamp(-127, 127).to(torch.int8)
+        buf = scales.cpu().numpy().tobytes() + q.cpu().numpy().tobytes()
+    elif dtype == "bfloat16":
+        buf = x.to(torch.bfloat16).cpu().contiguous().view(torch.int16).numpy().tobytes()
+    else:
+        buf = x.to(getattr(torch, dtype)).cpu().contiguous().numpy().tobytes()
+
+    if compression == "zlib":
+        buf = zlib.compress(buf)
+    return buf
+
+
+def _decode_chunk(raw, shape, dtype, compression, start, end, out_dtype):
+    """
+    Decode the frames [start, end) of a chunk with the given shape, `raw` is a uint8 array
+    or a memory map of the chunk bytes.
+    """
+    if compression == "zlib":
+        raw = np.frombuffer(zlib.decompress(raw), dtype=np.uint8)
+
+    scales = None
+    if dtype == "int8":
+        num_channels = shape[1]
+        scales = torch.from_numpy(raw[:4 * num_channels].view(np.float32).copy())
+        raw = raw[4 * num_channels:]
+    values = raw.view(_STORAGE_DTYPES[dtype]).reshape(shape)[start:end]
+    # copy only the needed frames out of the memory map
+    values = torch.from_numpy(np.ascontiguousarray(values))
+
+    if dtype == "bfloat16":
+        values = values.view(torch.bfloat16)
+    elif dtype == "int8":
+        values = values.float() * scales.view(1, -1, *([1] * (values.dim() - 2)))
+    return values if out_dtype is None else values.to(out_dtype)
+
+
+class SemanticFeatureShardWriter:
+    """
+    Append the outputs of many videos into chunked shards, each video is written clip by clip:
+        writer.begin_video(video_id, height=..., width=...)
+        for each clip: writer.append(obj_tokens=..., compression_mask_features=...)
+        writer.end_video()
+
+    Args:
+        out_dir (str): the directory of the shards
+        prefix (str): the file name prefix of the shards, it should be unique per process
+        dtype (str): the storage dtype, "float32", "float16", "bfloat16" or "int8"
+        compression (str): "" or "zlib". Compressed chunks can not be memory-mapped,
+            so the frame-range reads of them decompress entire chunks
+        max_shard_size_mb (int): a new shard is started before a video once the current one is larger
+    """
+
+    def __init__(self, out_dir, prefix="shard", dtype="float16", compression="", max_shard_size_mb=4096):
+        if dtype not in _STORAGE_DTYPES:
+            raise ValueError(f"Unsupported storage dtype {dtype}, should be one of {list(_STORAGE_DTYPES)}.")
+        if compression not in _COMPRESSIONS:
+            raise ValueError(f"Unsupported compression {compression}, should be one of {_COMPRESSIONS}.")
+        self.out_dir = out_dir
+        self.prefix = prefix
+        self.dtype = dtype
+        self.compression = compression
+        self.max_shard_size = max_shard_size_mb * 1024 * 1024
+
+        os.makedirs(out_dir, exist_ok=True)
+        self._shard_idx = -1
+        self._bin_file = None
+        self._index_file = None
+        self._video = None
+        self._open_next_shard()
+
+    def _open_next_shard(self):
+        self._close_files()
+        # never append to the shards of previous runs
+        while True:
+            self._shard_idx += 1
+            shard_path = os.path.join(self.out_dir, f"{self.prefix}_{self._shard_idx:05d}")
+            if not os.path.exists(shard_path + ".bin"):
+                break
+        self.shard_path = shard_path
+        self._bin_file = open(shard_path + ".bin", "ab")
+        self._index_file = open(shard_path + ".index.jsonl", "a")
+
+    def _close_files(self):
+        for f in (self._bin_file, self._index_file):
+            if f is not None:
+                f.close()
+        self._bin_file, self._index_file = None, None
+
+    def begin_video(self, video_id, **meta):
+        assert self._video is None, "end_video() should be called before starting a new video."
+        if self._bin_file.tell() >= self.max_shard_size:
+            self._open_next_shard()
+        self._video = {"video_id": video_id, "meta": meta, "arrays": {}}
+
+    @profiled("output_writing")
+    def append(self, **arrays):
+        """
+        Append a clip of the current video, each array is a Tensor with shape (T, C, ...)
+        and T is the same for all arrays.
+        """
+        assert self._video is not None, "begin_video() should be called before appending clips."
+        for name, x in arrays.items():
+            entry = self._video["arrays"].setdefault(
+                name,
+                {"shape": [0] + list(x.shape[1:]), "dtype": self.dtype, "compression": self.compression, "chunks": []}
+            )
+            assert list(x.shape[1:]) == entry["shape"][1:], f"Mismatched shape of {name}: {x.shape}."
+            buf = _encode_chunk(x, self.dtype, self.compression)
+            offset = self._bin_file.tell()
+            self._bin_file.write(buf)
+            t = entry["shape"][0]
+            entry["chunks"].append([offset, len(buf), t, t + x.shape[0]])
+            entry["shape"][0] = t + x.shape[0]
+
+    @profiled("output_writing")
+    def end_video(self):
+        assert self._video is not None
+        self._bin_file.flush()
+        self._index_file.write(json.dumps(self._video) + "\n")
+        self._index_file.flush()
+        self._video = None
+
+    def close(self):
+        if self._video is not None:
+            # drop the unfinished video, its chunks are never indexed
+            self._video = None
+        self._close_files()
+
+
+class SemanticFeatureStore:
+    """
+    Random access to the videos written by :class:`SemanticFeatureShardWriter`.
+
+    Args:
+        root (str or list[str]): a directory of shards, the path of a "*.index.jsonl" file,
+            or a list of such paths, e.g. the shards of one compression ratio only
+
+    Example:
+        store = SemanticFeatureStore("datasets/internvid/semantic_extraction/InternVId-FLT_1")
+        mask_feats = store.load(video_id, "compression_mask_features", start=0, end=16)
+    """
+
+    def __init__(self, root):
+        if isinstance(root, (list, tuple)):
+            index_files = list(root)
+        elif os.path.isdir(root):
+            index_files = sorted(glob.glob(os.path.join(root, "*.index.jsonl")))
+        else:
+            index_files = [root]
+
+        self._videos = {}
+        for index_file in index_files:
+            bin_path = index_file[:-len(".index.jsonl")] + ".bin"
+            with open(index_file) as f:
+                for line in f:
+                    line = line.strip()
+                    if len(line) == 0:
+                        continue
+                    video = json.loads(line)
+                    # the latest one wins if a video has been extracted twice
+                    self._videos[video["video_id"]] = (bin_path, video)
+        self._memmaps = {}
+
+    def __len__(self):
+        return len(self._videos)
+
+    def __contains__(self, video_id):
+        return video_id in self._videos
+
+    @property
+    def video_ids(self):
+        return list(self._videos.keys())
+
+    def meta(self, video_id):
+        return self._videos[video_id][1]["meta"]
+
+    def shape(self, video_id, name):
+        return tuple(self._videos[video_id][1]["arrays"][name]["shape"])
+
+    def _get_memmap(self, bin_path):
+        # opened lazily, so that the store can be created before forking dataloader workers
+        if bin_path not in self._memmaps:
+            self._memmaps[bin_path] = np.memmap(bin_path, dtype=np.uint8, mode="r")
+        return self._memmaps[bin_path]
+
+    def load(self, video_id, name, start=0, end=None, dtype=torch.float32):
+        """
+        Load the frames [start, end) of an array of a video.
+
+        Args:
+            video_id (str): the id of the video
+            name (str): "obj_tokens" or "compression_mask_features"
+            start, end (int): the frame range, in the frames of the saved (temporally strided) array
+            dtype (torch.dtype): the output dtype, None to keep the storage dtype (int8 is always dequantized)
+
+        Returns:
+            Tensor: with shape (end - start, C, ...) on cpu
+        """
+        bin_path, video = self._videos[video_id]
+        entry = video["arrays"][name]
+        num_frames = entry["shape"][0]
+        end = num_frames if end is None else min(end, num_frames)
+        start = max(start, 0)
+        if start >= end:
+            return torch.zeros((0, *entry["shape"][1:]), dtype=dtype or torch.float32)
+
+        data = self._get_memmap(bin_path)
+        values = []
+        for offset, nbytes, t_start, t_end in entry["chunks"]:
+            if t_end <= start or t_start >= end:
+                continue
+            chunk_shape = (t_end - t_start, *entry["shape"][1:])
+            values.append(_decode_chunk(
+                data[offset:offset + nbytes], chunk_shape, entry["dtype"], entry["compression"],
+                max(start, t_start) - t_start, min(end, t_end) - t_start, dtype,
+            ))
+        return torch.cat(values) if len(values) > 1 else values[0]
@@ -0,0 +1,140 @@
+__all__ = ["get_video_metadata", "read_video_frames"]
+
+
+def _get_framerate(stream):
+    """
+    The frame rate of a video stream, None if PyAV reports no rate (e.g. some raw or VFR streams).
+    """
+    for rate in (stream.average_rate, stream.guessed_rate, getattr(stream, "base_rate", None)):
+        if rate:
+            return float(rate)
+    return None
+
+
+def get_video_metadata(video_path):
+    """
+    Read the metadata of a video from the container headers, without decoding frames.
+
+    Args:
+        video_path (str): path of a .mp4/.avi/.mov/.mkv file
+
+    Returns:
+        dict: with "length", "height", "width" and "framerate" of the first video stream,
+            "framerate" is None if the container reports no frame rate
+    """
+    import av
+
+    with av.open(video_path) as container:
+        stream = container.streams.video[0]
+        framerate = _get_framerate(stream)
+        num_frames = stream.frames
+        if num_frames == 0:
+            # some containers (e.g. .mkv) do not store the number of frames
+            if stream.duration is not None:
+                duration = float(stream.duration * stream.time_base)
+            elif container.duration is not None:
+                duration = container.duration / av.time_base
+            else:
+                duration = None
+            if duration is not None and framerate is not None:
+                num_frames = int(round(duration * framerate))
+            else:
+                # neither the duration nor the frame rate is known, count the packets without decoding
+                num_frames = sum(1 for packet in container.demux(stream) if packet.size)
+
+        return {
+            "length": num_frames,
+            "height": stream.codec_context.height,
+            "width": stream.codec_context.width,
+            "framerate": framerate,
+        }
+
+
+def read_video_frames(video_path, frame_indices, start_sec=None, end_sec=None):
+    """
+    Decode the given frames of a video. It seeks to the key frame before the first
+    needed frame and stops decoding after the last one, so that only the needed range
+    is decoded, instead of the entire video as `torchvision.io.read_video` does.
+
+    Args:
+        video_path (str): path of a .mp4/.avi/.mov/.mkv file
+        frame_indices (list[int]): frame indices relative to `start_sec`,
+            may be unsorted or duplicated
+        start_sec (float): the start time of the clip in seconds, None for the start of the video
+        end_sec (float): the end time of the clip in seconds, None for the end of the video
+
+    Returns:
+        list[ndarray]: RGB frames with shape (H, W, 3) in the order of `frame_indices`.
+            If the video (or the clip) ends early, only the frames of the longest
+            prefix of `frame_indices` that exist are returned.
+    """
+    import av
+
+    if len(frame_indices) == 0:
+        return []
+
+    with av.open(video_path) as container:
+        stream = container.streams.video[0]
+        stream.thread_type = "AUTO"
+        framerate = _get_framerate(stream)
+        if framerate is None:
+            if start_sec is not None or end_sec is not None:
+                raise ValueError(f"{video_path} reports no frame rate, the clip [start_sec, end_sec] can not be located.")
+            return _read_video_frames_sequentially(container, stream, frame_indices)
+        time_base = float(stream.time_base)
+        start_pts = stream.start_time or 0
+
+        offset = int(round(start_sec * framerate)) if start_sec is not None else 0
+        last_index = int(end_sec * framerate) if end_sec is not None else None
+        wanted = sorted({offset + i for i in frame_indices})
+        if last_index is not None:
+            wanted = [i for i in wanted if i < last_index]
+
+        frames = {}
+        if len(wanted):
+            seek_pts = start_pts + int(wanted[0] / framerate / time_base)
+            container.seek(seek_pts, stream=stream, backward=True, any_frame=False)
+
+            ptr = 0
+            for frame in container.decode(stream):
+                if frame.pts is None:
+                    continue
+                index = int(round((frame.pts - start_pts) * time_base * framerate))
+                if index < wanted[ptr]:
+                    continue
+                image = frame.to_ndarray(format="rgb24")
+                # the first decoded frame at or after a wanted index, robust to the jitter of timestamps
+                while ptr < len(wanted) and wanted[ptr] <= index:
+                    frames[wanted[ptr]] = image
+                    ptr += 1
+                if ptr == len(wanted):
+                    break
+
+    images = []
+    for i in frame_indices:
+        if offset + i not in frames:
+            break
+        images.append(frames[offset + i])
+    return images
+
+
+def _read_video_frames_sequentially(container, stream, frame_indices):
+    """
+    Decode from the start of a video without a frame rate, where the index of a frame is
+    its decoding order, thus timestamps can not be used to seek.
+    """
+    wanted = set(frame_indices)
+    last_index = max(wanted)
+    frames = {}
+    for index, frame in enumerate(container.decode(stream)):
+        if index in wanted:
+            frames[index] = frame.to_ndarray(format="rgb24")
+        if index >= last_index:
+            break
+
+    images = []
+    for i in frame_indices:
+        if i not in frames:
+            break
+        images.append(frames[i])
+    return images
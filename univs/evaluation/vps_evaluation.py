@@ -18,6 +18,8 @@ from PIL import Image
 from panopticapi.utils import rgb2id
 from panopticapi.utils import IdGenerator
 
+from univs.utils.async_writer import AsyncImageWriter
+
 from .eval_vpq_vps import vpq_compute_parallel
 from .eval_stquality_vps import STQuality 
 
@@ -35,6 +37,7 @@ class VPSEvaluator(DatasetEvaluator):
         output_dir=None,
         *,
         use_fast_impl=True,
+        num_writer_workers=4,
     ):
         """
         Args:
@@ -62,6 +65,8 @@ class VPSEvaluator(DatasetEvaluator):
                 Although the results should be very close to the official implementation in COCO
                 API, it is still recommended to compute results with the official API for use in
                 papers. The faster implementation also uses more RAM.
+            num_writer_workers (int): the number of threads to save the predicted .png images
+                in the background, 0 to save them synchronously.
         """
         self._logger = logging.getLogger(__name__)
         self._distributed = distributed
@@ -78,6 +83,7 @@ class VPSEvaluator(DatasetEvaluator):
             self._tasks = tasks
 
         self._cpu_device = torch.device("cpu")
+        self._writer = AsyncImageWriter(num_workers=num_writer_workers)
 
         self._metadata = MetadataCatalog.get(dataset_name)
         thing_dataset_id_to_contiguous_id = self._metadata.thing_dataset_id_to_contiguous_id
@@ -170,10 +176,12 @@ class VPSEvaluator(DatasetEvaluator):
         #### save image
         annotations = []
         for i, image_name in enumerate(image_names):
-            image_ = Image.fromarray(pan_format[i])
             if not os.path.exists(os.path.join(self._output_dir, 'pan_pred', video_id)):
                 os.makedirs(os.path.join(self._output_dir, 'pan_pred', video_id))
-            image_.save(os.path.join(self._output_dir, 'pan_pred', video_id, image_name.split('/')[-1].split('.')[0] + '.png'))
+            self._writer.write(
+                os.path.join(self._output_dir, 'pan_pred', video_id, image_name.split('/')[-1].split('.')[0] + '.png'),
+                pan_format[i]
+            )
             annotations.append({"segments_info": [item[i] for item in segments_infos_ if item[i] is not None], "file_name": image_name.split('/')[-1]})
         self._predictions.append({'annotations': annotations, 'video_id': video_id})
 
@@ -181,6 +189,8 @@ class VPSEvaluator(DatasetEvaluator):
         """
         save jsons and comput vpq and stq metrics
         """
+        # all predicted images must be saved before being read by the main process
+        self._writer.flush(all_threads=True)
         if self._distributed:
             comm.synchronize()
             predictions = comm.gather(self._predictions, dst=0)
@@ -11,6 +11,8 @@ from detectron2.data import MetadataCatalog
 from detectron2.evaluation import DatasetEvaluator
 from detectron2.utils.file_io import PathManager
 
+from univs.utils.async_writer import AsyncImageWriter
+
 from .eval_utils_vss import Evaluator
 
 
@@ -28,6 +30,7 @@ class VSSEvaluator(DatasetEvaluator):
         *,
         use_fast_impl=True,
         eval_miou_res=-1,
+        num_writer_workers=4,
     ):
         """
         Args:
@@ -55,6 +58,8 @@ class VSSEvaluator(DatasetEvaluator):
                 Although the results should be very close to the official implementation in COCO
                 API, it is still recommended to compute results with the official API for use in
                 papers. The faster implementation also uses more RAM.
+            num_writer_workers (int): the number of threads to save the predicted .png images
+                in the background, 0 to save them synchronously.
         """
         self._logger = logging.getLogger(__name__)
         self._distributed = distributed
@@ -71,6 +76,7 @@ class VSSEvaluator(DatasetEvaluator):
             self._tasks = tasks
 
         self._cpu_device = torch.device("cpu")
+        self._writer = AsyncImageWriter(num_workers=num_writer_workers)
 
         self._metadata = MetadataCatalog.get(dataset_name)
         self.ignore_val = self._metadata.ignore_label
@@ -111,16 +117,22 @@ class VSSEvaluator(DatasetEvaluator):
         sem_seg_result = sem_seg_result_
         assert len(image_names) == len(sem_seg_result), 'Mismatch length between predicted and gt images'
         for i, image_name in enumerate(image_names):
-            image_ = Image.fromarray(sem_seg_result[i])
             if not os.path.exists(os.path.join(self._output_dir, video_id)):
                 os.makedirs(os.path.join(self._output_dir, video_id))
-            image_.save(os.path.join(self._output_dir, video_id, image_name.split('/')[-1].split('.')[0] + '.png'))
+            self._writer.write(
+                os.path.join(self._output_dir, video_id, image_name.split('/')[-1].split('.')[0] + '.png'),
+                sem_seg_result[i]
+            )
         return
 
     def evaluate(self):
         """
         evaluate miou and vc8/vc16
         """
+        # all predicted images must be saved before being read by the main process
+        self._writer.flush(all_threads=True)
+        if self._distributed:
+            comm.synchronize()
         if self._do_evaluation and comm.get_rank() == 0:
             self.evaluate_miou()
             self.evaluate_vc_perclip()
@@ -22,6 +22,7 @@ from detectron2.utils.logger import create_small_table
 
 from univs.data.datasets.ytvis_api.ytvos import YTVOS
 from univs.data.datasets.ytvis_api.ytvoseval import YTVOSeval
+from univs.utils.profiling import profile_region
 
 
 class YTVISEvaluator(DatasetEvaluator):
@@ -314,12 +315,13 @@ def instances_to_coco_json_video(inputs, outputs):
 
     ytvis_results = []
     for id, (s, l, m) in enumerate(zip(scores, labels, masks)):
-        segms = [
-            mask_util.encode(np.array(_mask[:, :, None], order="F", dtype="uint8"))[0]
-            for _mask in m
-        ]
-        for rle in segms:
-            rle["counts"] = rle["counts"].decode("utf-8")
+        with profile_region("rle_encoding"):
+            segms = [
+                mask_util.encode(np.array(_mask[:, :, None], order="F", dtype="uint8"))[0]
+                for _mask in m
+            ]
+            for rle in segms:
+                rle["counts"] = rle["counts"].decode("utf-8")
 
         res = {
             "video_id": video_id,
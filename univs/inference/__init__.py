@@ -7,4 +7,7 @@ from .inference_video_vos import InferenceVideoVOS
 from .inference_video_entity import InferenceVideoEntity
 
 # semantic extraction for raw videos with .mp4
-from .inference_video_semantic_extraction import InferenceVideoSemanticExtraction
\ No newline at end of file
+from .inference_video_semantic_extraction import InferenceVideoSemanticExtraction
+
+# serving mode, packing the clips of several videos into shared backbone forward passes
+from .batched_inference import run_batched_inference
@@ -0,0 +1,190 @@
+import copy
+import threading
+import time
+from collections import OrderedDict
+
+import torch
+from torch import nn
+
+from univs.modeling.tracking import FastOverTracker_DET, MDQE_OverTrackerEfficient
+from univs.utils.comm import inference_autocast
+from univs.utils.profiling import profiler
+
+__all__ = ["BatchedBackbone", "fork_inference_engine", "run_batched_inference"]
+
+
+class BatchedBackbone(nn.Module):
+    """
+    A backbone shared by the threads of several videos, which packs the clips of all videos that are
+    waiting for their features into one forward pass. A batch is launched once all active videos have
+    submitted a clip, or once the oldest pending clip has waited for `max_wait_ms`, so that a video
+    busy in its decoder or post-processing never stalls the others.
+
+    Clips are only packed with clips of the same (padded) size, thus the features of each video
+    are the same as running the backbone on it alone.
+
+    Args:
+        backbone: the backbone of the model
+        num_clients (int): the number of videos (threads) that call this backbone
+        max_batch_frames (int): the max number of frames per forward pass, a clip is never split
+        max_wait_ms (float): the max time to wait for the clips of other videos
+    """
+
+    def __init__(self, backbone, num_clients, max_batch_frames=32, max_wait_ms=20):
+        super().__init__()
+        self.backbone = backbone
+        self.max_batch_frames = max_batch_frames
+        self.max_wait = max_wait_ms / 1000.
+        self._num_clients = num_clients
+        self._pending = []
+        self._cond = threading.Condition()
+
+    @property
+    def size_divisibility(self):
+        return self.backbone.size_divisibility
+
+    def release_client(self):
+        # a video is finished, the others do not wait for it anymore
+        with self._cond:
+            self._num_clients -= 1
+            self._cond.notify_all()
+
+    def forward(self, x):
+        request = {"input": x, "output": None, "error": None, "taken": False, "done": False}
+        batch = None
+        with self._cond:
+            self._pending.append(request)
+            self._cond.notify_all()
+            deadline = time.monotonic() + self.max_wait
+            while not request["done"]:
+                if not request["taken"]:
+                    remaining = deadline - time.monotonic()
+                    if len(self._pending) >= self._num_clients or remaining <= 0:
+                        # this thread runs the forward pass of all pending clips
+                        batch, self._pending = self._pending, []
+                        for r in batch:
+                            r["taken"] = True
+                        break
+                    self._cond.wait(timeout=remaining)
+                else:
+                    # taken by another thread, wait for its outputs
+                    self._cond.wait()
+
+        if batch is not None:
+            self._run(batch)
+            with self._cond:
+                for r in batch:
+                    r["done"] = True
+                self._cond.notify_all()
+
+        if request["error"] is not None:
+            raise request["error"]
+        return request["output"]
+
+    def _run(self, batch):
+        groups = {}
+        for r in batch:
+            x = r["input"]
+            groups.setdefault((tuple(x.shape[1:]), x.dtype, x.device), []).append(r)
+
+        for requests in groups.values():
+            # split into sub-batches of at most max_batch_frames frames
+            sub_batches, num_frames = [[]], 0
+            for r in requests:
+                if len(sub_batches[-1]) and num_frames + len(r["input"]) > self.max_batch_frames:
+                    sub_batches.append([])
+                    num_frames = 0
+                sub_batches[-1].append(r)
+                num_frames += len(r["input"])
+
+            for sub_batch in sub_batches:
+                try:
+                    if len(sub_batch) == 1:
+                        sub_batch[0]["output"] = self.backbone(sub_batch[0]["input"])
+                        continue
+                    sizes = [len(r["input"]) for r in sub_batch]
+                    features = self.backbone(torch.cat([r["input"] for r in sub_batch]))
+                    features = {k: v.split(sizes) for k, v in features.items()}
+                    for i, r in enumerate(sub_batch):
+                        r["output"] = {k: v[i] for k, v in features.items()}
+                except BaseException as e:
+                    for r in sub_batch:
+                        r["error"] = e
+
+
+def fork_inference_engine(engine):
+    """
+    A shallow copy of an inference engine for one video. The configs, buffers and thread-safe
+    writers are shared, while the attributes assigned during inference and the trackers of
+    the memory pool belong to the video. Each video runs in its own thread, and the image writer
+    tracks the pending images per thread, so a video only flushes its own images.
+    """
+    forked = copy.copy(engine)
+    if isinstance(engine, nn.Module):
+        # copy.copy shares the dicts of registered submodules, buffers and parameters, thus a submodule
+        # or buffer assigned by one video would be seen by all others, the tensors are still shared
+        forked._parameters = OrderedDict(engine._parameters)
+        forked._buffers = OrderedDict(engine._buffers)
+        forked._modules = OrderedDict(
+            (name, None if module is None else fork_inference_engine(module))
+            for name, module in engine._modules.items()
+        )
+    for name, value in list(vars(forked).items()):
+        if isinstance(value, (FastOverTracker_DET, MDQE_OverTrackerEfficient)):
+            setattr(forked, name, copy.deepcopy(value))
+    return forked
+
+
+def run_batched_inference(model, videos, max_batch_frames=32, max_wait_ms=20):
+    """
+    Run several independent videos of the same task at once, each video runs its own inference
+    engine in a thread, and their clips are packed into shared backbone forward passes.
+
+    Args:
+        model: a UniVS_Prompt model in eval mode
+        videos (list[dict]): each item is the input of one video, i.e. batched_inputs[0] in `forward`
+    Returns:
+        list: the results of each video, the same as `model([video])`
+    """
+    engines = [model.get_inference_engine([video]) for video in videos]
+    if any(engine is not engines[0] for engine in engines):
+        raise ValueError("The videos of a batch should have the same task.")
+    if engines[0] is model.inference_video_semantic_extraction:
+        raise ValueError("Semantic extraction writes one shard at a time, which does not support batched videos.")
+
+    grad_enabled = torch.is_grad_enabled()
+    backbone = model.backbone
+    batched_backbone = BatchedBackbone(backbone, len(videos), max_batch_frames, max_wait_ms)
+    results = [None] * len(videos)
+    errors = [None] * len(videos)
+
+    def _run(i, video):
+        try:
+            # grad mode, autocast and the current cuda device are thread-local
+            if model.device.type == "cuda":
+                torch.cuda.set_device(model.device)
+            with torch.set_grad_enabled(grad_enabled), inference_autocast(model.device, model.inference_dtype), \
+                    profiler.video_inputs(video):
+                results[i] = fork_inference_engine(engines[i]).eval(model, [video])
+        except BaseException as e:
+            errors[i] = e
+        finally:
+            batched_backbone.release_client()
+
+    model.backbone = batched_backbone
+    try:
+        threads = [
+            threading.Thread(target=_run, args=(i, video), name=f"univs_video_{i}", daemon=True)
+            for i, video in enumerate(videos)
+        ]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+    finally:
+        model.backbone = backbone
+
+    for e in errors:
+        if e is not None:
+            raise e
+    return results
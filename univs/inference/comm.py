@@ -6,6 +6,9 @@ from scipy.optimize import linear_sum_assignment
 
 import pycocotools.mask as mask_util
 
+from univs.utils.comm import autocast_fp32
+from univs.utils.profiling import profile_region
+
 
 def generate_temporal_weights(num_frames, weights=None, enable_softmax=False, scaler=5.):
     """
@@ -22,6 +25,7 @@ def generate_temporal_weights(num_frames, weights=None, enable_softmax=False, sc
 
     return temp_w / temp_w.sum(-1).unsqueeze(-1).clamp(min=1e-3)
     
+@autocast_fp32
 def match_from_learnable_embds(tgt_embds, cur_embds, return_similarity=False, return_src_indices=False, use_norm=True, thresh=0):
     """ !! Important 
     tgt_embds: NxT_prevxC
@@ -51,7 +55,8 @@ def match_from_learnable_embds(tgt_embds, cur_embds, return_similarity=False, re
             cos_sim[cos_sim < thresh] = 0.
 
     C = (1 - cos_sim).cpu()
-    indices = linear_sum_assignment(C)  # target x current
+    with profile_region("matching"):
+        indices = linear_sum_assignment(C)  # target x current
     cos_sim = cos_sim[indices]
     if not return_src_indices:
         indices = indices[1]  # permutation that makes current aligns to target
@@ -61,6 +66,21 @@ def match_from_learnable_embds(tgt_embds, cur_embds, return_similarity=False, re
     else:
         return indices
 
+@autocast_fp32
+def bisoftmax_similarity(tgt_embds, cur_embds, thresh=0):
+    """
+    the bi-softmax similarity (also called as quasi_track) between entities
+    tgt_embds: NxT_prevxC
+    cur_embds: MxT_clipxC
+    out: NxM
+    """
+    sim = torch.einsum('ntc,mfc->nmtf', tgt_embds, cur_embds).flatten(2)  # N, M, K
+    sim_bi = (sim.softmax(1) + sim.softmax(0)).mean(-1) / 2.
+    sim_bi[sim_bi < thresh] = 0
+
+    return sim_bi
+
+@autocast_fp32
 def check_consistency_with_prev_frames(
     prev_embds, cur_embds, sim_threshold=0.5, return_similarity=False, use_norm=True
 ):
@@ -205,3 +225,69 @@ def calculate_mask_temporal_consistency_scores(scores):
         scores[t] *= w 
     
     return scores
+
+
+class OnlineClipAverager:
+    """
+    Streaming accumulator for the clip-by-clip inference of MinVIS-like trackers, where clips are 
+    sampled with a stride of one frame. The predictions of each (already matched) clip are folded 
+    into a running sum/count of the frames in the window, and a frame is finalized once it leaves 
+    the window, i.e. no later clip covers it. Compared to keeping the masks of all clips and averaging 
+    overlapping frames at the end, the memory of overlapping frames is bounded by the clip length.
+
+    finalized_device: the device to store the finalized frames, e.g. "cpu" to save GPU memory
+    The running sums are kept in fp32, while the finalized frames are stored in the dtype of the 
+    input masks, e.g. fp16/bf16 with reduced-precision inference.
+    """
+
+    def __init__(self, finalized_device=None):
+        self.finalized_device = finalized_device
+        self.num_clips = 0
+        self.logits_sum = None
+        self.window_start = 0
+        self.window_sums = []    # running sum of masks per frame in the window, t * [q h w]
+        self.window_counts = []  # the number of clips covering each frame in the window
+        self.finalized_masks = []
+        self.finalized_dtype = None
+
+    def _finalize_frames(self, end_idx):
+        while self.window_start < end_idx and len(self.window_sums):
+            m = self.window_sums.pop(0) / self.window_counts.pop(0)
+            m = m.to(device=self.finalized_device, dtype=self.finalized_dtype)
+            self.finalized_masks.append(m)
+            self.window_start += 1
+
+    def update(self, start_idx, pred_logits, pred_masks):
+        """
+        start_idx: the index of the first frame of the clip in the video
+        pred_logits: QxK, the classification logits of the clip
+        pred_masks: QxTxHxW, the mask logits of the clip
+        """
+        assert start_idx >= self.window_start, "Clips should be processed in the temporal order."
+        # the frames before the current clip will never be covered by later clips
+        self._finalize_frames(start_idx)
+        self.window_start = start_idx
+        self.finalized_dtype = pred_masks.dtype
+
+        for t in range(pred_masks.shape[1]):
+            v = t + start_idx - self.window_start
+            if v < len(self.window_sums):
+                self.window_sums[v] += pred_masks[:, t]
+                self.window_counts[v] += 1
+            else:
+                self.window_sums.append(pred_masks[:, t].to(torch.float, copy=True))
+                self.window_counts.append(1)
+
+        self.logits_sum = pred_logits.float() if self.logits_sum is None else self.logits_sum + pred_logits
+        self.num_clips += 1
+
+    def finalize(self):
+        """
+        Returns:
+            the averaged logits (QxK) over all clips, and the averaged masks (QxVxHxW) of all frames
+        """
+        self._finalize_frames(self.window_start + len(self.window_sums))
+        out_logits = self.logits_sum / self.num_clips
+        out_masks = torch.stack(self.finalized_masks, dim=1)  # v * [q h w] -> q v h w
+        self.finalized_masks = []
+        return out_logits, out_masks
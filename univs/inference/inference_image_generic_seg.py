@@ -27,6 +27,7 @@ from univs import (
     build_clip_language_encoder,
     )
 from univs.utils.comm import convert_mask_to_box, calculate_mask_quality_scores
+from univs.utils.profiling import profile_region
 from univs.prepare_targets import PrepareTargets
 
 from datasets.concept_emb.combined_datasets_category_info import combined_datasets_category_info
@@ -210,8 +211,10 @@ class InferenceImageGenericSegmentation(nn.Module):
             raise ValueError(f'do not support the model inference on {dataset_name}.')
     
     def inference_image(self, model, batched_inputs, images, targets):
-        features = model.backbone(images.tensor)
-        outputs = model.sem_seg_head(features, targets=targets)
+        with profile_region("backbone"):
+            features = model.backbone(images.tensor)
+        with profile_region("sem_seg_head"):
+            outputs = model.sem_seg_head(features, targets=targets)
         del outputs['aux_outputs']
 
         dataset_name = batched_inputs[0]['dataset_name']
@@ -303,18 +306,29 @@ class InferenceImageGenericSegmentation(nn.Module):
     
         return semseg
 
+    def thing_ids(self, device):
+        # contiguous ids of thing categories, as a tensor for the vectorized membership tests
+        return torch.as_tensor(
+            list(self.metadata.thing_dataset_id_to_contiguous_id.values()), dtype=torch.long, device=device
+        )
+
     def panoptic_inference(self, mask_cls, mask_pred):
+        thing_ids = self.thing_ids(mask_cls.device)
         if self.prompt_as_queries:
             # remove the predicted semantic masks with thing categories
-            is_thing_idxs = self.metadata.thing_dataset_id_to_contiguous_id.values()
-            mask_cls = torch.stack([m for i, m in enumerate(mask_cls) 
-                                    if i < self.num_queries or i-self.num_queries not in is_thing_idxs])
-            mask_pred = torch.stack([s for i, s in enumerate(mask_pred) 
-                                    if i < self.num_queries or i-self.num_queries not in is_thing_idxs])
+            query_idxs = torch.arange(mask_cls.shape[0], device=mask_cls.device)
+            is_thing = (query_idxs[:, None] - self.num_queries == thing_ids[None]).any(-1)
+            keep = (query_idxs < self.num_queries) | ~is_thing
+            mask_cls = mask_cls[keep]
+            mask_pred = mask_pred[keep]
         
         nms_enable = True
         if nms_enable:
-            mask_cls, mask_pred, _ = self.postprocess_nms(mask_cls, mask_pred, biou_threshold=0.9)
+            # masks with low scores are removed below, skip them before computing their boxes,
+            # they can only suppress masks with lower scores in NMS
+            mask_cls, mask_pred, _ = self.postprocess_nms(
+                mask_cls, mask_pred, biou_threshold=0.9, score_threshold=self.object_mask_threshold
+            )
 
         scores, labels = mask_cls.max(-1)
         mask_pred = mask_pred.sigmoid()
@@ -333,73 +347,79 @@ class InferenceImageGenericSegmentation(nn.Module):
         panoptic_seg = torch.zeros((h, w), dtype=torch.int32, device=cur_masks.device)
         segments_info = []
 
-        current_segment_id = 0
-
         if num_masks == 0:
             # We didn't detect any mask :(
             return panoptic_seg, segments_info
         else:
             # take argmax
             cur_mask_ids = cur_prob_masks.argmax(0)  # NHW -> HW
+            # the pixels assigned to a mask, which are also in the binary mask of itself
+            cur_binary_masks = cur_masks >= 0.5
+            is_fg = cur_binary_masks.gather(0, cur_mask_ids[None])[0]
+
+            # areas of all masks at once: assigned pixels, binary mask and their intersection
+            mask_areas = torch.bincount(cur_mask_ids.flatten(), minlength=num_masks)
+            original_areas = cur_binary_masks.flatten(1).sum(-1)
+            inter_areas = torch.bincount(cur_mask_ids[is_fg], minlength=num_masks)
+            valid = (mask_areas > 0) & (original_areas > 0) & (inter_areas > 0) & \
+                    (mask_areas.double() / original_areas.double().clamp(min=1) >= self.overlap_threshold)
+            is_thing = (cur_classes[:, None] == thing_ids[None]).any(-1)
+
+            # segment ids in the order of masks, stuff masks with the same category share the first segment id
+            segment_ids = [0] * num_masks
             stuff_memory_list = {}
-            nk = 0
-            for k in range(num_masks):
-                pred_class = cur_classes[k].item()
-                isthing = int(pred_class) in self.metadata.thing_dataset_id_to_contiguous_id.values()
-                mask_area = (cur_mask_ids == k).sum().item()
-                original_area = (cur_masks[k] >= 0.5).sum().item()
-                mask = (cur_mask_ids == k) & (cur_masks[k] >= 0.5)
-
-                if mask_area > 0 and original_area > 0 and mask.sum().item() > 0:
-                    if mask_area / original_area < self.overlap_threshold:
+            current_segment_id = 0
+            for k, (is_valid, isthing, pred_class) in enumerate(
+                zip(valid.tolist(), is_thing.tolist(), cur_classes.tolist())
+            ):
+                if not is_valid:
+                    continue
+                # merge stuff regions
+                if not isthing:
+                    if pred_class in stuff_memory_list:
+                        segment_ids[k] = stuff_memory_list[pred_class]
                         continue
-                    nk += 1
-                    # merge stuff regions
-                    if not isthing:
-                        if int(pred_class) in stuff_memory_list.keys():
-                            panoptic_seg[mask] = stuff_memory_list[int(pred_class)]
-                            continue
-                        else:
-                            stuff_memory_list[int(pred_class)] = current_segment_id + 1
-
-                    current_segment_id += 1
-                    panoptic_seg[mask] = current_segment_id
-
-                    segments_info.append(
-                        {
-                            "id": current_segment_id,
-                            "isthing": bool(isthing),
-                            "category_id": int(pred_class),
-                        }
-                    )
+                    stuff_memory_list[pred_class] = current_segment_id + 1
+
+                current_segment_id += 1
+                segment_ids[k] = current_segment_id
+                segments_info.append(
+                    {
+                        "id": current_segment_id,
+                        "isthing": bool(isthing),
+                        "category_id": int(pred_class),
+                    }
+                )
+
+            # paste all segments at once, the pixels of a mask are disjoint with other masks
+            segment_ids = torch.as_tensor(segment_ids, dtype=torch.int32, device=cur_masks.device)
+            panoptic_seg = torch.where(is_fg, segment_ids[cur_mask_ids], panoptic_seg)
            
             return panoptic_seg, segments_info
 
     def instance_inference(self, mask_cls, mask_pred, out_size):
         # mask_pred is already processed to have the same shape as original input
         image_size = mask_pred.shape[-2:]
-        box_pred = convert_mask_to_box(mask_pred.gt(0)) 
         if self.prompt_as_queries:
             mask_cls = mask_cls[:self.num_queries]
             mask_pred = mask_pred[:self.num_queries]
-            box_pred = box_pred[:self.num_queries]
         
         # if this is panoptic segmentation, we only keep the "thing" classes
         if len(self.metadata.thing_dataset_id_to_contiguous_id) != mask_cls.shape[-1]:
             # used in original Mask2Former
+            thing_ids = self.thing_ids(mask_cls.device)
             labels = mask_cls.max(-1)[1]
-            mask_cls = mask_cls[..., list(self.metadata.thing_dataset_id_to_contiguous_id.values())]
+            mask_cls = mask_cls[..., thing_ids]
 
-            keep = torch.zeros_like(labels).bool()
-            for i, lab in enumerate(labels):
-                keep[i] = int(lab) in self.metadata.thing_dataset_id_to_contiguous_id.values()
+            keep = (labels[:, None] == thing_ids[None]).any(-1)
             if keep.sum() == 0:
                 scores = mask_cls.max(-1)[0]
                 keep = scores >= min(0.1, scores.max())
 
             mask_cls = mask_cls[keep]
             mask_pred = mask_pred[keep]
-            box_pred = box_pred[keep]
+        # boxes of the remaining masks only
+        box_pred = convert_mask_to_box(mask_pred.gt(0))
         
         nms_enable = True
         if nms_enable:
@@ -433,7 +453,19 @@ class InferenceImageGenericSegmentation(nn.Module):
 
         return result
     
-    def postprocess_nms(self, scores, mask_pred, box_pred=None, biou_threshold=0.85):
+    def postprocess_nms(self, scores, mask_pred, box_pred=None, biou_threshold=0.85, score_threshold=None):
+        """
+        Box NMS per category, where boxes are derived from masks.
+        Args:
+            score_threshold: if given, masks with max scores <= score_threshold are removed before NMS,
+                which keeps the same outputs for the masks above the threshold and skips their boxes
+        """
+        if score_threshold is not None:
+            keep = scores.max(-1)[0] > score_threshold
+            scores = scores[keep]
+            mask_pred = mask_pred[keep]
+            if box_pred is not None:
+                box_pred = box_pred[keep]
         if box_pred is None:
             box_pred = convert_mask_to_box(mask_pred.gt(0.))
         scores_nms, labels_nms = scores.max(-1)
@@ -447,4 +479,4 @@ class InferenceImageGenericSegmentation(nn.Module):
         mask_pred = mask_pred[keep_by_nms]
         box_pred = box_pred[keep_by_nms]
 
-        return scores, mask_pred, box_pred
\ No newline at end of file
+        return scores, mask_pred, box_pred
@@ -34,13 +34,18 @@ from univs import (
     FastOverTracker_DET,
     )
 from univs.data.datasets import _get_vspw_vss_metadata, _get_vipseg_panoptic_metadata_val
-from univs.utils.comm import convert_mask_to_box, calculate_mask_quality_scores, video_box_iou, batched_mask_iou
+from univs.utils.comm import (
+    convert_mask_to_box, calculate_mask_quality_scores, video_box_iou, batched_mask_iou, get_inference_dtype,
+    upsample_mask_logits,
+)
+from univs.utils.profiling import profile_region, profiled
 from univs.prepare_targets import PrepareTargets
 
 from datasets.concept_emb.combined_datasets_category_info import combined_datasets_category_info
 from univs.utils.visualizer import VisualizerFrame
 from .comm import (
     match_from_learnable_embds, 
+    bisoftmax_similarity,
     vis_clip_instances_to_coco_json_video, 
     check_consistency_with_prev_frames, 
     generate_temporal_weights
@@ -98,6 +103,8 @@ class InferenceVideoEntity(nn.Module):
         detect_newly_interval_frames: int = 1,
         # custom videos
         custom_videos_enable: bool=False,
+        # reduced precision
+        precision: str="fp32",
     ):
         """
         Args:
@@ -109,6 +116,7 @@ class InferenceVideoEntity(nn.Module):
             pixel_mean, pixel_std: list or tuple with #channels element, representing
                 the per-channel mean and std to be used to normalize the input image
             test_topk_per_image: int, instance segmentation parameter, keep topk instances per image
+            precision: "fp32", "fp16" or "bf16", the dtype of mask logits stored in the memory pool
         """
         super().__init__()
 
@@ -162,6 +170,7 @@ class InferenceVideoEntity(nn.Module):
 
         self.output_dir = output_dir
         self.custom_videos_enable = custom_videos_enable
+        self.memory_dtype = get_inference_dtype(precision) or torch.float
         self.visualize_results_enable = True if custom_videos_enable else False
         self.visualizer = visualization_query_embds(
             reduced_type='pca',
@@ -228,6 +237,7 @@ class InferenceVideoEntity(nn.Module):
             "detect_newly_interval_frames": cfg.MODEL.UniVS.TEST.DETECT_NEWLY_INTERVAL_FRAMES,
             # custom videos
             "custom_videos_enable": cfg.MODEL.UniVS.TEST.CUSTOM_VIDEOS_ENABLE,
+            "precision": cfg.MODEL.UniVS.TEST.PRECISION,
         }
 
     @property
@@ -309,11 +319,13 @@ class InferenceVideoEntity(nn.Module):
             if i + self.num_frames > end_idx_window:
                 start_idx_window, end_idx_window = i, i + self.num_frames_window_test
                 frame_idx_window = range(start_idx_window, end_idx_window)
-                features_window = model.backbone(images_tensor[start_idx_window:end_idx_window])
+                with profile_region("backbone"):
+                    features_window = model.backbone(images_tensor[start_idx_window:end_idx_window])
 
             features = {k: v[frame_idx_window.index(i):frame_idx_window.index(i)+self.num_frames]
                         for k, v in features_window.items()}
-            out = model.sem_seg_head(features, targets=targets)
+            with profile_region("sem_seg_head"):
+                out = model.sem_seg_head(features, targets=targets)
             del out['aux_outputs']
 
             # map logits into [0, 1]
@@ -430,6 +442,7 @@ class InferenceVideoEntity(nn.Module):
         else:
             raise ValueError(f"Not support to eval the dataset {dataset_name} yet")
     
+    @profiled("tracker_update")
     def write_prompt_predictions_into_annotations_per_clip(self, first_frame_idx, out, targets, interim_size, image_size, stride):
         """
         Write predictions per clip into annotations, which can be viewd as the pseudo ground-truth annotations
@@ -507,7 +520,7 @@ class InferenceVideoEntity(nn.Module):
             gt_mask_quality_scores[is_consistency] += mask_quality_scores[is_consistency] 
             
         targets_per_video['logits'] = gt_logits
-        targets_per_video['masks'] = gt_mask_logits.gt(0.).float()
+        targets_per_video['masks'] = gt_mask_logits.gt(0.).to(gt_mask_logits.dtype)
         targets_per_video['mask_logits'] = gt_mask_logits
         targets_per_video['boxes'] = gt_boxes
         targets_per_video['embds'] = gt_embds
@@ -561,7 +574,7 @@ class InferenceVideoEntity(nn.Module):
             else:
                  # Calculate rank of query embeds
                 pred_embds_one_hot = (pred_embds.mean(1)*1000).softmax(-1)
-                emb_one_hot_rank = np.linalg.matrix_rank(pred_embds_one_hot.cpu().numpy())
+                emb_one_hot_rank = np.linalg.matrix_rank(pred_embds_one_hot.float().cpu().numpy())
                 # print(f"The rank of the matrix with shape {pred_embds.shape} is: {emb_one_hot_rank}")
                 emb_one_hot_sim = torch.mm(pred_embds_one_hot[sorted_indices], pred_embds_one_hot[sorted_indices].t())
                 max_sim = torch.triu(emb_one_hot_sim, diagonal=1).max(0)[0]
@@ -591,10 +604,9 @@ class InferenceVideoEntity(nn.Module):
 
             tgt_embds = gt_embds[:, -3:]
             if self.use_quasi_track:
-                sim = torch.einsum('ntc,mfc->nmtf', tgt_embds, pred_embds).flatten(2)  # N_gt, N_pred, K
-                sim_bi = (sim.softmax(1) + sim.softmax(0)).mean(-1) / 2. 
-                sim_bi[sim_bi < self.detect_newly_object_threshold] = 0
-                indices = linear_sum_assignment((1 - sim_bi).cpu())
+                sim_bi = bisoftmax_similarity(tgt_embds, pred_embds, thresh=self.detect_newly_object_threshold)
+                with profile_region("matching"):
+                    indices = linear_sum_assignment((1 - sim_bi).cpu())
                 matched_sim = sim_bi[indices]
             else:
                 indices, matched_sim = match_from_learnable_embds(
@@ -629,7 +641,7 @@ class InferenceVideoEntity(nn.Module):
                 gt_mask_quality_scores[matched_tgt_indices] += mask_quality_scores[matched_pred_indices]
 
                 targets_per_video['mask_logits'] = gt_mask_logits
-                targets_per_video['masks'] = gt_mask_logits.gt(0.).float()
+                targets_per_video['masks'] = gt_mask_logits.gt(0.).to(gt_mask_logits.dtype)
                 targets_per_video['occurence'] = gt_occurrence
                 targets_per_video["mask_quality_scores"] = gt_mask_quality_scores
             
@@ -709,10 +721,9 @@ class InferenceVideoEntity(nn.Module):
 
             tgt_embds = gt_embds[:, -3:]
             if self.use_quasi_track:
-                sim = torch.einsum('ntc,mfc->nmtf', tgt_embds, pred_embds).flatten(2)  # N_gt, N_pred, K
-                sim_bi = (sim.softmax(1) + sim.softmax(0)).mean(-1) / 2. 
-                sim_bi[sim_bi < self.detect_newly_object_threshold] = 0  # Important!!
-                indices = linear_sum_assignment((1 - sim_bi).cpu())
+                sim_bi = bisoftmax_similarity(tgt_embds, pred_embds, thresh=self.detect_newly_object_threshold)  # Important!!
+                with profile_region("matching"):
+                    indices = linear_sum_assignment((1 - sim_bi).cpu())
                 matched_sim = sim_bi[indices]
             else:
                 indices, matched_sim = match_from_learnable_embds(
@@ -742,7 +753,7 @@ class InferenceVideoEntity(nn.Module):
             targets_per_video['logits'] = gt_logits
             targets_per_video['embds'] = gt_embds
             targets_per_video['mask_logits'] = gt_mask_logits
-            targets_per_video['masks'] = gt_mask_logits.gt(0.).float()
+            targets_per_video['masks'] = gt_mask_logits.gt(0.).to(gt_mask_logits.dtype)
             targets_per_video['occurrence'] = gt_occurrence
             targets_per_video["mask_quality_scores"] = gt_mask_quality_scores
 
@@ -764,6 +775,7 @@ class InferenceVideoEntity(nn.Module):
         out_learn['pred_boxes'] = pred_boxes[newly_indices]
         out_learn['mask_quality_scores'] = mask_quality_scores[newly_indices]
     
+    @profiled("tracker_update")
     def write_newly_entities_into_annotations_per_clip(self, first_frame_idx, out, targets, interim_size):
         """
         Write annotated masks for these objects that appear in the first frame into the annotation Dict
@@ -798,7 +810,7 @@ class InferenceVideoEntity(nn.Module):
             targets_per_video.update({
                 "logits": pred_logits, 
                 "masks": pred_masks.gt(0.),  
-                "mask_logits": pred_masks,  
+                "mask_logits": pred_masks.to(self.memory_dtype),  
                 "boxes": pred_boxes,  
                 "embds": pred_embds, 
                 "ids":   pred_ids,
@@ -824,13 +836,13 @@ class InferenceVideoEntity(nn.Module):
             # zero-vector padding to keep consistency with annotations
             gt_logits_pad = torch.zeros([_num_instance_newly, gt_logits.shape[1]-pred_logits.shape[1], gt_logits.shape[-1]], dtype=torch.float, device=self.device)
             mask_shape = [_num_instance_newly, gt_masks.shape[1]-num_frames, interim_size[0], interim_size[1]]
-            gt_masks_pad = torch.zeros(mask_shape, dtype=torch.float, device=self.device)
+            gt_masks_pad = torch.zeros(mask_shape, dtype=self.memory_dtype, device=self.device)
             gt_boxes_pad = torch.zeros([_num_instance_newly, gt_boxes.shape[1]-num_frames, 4], dtype=torch.float32, device=self.device)
             gt_embds_pad = torch.zeros([_num_instance_newly, gt_embds.shape[1]-pred_embds.shape[1], self.hidden_dim], dtype=torch.float32, device=self.device)
             gt_occurrence_pad = torch.zeros([_num_instance_newly, gt_occurrence.shape[1]-pred_occurrence.shape[1]], device=self.device)
             
             gt_logits_newly = torch.cat([gt_logits_pad, pred_logits], dim=1)
-            gt_masks_newly = torch.cat([gt_masks_pad, pred_masks], dim=1)
+            gt_masks_newly = torch.cat([gt_masks_pad, pred_masks.to(self.memory_dtype)], dim=1)
             gt_boxes_newly = torch.cat([gt_boxes_pad, pred_boxes], dim=1)
             gt_embds_newly = torch.cat([gt_embds_pad, pred_embds], dim=1)
             gt_ids_newly = torch.arange(_num_instance_newly, device=self.device) + len(gt_ids)
@@ -890,7 +902,7 @@ class InferenceVideoEntity(nn.Module):
 
         # zero-vector padding to keep consistency with annotations
         mask_shape = [_num_instance, stride, gt_masks.shape[-2], gt_masks.shape[-1]]
-        gt_masks_pad = torch.zeros(mask_shape, dtype=torch.float, device=self.device)
+        gt_masks_pad = torch.zeros(mask_shape, dtype=gt_mask_logits.dtype, device=self.device)
         gt_boxes_pad = torch.zeros([_num_instance, stride, 4], dtype=torch.float32, device=self.device)
         gt_embds_pad = torch.mean(gt_embds[:, -3:], dim=1, keepdim=True).clone()
         gt_occurrence_pad = torch.zeros([_num_instance, stride], device=self.device)
@@ -930,23 +942,19 @@ class InferenceVideoEntity(nn.Module):
         masks = masks / occurence[..., None, None].clamp(min=1)
         
         masks = masks[:, :, : image_size[0], : image_size[1]]
-        masks = retry_if_cuda_oom(F.interpolate)(
-            masks.float(),
-            size=out_size,
-            mode="bilinear",
-            align_corners=False
-        ) 
-        masks = (masks > 0.).cpu()
+        # only the tracked entities are upsampled, frame chunk by frame chunk to the output size
+        masks = retry_if_cuda_oom(upsample_mask_logits)(masks.float(), out_size, binarize=True, out_device="cpu")
         scores = scores.cpu()
 
         results_list = []
         for i, (obj_id, s, mask) in enumerate(zip(obj_ids, scores, masks)):
-            segms = [
-                mask_util.encode(np.array(m[:, :, None], order="F", dtype="uint8"))[0]
-                for m in mask.cpu()
-            ]
-            for rle in segms:
-                rle["counts"] = rle["counts"].decode("utf-8")
+            with profile_region("rle_encoding"):
+                segms = [
+                    mask_util.encode(np.array(m[:, :, None], order="F", dtype="uint8"))[0]
+                    for m in mask.cpu()
+                ]
+                for rle in segms:
+                    rle["counts"] = rle["counts"].decode("utf-8")
 
             res = {
                 "obj_id": int(obj_id),
@@ -1337,7 +1345,7 @@ class InferenceVideoEntity(nn.Module):
                 embds = embds / torch.norm(embds, dim=-1, keepdim=True)
                 embds = embds.clamp(min=0.)
                 embds = embds / torch.max(embds, dim=-1, keepdim=True)[0].clamp(min=1e-3)
-                embds_np = embds.t().cpu().numpy()
+                embds_np = embds.t().float().cpu().numpy()
                 # embds_np = (embds_np * 255).astype(np.uint8)
 
                 save_by_category = True
@@ -23,6 +23,7 @@ from detectron2.data import MetadataCatalog
 from detectron2.modeling.postprocessing import sem_seg_postprocess
 from detectron2.structures import Boxes, ImageList, Instances, BitMasks
 from detectron2.utils.memory import retry_if_cuda_oom
+import detectron2.utils.comm as comm
 
 from mask2former.utils.box_ops import box_xyxy_to_cxcywh
 from univs import (
@@ -35,7 +36,9 @@ from univs import (
     FastOverTracker_DET,
     )
 from univs.data.datasets import _get_vspw_vss_metadata, _get_vipseg_panoptic_metadata_val
+from univs.data.semantic_feature_store import SemanticFeatureShardWriter
 from univs.utils.comm import convert_mask_to_box, calculate_mask_quality_scores, video_box_iou, batched_mask_iou
+from univs.utils.profiling import profile_region
 from univs.prepare_targets import PrepareTargets
 
 from datasets.concept_emb.combined_datasets_category_info import combined_datasets_category_info
@@ -78,6 +81,10 @@ class InferenceVideoSemanticExtraction(nn.Module):
         semantic_extraction_compression_ratio: int = 8,
         semantic_extraction_compression_ratio_temporal: int=1,
         semantic_extraction_output_dir: str='',
+        semantic_extraction_output_format: str='shard',
+        semantic_extraction_storage_dtype: str='float16',
+        semantic_extraction_compression: str='',
+        semantic_extraction_shard_max_size_mb: int=4096,
     ):
         """
         Args:
@@ -114,6 +121,13 @@ class InferenceVideoSemanticExtraction(nn.Module):
         self.semantic_extraction_compression_ratio = semantic_extraction_compression_ratio
         self.semantic_extraction_compression_ratio_temporal = semantic_extraction_compression_ratio_temporal
         self.semantic_extraction_output_dir = semantic_extraction_output_dir
+        assert semantic_extraction_output_format in {"shard", "pt"}, \
+            f"Unsupported output format {semantic_extraction_output_format}."
+        self.semantic_extraction_output_format = semantic_extraction_output_format
+        self.semantic_extraction_storage_dtype = semantic_extraction_storage_dtype
+        self.semantic_extraction_compression = semantic_extraction_compression
+        self.semantic_extraction_shard_max_size_mb = semantic_extraction_shard_max_size_mb
+        self.shard_writer = None
        
     @classmethod
     def from_config(cls, cfg):
@@ -139,6 +153,10 @@ class InferenceVideoSemanticExtraction(nn.Module):
             "semantic_extraction_compression_ratio": cfg.MODEL.UniVS.TEST.SEMANTIC_EXTRACTION.COMPRESSION_RATIO,
             "semantic_extraction_compression_ratio_temporal": cfg.MODEL.UniVS.TEST.SEMANTIC_EXTRACTION.COMPRESSION_RATIO_TEMPORAL,
             "semantic_extraction_output_dir": cfg.MODEL.UniVS.TEST.SEMANTIC_EXTRACTION.OUTPUT_DIR,
+            "semantic_extraction_output_format": cfg.MODEL.UniVS.TEST.SEMANTIC_EXTRACTION.OUTPUT_FORMAT,
+            "semantic_extraction_storage_dtype": cfg.MODEL.UniVS.TEST.SEMANTIC_EXTRACTION.STORAGE_DTYPE,
+            "semantic_extraction_compression": cfg.MODEL.UniVS.TEST.SEMANTIC_EXTRACTION.COMPRESSION,
+            "semantic_extraction_shard_max_size_mb": cfg.MODEL.UniVS.TEST.SEMANTIC_EXTRACTION.SHARD_MAX_SIZE_MB,
         }
 
     @property
@@ -159,9 +177,11 @@ class InferenceVideoSemanticExtraction(nn.Module):
         Returns:
             list[dict]: each dict has the results for one image.
         """
+        # apply the temporal stride before the backbone, so that the skipped frames are never processed
+        t_itv = self.semantic_extraction_compression_ratio_temporal
         images = []
         for video in batched_inputs:
-            for frame in video["image"]:
+            for frame in video["image"][::t_itv]:
                 images.append(frame.to(self.device))
         images_norm = [(x - self.pixel_mean) / self.pixel_std for x in images]
         if self.LSJ_aug_enable_test:
@@ -178,21 +198,83 @@ class InferenceVideoSemanticExtraction(nn.Module):
         
         return self.inference_video(model, batched_inputs, images_norm, targets)
         
+    @staticmethod
+    def compression_grid(feature_size, interim_size, image_size, compression_size, device):
+        """
+        The sampling grid to resample mask features from feature resolution to the compression size
+        in one step. It is equivalent to bilinear upsampling to the padded size, cropping the padding
+        and nearest downsampling to the compression size, without the full-resolution intermediate.
+
+        Returns:
+            Tensor: with shape (1, H_c, W_c, 2) for F.grid_sample(align_corners=False)
+        """
+        coords = []
+        for l_img, l_interim, l_c in zip(image_size, interim_size, compression_size):
+            # the pixels picked by nearest downsampling, in the cropped (unpadded) image
+            idxs = (torch.arange(l_c, dtype=torch.float64, device=device) * (l_img / l_c)).floor()
+            idxs = idxs.clamp(max=l_img - 1)
+            # pixel centers of the padded image, normalized to [-1, 1]
+            coords.append((2 * idxs + 1) / l_interim - 1)
+        grid_y, grid_x = torch.meshgrid(coords[0], coords[1], indexing="ij")
+        return torch.stack([grid_x, grid_y], dim=-1).float()[None]
+
+    def get_output_dir(self, targets):
+        if self.semantic_extraction_output_dir is None or len(self.semantic_extraction_output_dir) == 0:
+            # "..../video_name/frame_name.jpg"
+            video_path = '/'.join(targets[0]['file_names'][0].split('/')[:-2])
+            # datasets/internvid/raw/InternVId-FLT_1/---3UsVESJA_00:03:31.638_00:03:41.638.mp4/
+            return video_path.replace('raw', 'semantic_extraction')
+        return self.semantic_extraction_output_dir
+
+    def get_shard_writer(self, out_dir):
+        s_itv = self.semantic_extraction_compression_ratio
+        t_itv = self.semantic_extraction_compression_ratio_temporal
+        if self.shard_writer is None or self.shard_writer.out_dir != out_dir:
+            if self.shard_writer is not None:
+                self.shard_writer.close()
+            # one writer per process, the shards can not be appended by multiple processes
+            self.shard_writer = SemanticFeatureShardWriter(
+                out_dir,
+                prefix=f"semantic_features_{s_itv}_{t_itv}_rank{comm.get_rank()}",
+                dtype=self.semantic_extraction_storage_dtype,
+                compression=self.semantic_extraction_compression,
+                max_shard_size_mb=self.semantic_extraction_shard_max_size_mb,
+            )
+        return self.shard_writer
+
     def inference_video(self, model, batched_inputs, images, targets):
         images_tensor = images.tensor
         video_len = int(batched_inputs[0]["video_len"])
         assert "video_id" in batched_inputs[0]
         video_id = batched_inputs[0]["video_id"]
+        s_itv = self.semantic_extraction_compression_ratio
+        t_itv = self.semantic_extraction_compression_ratio_temporal
+        # the original indices of the frames kept after the temporal stride
+        frame_ids = torch.arange(0, video_len, t_itv)
+        assert len(images_tensor) == len(frame_ids)
         
         # masks size
         interim_size = images_tensor.shape[-2:]
         image_size = images.image_sizes[0]  # image size without padding after data augmentation
         out_height = batched_inputs[0].get("height", image_size[0])  # raw image size before data augmentation
         out_width = batched_inputs[0].get("width", image_size[1])  # raw image size before data augmentation
-        out_size = (out_height, out_width)
+        compression_size = (int(out_height / s_itv), int(out_width / s_itv))
 
-        obj_tokens_video = []
-        compression_mask_features_video = []
+        out_dir = self.get_output_dir(targets)
+        os.makedirs(out_dir, exist_ok=True)
+        if self.semantic_extraction_output_format == "shard":
+            # each clip is written into the shard once ready
+            writer = self.get_shard_writer(out_dir)
+            writer.begin_video(
+                video_id, video_len=video_len, height=out_height, width=out_width,
+                compression_ratio=s_itv, compression_ratio_temporal=t_itv,
+            )
+        else:
+            # the outputs of each clip are moved to cpu once ready, to release gpu memory during long videos
+            obj_tokens_video = []
+            compression_mask_features_video = []
+        num_saved_frames = 0
+        grid = None
 
         is_last = False
         start_idx_window, end_idx_window = 0, 0
@@ -203,60 +285,53 @@ class InferenceVideoSemanticExtraction(nn.Module):
                 break
 
             is_last = (i + self.num_frames) >= len(images_tensor)
-            targets[0]["first_frame_idx"] = i
-            targets[0]["frame_indices"] = torch.arange(i, min(i+self.num_frames, len(images_tensor)))
+            targets[0]["first_frame_idx"] = int(frame_ids[i])
+            targets[0]["frame_indices"] = frame_ids[i:i+self.num_frames]
 
             if i + self.num_frames > end_idx_window:
                 start_idx_window, end_idx_window = i, i + self.num_frames_window_test
                 frame_idx_window = range(start_idx_window, end_idx_window)
-                features_window = model.backbone(images_tensor[start_idx_window:end_idx_window])
+                with profile_region("backbone"):
+                    features_window = model.backbone(images_tensor[start_idx_window:end_idx_window])
 
             features = {k: v[frame_idx_window.index(i):frame_idx_window.index(i)+self.num_frames]
                         for k, v in features_window.items()}
-            out = model.sem_seg_head(features, targets=targets)
+            with profile_region("sem_seg_head"):
+                out = model.sem_seg_head(features, targets=targets)
 
             obj_tokens = out["pred_embds"]        # T, N_obj_tokens, C
             mask_features = out["mask_features"]  # T, C, H, W
-            mask_features = F.interpolate(
-                mask_features, 
-                size=interim_size, 
-                mode="bilinear", 
-                align_corners=False
-            )
-            mask_features = mask_features[..., :image_size[0], :image_size[1]]
-            
-            s_itv = self.semantic_extraction_compression_ratio
-            compression_height = int(out_height / s_itv)
-            compression_width = int(out_width / s_itv)
-            compression_mask_features = F.interpolate(
-                mask_features,
-                size=(compression_height, compression_width), 
-                mode="nearest", 
-            )
-            
-            obj_tokens_video.append(obj_tokens)
-            compression_mask_features_video.append(compression_mask_features)
+            if grid is None:
+                grid = self.compression_grid(
+                    mask_features.shape[-2:], interim_size, image_size, compression_size, mask_features.device
+                )
+            compression_mask_features = F.grid_sample(
+                mask_features.float(),
+                grid.expand(mask_features.shape[0], -1, -1, -1),
+                mode="bilinear",
+                padding_mode="border",
+                align_corners=False,
+            )  # T, C, H/s_itv, W/s_itv
+            num_saved_frames += obj_tokens.shape[0]
+
+            if self.semantic_extraction_output_format == "shard":
+                writer.append(obj_tokens=obj_tokens, compression_mask_features=compression_mask_features)
+            else:
+                # always in fp32 regardless of the inference precision
+                obj_tokens_video.append(obj_tokens.float().cpu())
+                compression_mask_features_video.append(compression_mask_features.cpu())
         
+        assert len(frame_ids) == num_saved_frames
+        if self.semantic_extraction_output_format == "shard":
+            writer.end_video()
+            return
+
         obj_tokens_video = torch.cat(obj_tokens_video)  # T, C, N_obj_tokens
         compression_mask_features_video = torch.cat(compression_mask_features_video)  # T, C, H/32, W/32
-        assert video_len == obj_tokens_video.shape[0]
-
-        t_itv = self.semantic_extraction_compression_ratio_temporal
-        # obj_tokens_video = obj_tokens_video[::t_itv]
-        # compression_mask_features_video = compression_mask_features_video[::t_itv]
-        # print(obj_tokens_video.shape, compression_mask_features_video.shape)
 
-        # "..../video_name/frame_name.jpg"
-        video_path = '/'.join(targets[0]['file_names'][0].split('/')[:-2])
-        # datasets/internvid/raw/InternVId-FLT_1/---3UsVESJA_00:03:31.638_00:03:41.638.mp4/
-        if self.semantic_extraction_output_dir is None or len(self.semantic_extraction_output_dir) == 0:
-            out_dir = video_path.replace('raw', 'semantic_extraction')
-        else:
-            out_dir = self.semantic_extraction_output_dir
-        os.makedirs(out_dir, exist_ok=True)
         out_file_obj_tokens = os.path.join(out_dir, video_id + f"._obj_tokens_{s_itv}_{t_itv}.pt")
         out_file_compression_mask_features = os.path.join(out_dir, video_id + f"._compression_mask_features_{s_itv}_{t_itv}.pt")
         
         # Save tensor to a compressed file
-        torch.save(obj_tokens_video[::t_itv], out_file_obj_tokens) #, _use_new_zipfile_serialization=True)
-        torch.save(compression_mask_features_video[::t_itv], out_file_compression_mask_features) #, _use_new_zipfile_serialization=True)
\ No newline at end of file
+        torch.save(obj_tokens_video, out_file_obj_tokens) #, _use_new_zipfile_serialization=True)
+        torch.save(compression_mask_features_video, out_file_compression_mask_features) #, _use_new_zipfile_serialization=True)
@@ -28,7 +28,9 @@ from univs import (
     Clips, 
     MDQE_OverTrackerEfficient,
 )
-from univs.utils.comm import convert_mask_to_box, calculate_mask_quality_scores
+from univs.utils.comm import convert_mask_to_box, calculate_mask_quality_scores, get_inference_dtype, autocast_fp32, \
+    upsample_mask_logits
+from univs.utils.profiling import profile_region, profiled
 from univs.prepare_targets import PrepareTargets
 
 from datasets.concept_emb.combined_datasets_category_info import combined_datasets_category_info
@@ -77,7 +79,8 @@ class InferenceVideoVIS(nn.Module):
         num_max_inst_test: int,
         num_frames_window_test: int,
         clip_stride: int,
-
+        # reduced precision
+        precision: str="fp32",
     ):
         """
         Args:
@@ -89,6 +92,7 @@ class InferenceVideoVIS(nn.Module):
             pixel_mean, pixel_std: list or tuple with #channels element, representing
                 the per-channel mean and std to be used to normalize the input image
             test_topk_per_image: int, instance segmentation parameter, keep topk instances per image
+            precision: "fp32", "fp16" or "bf16", the dtype of mask logits stored in the tracker memory
         """
         super().__init__()
 
@@ -133,7 +137,7 @@ class InferenceVideoVIS(nn.Module):
         self.num_max_inst_test = num_max_inst_test
         self.num_frames_window_test = max(num_frames_window_test, num_frames)
         self.clip_stride = clip_stride
-        
+        self.memory_dtype = get_inference_dtype(precision) or torch.float
 
     @classmethod
     def from_config(cls, cfg):
@@ -171,6 +175,7 @@ class InferenceVideoVIS(nn.Module):
             "num_max_inst_test": cfg.MODEL.BoxVIS.TEST.NUM_MAX_INST,
             "num_frames_window_test": cfg.MODEL.BoxVIS.TEST.NUM_FRAMES_WINDOW,
             "clip_stride": cfg.MODEL.BoxVIS.TEST.CLIP_STRIDE,
+            "precision": cfg.MODEL.UniVS.TEST.PRECISION,
         }
 
     @property
@@ -229,11 +234,13 @@ class InferenceVideoVIS(nn.Module):
             if i + self.num_frames_test > end_idx_window:
                 start_idx_window, end_idx_window = i, i + self.num_frames_window_test
                 frame_idx_window = range(start_idx_window, end_idx_window)
-                features_window = model.backbone(images_tensor[start_idx_window:end_idx_window])
+                with profile_region("backbone"):
+                    features_window = model.backbone(images_tensor[start_idx_window:end_idx_window])
 
             features = {k: v[frame_idx_window.index(i):frame_idx_window.index(i)+self.num_frames_test]
                         for k, v in features_window.items()}
-            out = model.sem_seg_head(features, targets=targets)
+            with profile_region("sem_seg_head"):
+                out = model.sem_seg_head(features, targets=targets)
             del out['aux_outputs']
 
             pred_logits = out['pred_logits'][0].sigmoid() 
@@ -316,28 +323,25 @@ class InferenceVideoVIS(nn.Module):
         labels_per_video = labels[topk_indices]
         topk_indices = torch.div(topk_indices, num_classes, rounding_mode='floor')
 
-        mask_pred = mask_pred[topk_indices]
-        mask_pred = retry_if_cuda_oom(F.interpolate)(
-            mask_pred,
+        # a query may be selected with several classes, thus only the selected queries are upsampled, once
+        query_indices, inverse_indices = torch.unique(topk_indices, return_inverse=True)
+        mask_pred = mask_pred[query_indices]
+        # the mask quality only needs the sampled frames at the interim size
+        itv_t = max(int(mask_pred.shape[1] / 10.), 1)
+        sampled_mask_pred = retry_if_cuda_oom(F.interpolate)(
+            mask_pred[:, ::itv_t],
             size=interim_size,
             mode="bilinear",
             align_corners=False,
-        )  # cQ, t, H, W
-        mask_pred = mask_pred[:, :, : image_size[0], : image_size[1]]
-        itv_t = max(int(mask_pred.shape[1] / 10.), 1)
-        mask_quality_scores = calculate_mask_quality_scores(mask_pred[:, ::itv_t])
+        )[:, :, : image_size[0], : image_size[1]]  # cQ, t, H, W
+        mask_quality_scores = calculate_mask_quality_scores(sampled_mask_pred)[inverse_indices]
         scores_per_video = scores_per_video * mask_quality_scores.to(scores_per_video.device)
 
-        masks_per_video = []
-        for m in mask_pred:
-            # slower speed but memory friendly for long videos
-            m = retry_if_cuda_oom(F.interpolate)(
-                m.unsqueeze(0),
-                size=out_size,
-                mode="bilinear",
-                align_corners=False
-            ).squeeze(0) > 0.
-            masks_per_video.append(m.cpu())
+        # upsample frame chunk by frame chunk to the output size, memory friendly for long videos
+        masks = retry_if_cuda_oom(upsample_mask_logits)(
+            mask_pred, out_size, interim_size=interim_size, image_size=image_size, binarize=True, out_device="cpu"
+        )
+        masks_per_video = [masks[i] for i in inverse_indices.tolist()]
 
         scores_per_video = scores_per_video.tolist()
         labels_per_video = labels_per_video.tolist()
@@ -351,6 +355,8 @@ class InferenceVideoVIS(nn.Module):
 
         return processed_results
 
+    @profiled("matching")
+    @autocast_fp32
     def match_from_embds(self, tgt_embds, cur_embds, return_scores=False):
         cur_embds = cur_embds / cur_embds.norm(dim=-1)[..., None]
         tgt_embds = tgt_embds / tgt_embds.norm(dim=-1)[..., None]
@@ -360,7 +366,8 @@ class InferenceVideoVIS(nn.Module):
         C = 1.0 * cost_embd
         C = C.cpu()
 
-        indices = linear_sum_assignment(C)  # target x current
+        with profile_region("matching"):
+            indices = linear_sum_assignment(C)  # target x current
         cos_sim = cos_sim[indices]
         indices = indices[1]  # permutation that makes current aligns to target
 
@@ -379,7 +386,8 @@ class InferenceVideoVIS(nn.Module):
         merge_device = "cpu" if self.merge_on_cpu else self.device
         tracker = MDQE_OverTrackerEfficient(
             video_len, self.num_classes, self.num_max_inst_test, self.num_frames_test, self.num_frames_window_test,
-            self.clip_stride, self.hidden_dim, self.apply_cls_thres, merge_device, self.data_name
+            self.clip_stride, self.hidden_dim, self.apply_cls_thres, merge_device, self.data_name,
+            memory_dtype=self.memory_dtype,
         )
 
         results_window_list = []
@@ -395,11 +403,13 @@ class InferenceVideoVIS(nn.Module):
             if i + self.num_frames_test > end_idx_window:
                 start_idx_window, end_idx_window = i, i + self.num_frames_window_test
                 frame_idx_window = range(start_idx_window, end_idx_window)
-                features_window = model.backbone(images.tensor[start_idx_window:end_idx_window])
+                with profile_region("backbone"):
+                    features_window = model.backbone(images.tensor[start_idx_window:end_idx_window])
 
             features = {k: v[frame_idx_window.index(i):frame_idx_window.index(i)+self.num_frames_test]
                         for k, v in features_window.items()}
-            outputs = model.sem_seg_head(features, targets=targets)
+            with profile_region("sem_seg_head"):
+                outputs = model.sem_seg_head(features, targets=targets)
             del outputs['aux_outputs']
             if self.merge_on_cpu:
                 outputs = {k: v.cpu() for k, v in outputs.items() if not isinstance(v, list)}
@@ -524,12 +534,13 @@ class InferenceVideoVIS(nn.Module):
 
         results_per_window_list = []
         for obj_id, s, m in zip(pred_obj_ids, pred_scores, pred_masks_list):
-            segms = [
-                mask_util.encode(np.array(_mask[:, :, None], order="F", dtype="uint8"))[0]
-                for _mask in m
-            ]
-            for rle in segms:
-                rle["counts"] = rle["counts"].decode("utf-8")
+            with profile_region("rle_encoding"):
+                segms = [
+                    mask_util.encode(np.array(_mask[:, :, None], order="F", dtype="uint8"))[0]
+                    for _mask in m
+                ]
+                for rle in segms:
+                    rle["counts"] = rle["counts"].decode("utf-8")
 
             frame_id_start = cur_frame_idx + 1 - len(segms) if not is_last_clip \
                 else cur_frame_idx + self.num_frames_test - len(segms)
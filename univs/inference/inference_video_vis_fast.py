@@ -29,11 +29,12 @@ from univs import (
     Clips, 
     FastOverTracker_DET,
     )
-from univs.utils.comm import convert_mask_to_box, calculate_mask_quality_scores
+from univs.utils.comm import convert_mask_to_box, calculate_mask_quality_scores, upsample_mask_logits
+from univs.utils.profiling import profile_region
 from univs.prepare_targets import PrepareTargets
 
 from datasets.concept_emb.combined_datasets_category_info import combined_datasets_category_info
-from .comm import match_from_learnable_embds, vis_clip_instances_to_coco_json_video
+from .comm import match_from_learnable_embds, vis_clip_instances_to_coco_json_video, OnlineClipAverager
 
 
 class InferenceVideoVISFast(nn.Module):
@@ -219,6 +220,10 @@ class InferenceVideoVISFast(nn.Module):
     def inference_video_vis_minvis(self, model, batched_inputs, images, targets):
         images_tensor = images.tensor
 
+        # overlapping frames of clips are averaged online, the finalized frames are stored on merge device
+        merge_device = "cpu" if self.merge_on_cpu else self.device
+        clip_averager = OnlineClipAverager(finalized_device=merge_device)
+
         start_idx_window, end_idx_window = 0, 0
         for i in range(len(images_tensor)):
             targets[0]["frame_indices"] = torch.arange(i, i+self.num_frames)
@@ -229,11 +234,13 @@ class InferenceVideoVISFast(nn.Module):
             if i + self.num_frames > end_idx_window:
                 start_idx_window, end_idx_window = i, i + self.num_frames_window_test
                 frame_idx_window = range(start_idx_window, end_idx_window)
-                features_window = model.backbone(images_tensor[start_idx_window:end_idx_window])
+                with profile_region("backbone"):
+                    features_window = model.backbone(images_tensor[start_idx_window:end_idx_window])
 
             features = {k: v[frame_idx_window.index(i):frame_idx_window.index(i)+self.num_frames]
                         for k, v in features_window.items()}
-            out = model.sem_seg_head(features, targets=targets)
+            with profile_region("sem_seg_head"):
+                out = model.sem_seg_head(features, targets=targets)
             del out['aux_outputs']
 
             pred_logits = out['pred_logits'][0].sigmoid() 
@@ -253,37 +260,24 @@ class InferenceVideoVISFast(nn.Module):
             pred_masks = out['pred_masks'][0, :self.num_queries].float()   # QxTxHxW
             pred_embds = out['pred_embds'][0, :self.num_queries].float()   # QxTxC
             if i == 0:
-                out_logits = [pred_logits]
-                out_masks = [pred_masks]
                 out_embds = [pred_embds.mean(1)]
             else:
-                mem_embds = torch.stack(out_embds[-2:], dim=1)
+                mem_embds = torch.stack(out_embds, dim=1)
                 indices = match_from_learnable_embds(mem_embds, pred_embds)
-                out_logits.append(pred_logits[indices, :])
-                out_masks.append(pred_masks[indices, :, :, :])
-                out_embds.append(pred_embds[indices, :].mean(1))
+                pred_logits = pred_logits[indices, :]
+                pred_masks = pred_masks[indices, :, :, :]
+                out_embds = [out_embds[-1], pred_embds[indices, :].mean(1)]
+            clip_averager.update(i, pred_logits, pred_masks)
 
-        q, n_t, h, w = out_masks[0].shape
-
-        out_logits = sum(out_logits) / len(out_logits)
+        out_logits, out_masks = clip_averager.finalize()
         dataset_name = batched_inputs[0]['dataset_name']
         assert dataset_name in combined_datasets_category_info
         num_classes, start_idx = combined_datasets_category_info[dataset_name]
         mask_scores = out_logits[..., start_idx:start_idx + num_classes]
         mask_scores = mask_scores.sigmoid()    # cos_sim with L2 norm
-
-        out_masks_mean = []
-        n_clips = len(out_masks)
-        for v in range(n_clips+n_t-1):
-            n_t_valid = min(v+1, n_t)
-            m = []
-            for t in range(n_t_valid):
-                if v-t < n_clips:
-                    m.append(out_masks[v-t][:, t])  # q, h, w
-            out_masks_mean.append(torch.stack(m).mean(dim=0))  # q, h, w
             
         outputs = {}
-        outputs['pred_masks'] = torch.stack(out_masks_mean, dim=1)  # t * [q h w] -> q t h w
+        outputs['pred_masks'] = out_masks                           # q t h w
         outputs['pred_scores'] = mask_scores                        # q k
 
         # masks size
@@ -314,28 +308,25 @@ class InferenceVideoVISFast(nn.Module):
         labels_per_video = labels[topk_indices]
         topk_indices = torch.div(topk_indices, num_classes, rounding_mode='floor')
 
-        mask_pred = mask_pred[topk_indices]
-        mask_pred = retry_if_cuda_oom(F.interpolate)(
-            mask_pred,
+        # a query may be selected with several classes, thus only the selected queries are upsampled, once
+        query_indices, inverse_indices = torch.unique(topk_indices, return_inverse=True)
+        mask_pred = mask_pred[query_indices]
+        # the mask quality only needs the sampled frames at the interim size
+        itv_t = max(int(mask_pred.shape[1] / 10.), 1)
+        sampled_mask_pred = retry_if_cuda_oom(F.interpolate)(
+            mask_pred[:, ::itv_t],
             size=interim_size,
             mode="bilinear",
             align_corners=False,
-        )  # cQ, t, H, W
-        mask_pred = mask_pred[:, :, : image_size[0], : image_size[1]]
-        itv_t = max(int(mask_pred.shape[1] / 10.), 1)
-        mask_quality_scores = calculate_mask_quality_scores(mask_pred[:, ::itv_t]).clamp(min=0.1)
+        )[:, :, : image_size[0], : image_size[1]]  # cQ, t, H, W
+        mask_quality_scores = calculate_mask_quality_scores(sampled_mask_pred).clamp(min=0.1)[inverse_indices]
         scores_per_video = scores_per_video * mask_quality_scores.to(scores_per_video.device)
 
-        masks_per_video = []
-        for m in mask_pred:
-            # slower speed but memory friendly for long videos
-            m = retry_if_cuda_oom(F.interpolate)(
-                m.unsqueeze(0),
-                size=out_size,
-                mode="bilinear",
-                align_corners=False
-            ).squeeze(0) > 0.
-            masks_per_video.append(m.cpu())
+        # upsample frame chunk by frame chunk to the output size, memory friendly for long videos
+        masks = retry_if_cuda_oom(upsample_mask_logits)(
+            mask_pred, out_size, interim_size=interim_size, image_size=image_size, binarize=True, out_device="cpu"
+        )
+        masks_per_video = [masks[i] for i in inverse_indices.tolist()]
 
         scores_per_video = scores_per_video.tolist()
         labels_per_video = labels_per_video.tolist()
@@ -379,11 +370,13 @@ class InferenceVideoVISFast(nn.Module):
             if i + self.num_frames > end_idx_window:
                 start_idx_window, end_idx_window = i, i + self.num_frames_window_test
                 frame_idx_window = range(start_idx_window, end_idx_window)
-                features_window = model.backbone(images.tensor[start_idx_window:end_idx_window])
+                with profile_region("backbone"):
+                    features_window = model.backbone(images.tensor[start_idx_window:end_idx_window])
 
             features = {k: v[frame_idx_window.index(i):frame_idx_window.index(i)+self.num_frames]
                         for k, v in features_window.items()}
-            outputs = model.sem_seg_head(features, targets=targets)
+            with profile_region("sem_seg_head"):
+                outputs = model.sem_seg_head(features, targets=targets)
             del outputs['aux_outputs']
             if self.merge_on_cpu:
                 outputs = {k: v.cpu() for k, v in outputs.items() if not isinstance(v, list)}
@@ -504,12 +497,13 @@ class InferenceVideoVISFast(nn.Module):
 
         results_per_window_list = []
         for obj_id, s, m, nonblank in zip(pred_obj_ids, pred_scores, pred_masks_list, num_nonblank_masks_list):
-            segms = [
-                mask_util.encode(np.array(_mask[:, :, None], order="F", dtype="uint8"))[0]
-                for _mask in m
-            ]
-            for rle in segms:
-                rle["counts"] = rle["counts"].decode("utf-8")
+            with profile_region("rle_encoding"):
+                segms = [
+                    mask_util.encode(np.array(_mask[:, :, None], order="F", dtype="uint8"))[0]
+                    for _mask in m
+                ]
+                for rle in segms:
+                    rle["counts"] = rle["counts"].decode("utf-8")
 
             frame_id_start = cur_frame_idx + 1 - len(segms) if not is_last_clip \
                 else cur_frame_idx + self.num_frames - len(segms)
@@ -8,9 +8,7 @@ from torch.nn import functional as F
 from typing import Tuple
 # support color space pytorch, https://kornia.readthedocs.io/en/latest/_modules/kornia/color/lab.html#rgb_to_lab
 from kornia import color
-from PIL import Image
 
-import numpy as np
 import pycocotools.mask as mask_util
 import matplotlib.pyplot as plt
 from scipy.optimize import linear_sum_assignment
@@ -33,7 +31,9 @@ from univs import (
     MDQE_OverTrackerEfficient,
     )
 from univs.utils.comm import convert_mask_to_box, calculate_mask_quality_scores, box_iou, video_box_iou, batched_pair_mask_iou
+from univs.utils.profiling import profile_region
 from univs.prepare_targets import PrepareTargets
+from univs.utils.async_writer import AsyncImageWriter
 
 from datasets.concept_emb.combined_datasets_category_info import combined_datasets_category_info
 
@@ -85,6 +85,7 @@ class InferenceVideoVOS(nn.Module):
         temporal_consistency_threshold: float=0.25,
         video_unified_inference_queries: str='prompt',
         num_prev_frames_memory: int=5,
+        num_writer_workers: int=4,
     ):
         """
         Args:
@@ -96,6 +97,8 @@ class InferenceVideoVOS(nn.Module):
             pixel_mean, pixel_std: list or tuple with #channels element, representing
                 the per-channel mean and std to be used to normalize the input image
             test_topk_per_image: int, instance segmentation parameter, keep topk instances per image
+            num_writer_workers: int, the number of threads to save the predicted masks in the background,
+                0 to save them synchronously
         """
         super().__init__()
 
@@ -146,6 +149,7 @@ class InferenceVideoVOS(nn.Module):
 
         self.output_dir = output_dir
         self.use_semseg_pvos = True
+        self.writer = AsyncImageWriter(num_workers=num_writer_workers)
 
         self.visualize_results_only_enable = False
         self.visualize_query_emb_enable = False
@@ -194,6 +198,7 @@ class InferenceVideoVOS(nn.Module):
             "temporal_consistency_threshold": cfg.MODEL.UniVS.TEST.TEMPORAL_CONSISTENCY_THRESHOLD,
             "video_unified_inference_queries": cfg.MODEL.UniVS.TEST.VIDEO_UNIFIED_INFERENCE_QUERIES,
             "num_prev_frames_memory": cfg.MODEL.UniVS.TEST.NUM_PREV_FRAMES_MEMORY,
+            "num_writer_workers": cfg.MODEL.UniVS.TEST.NUM_WRITER_WORKERS,
         }
 
     @property
@@ -239,6 +244,8 @@ class InferenceVideoVOS(nn.Module):
         targets[0]['video_len'] = len(images)
 
         self.inference_video_vos(model, batched_inputs, images_norm, targets, image_size, out_size)
+        # wait for the masks of this video to be saved
+        self.writer.flush()
     
     def inference_video_vos(self, model, batched_inputs, images, targets, image_size, out_size):
         images_tensor = images.tensor
@@ -257,7 +264,8 @@ class InferenceVideoVOS(nn.Module):
             if i + self.num_frames > end_idx_window:
                 start_idx_window, end_idx_window = i, min(i + self.num_frames_window_test, video_len)
                 frame_idx_window = range(start_idx_window, end_idx_window)
-                features_window = model.backbone(images_tensor[start_idx_window:end_idx_window])
+                with profile_region("backbone"):
+                    features_window = model.backbone(images_tensor[start_idx_window:end_idx_window])
 
             # step1: write the annotated masks for objects that firstly appear, and pad targets for all objects
             self.write_targets_into_annotations_per_clip(targets, i, stride)
@@ -265,7 +273,8 @@ class InferenceVideoVOS(nn.Module):
             # step2: input images into model to obtain predictions
             features = {k: v[frame_idx_window.index(i):frame_idx_window.index(i)+self.num_frames]
                         for k, v in features_window.items()}
-            out = model.sem_seg_head(features, targets=targets)
+            with profile_region("sem_seg_head"):
+                out = model.sem_seg_head(features, targets=targets)
             del out['aux_outputs']
 
             # step3: write predictions into annotations, 
@@ -651,19 +660,16 @@ class InferenceVideoVOS(nn.Module):
             )
         pred_masks = pred_masks.gt(0.).float()
 
-        for t, m in enumerate(pred_masks.transpose(0, 1)):
-            is_bg = (m <= 0).all(0)
-            m = ids[m.argmax(0)]
-            m[is_bg] = 0
-        
-            m = m.cpu().numpy().astype(np.uint8)
-            m = Image.fromarray(m)
-            m.putpalette(targets_per_video["mask_palette"])
+        is_bg = (pred_masks <= 0).all(0)  # THW
+        id_maps = ids[pred_masks.argmax(0)]
+        id_maps[is_bg] = 0
+        id_maps = id_maps.to(torch.uint8).cpu().numpy()
 
+        # PNG encoding and file I/O are handed off to the background writer
+        for t, m in enumerate(id_maps):
             file_name = file_names[first_frame_idx+t].split('/')[-1]
             save_path = '/'.join([save_dir, file_name.replace('.jpg', '.png')])
-            m.save(save_path)
-            m.close()
+            self.writer.write(save_path, m, palette=targets_per_video["mask_palette"])
         
         if is_last and self.visualize_query_emb_enable:
             self.visualizer_query_emb.visualization_query_embds(targets)
@@ -699,15 +705,11 @@ class InferenceVideoVOS(nn.Module):
             save_dir = os.path.join(self.output_dir, 'inference/Annotations', video_name, str(id_))
             os.makedirs(save_dir, exist_ok=True)
 
+            mi = (mi * 255).to(torch.uint8).cpu().numpy()
             for t, m in enumerate(mi):
-                m = m * 255
-                m = m.cpu().numpy().astype(np.uint8)
-                m = Image.fromarray(m)
-
                 file_name = file_names[first_frame_idx+t].split('/')[-1]
                 save_path = '/'.join([save_dir, file_name.replace('.jpg', '.png')])
-                m.save(save_path)
-                m.close()
+                self.writer.write(save_path, m)
         
         if is_last and self.visualize_query_emb_enable:
             self.visualizer_query_emb.visualization_query_embds(targets)
@@ -763,4 +765,4 @@ class InferenceVideoVOS(nn.Module):
 
                 save_path = '/'.join([save_dir, file_name.replace('.png', '.jpg')])
                 VisImage = visualizer.draw_instance_predictions(results)
-                VisImage.save(save_path)
\ No newline at end of file
+                self.writer.write(save_path, VisImage.get_image())
\ No newline at end of file
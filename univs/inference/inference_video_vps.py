@@ -26,10 +26,12 @@ from univs import (
     TextPromptEncoder,
     build_clip_language_encoder,
     )
-from univs.utils.comm import convert_mask_to_box, calculate_mask_quality_scores
+from univs.utils.comm import convert_mask_to_box, calculate_mask_quality_scores, autocast_fp32
+from univs.utils.profiling import profile_region, profiled
 from univs.prepare_targets import PrepareTargets
 
 from datasets.concept_emb.combined_datasets_category_info import combined_datasets_category_info
+from .comm import OnlineClipAverager
 
 
 class InferenceVideoVPS(nn.Module):
@@ -210,6 +212,9 @@ class InferenceVideoVPS(nn.Module):
         images_tensor = images.tensor
 
         # compared to tracker in MinVIS, this is more friendly for memory
+        # overlapping frames of clips are averaged online, the finalized frames are stored on merge device
+        merge_device = "cpu" if self.merge_on_cpu else self.device
+        clip_averager = OnlineClipAverager(finalized_device=merge_device)
         start_idx_window, end_idx_window = 0, 0
         for i in range(len(images_tensor)):
             targets[0]["frame_indices"] = torch.arange(i, i+self.num_frames)
@@ -220,11 +225,13 @@ class InferenceVideoVPS(nn.Module):
             if i + self.num_frames > end_idx_window:
                 start_idx_window, end_idx_window = i, i + self.num_frames_window_test
                 frame_idx_window = range(start_idx_window, end_idx_window)
-                features_window = model.backbone(images_tensor[start_idx_window:end_idx_window])
+                with profile_region("backbone"):
+                    features_window = model.backbone(images_tensor[start_idx_window:end_idx_window])
 
             features = {k: v[frame_idx_window.index(i):frame_idx_window.index(i)+self.num_frames]
                         for k, v in features_window.items()}
-            out = model.sem_seg_head(features, targets=targets)
+            with profile_region("sem_seg_head"):
+                out = model.sem_seg_head(features, targets=targets)
             del out['aux_outputs']
 
             pred_logits = out['pred_logits'][0].sigmoid() 
@@ -251,35 +258,22 @@ class InferenceVideoVPS(nn.Module):
             pred_embds = pred_embds[:self.num_queries]
             
             if i == 0:
-                out_logits = [pred_logits]
-                out_masks = [pred_masks]
                 out_embds = [pred_embds]
             else:
-                mem_embds = torch.stack(out_embds[-2:]).mean(dim=0)
+                mem_embds = torch.stack(out_embds).mean(dim=0)
                 indices = self.match_from_embds(mem_embds, pred_embds)
-                out_logits.append(pred_logits[indices, :])
-                out_masks.append(pred_masks[indices, :, :, :])
-                out_embds.append(pred_embds[indices, :])
+                pred_logits = pred_logits[indices, :]
+                pred_masks = pred_masks[indices, :, :, :]
+                out_embds = [out_embds[-1], pred_embds[indices, :]]
+            clip_averager.update(i, pred_logits, pred_masks)
         
-        q, n_t, h, w = out_masks[0].shape
-        n_clips = len(out_masks)
-
-        out_logits = sum(out_logits) / len(out_logits)
-        out_masks_mean = []
-        for v in range(n_clips+n_t-1):
-            n_t_valid = min(v+1, n_t)
-            m = []
-            for t in range(n_t_valid):
-                if v-t < n_clips:
-                    m.append(out_masks[v-t][:, t])  # q, h, w
-            out_masks_mean.append(torch.stack(m).mean(dim=0))  # q, h, w
+        out_logits, pred_masks = clip_averager.finalize()
 
         dataset_name = batched_inputs[0]['dataset_name']
         assert dataset_name in combined_datasets_category_info
         num_classes, start_idx = combined_datasets_category_info[dataset_name]
         out_logits = out_logits[..., start_idx:start_idx + num_classes]
         pred_cls = out_logits.sigmoid()                  # q k, cos_sim with L2 norm
-        pred_masks = torch.stack(out_masks_mean, dim=1)  # t * [q h w] -> q t h w
 
          # upsample masks
         interim_size = images_tensor.shape[-2:]
@@ -292,6 +286,8 @@ class InferenceVideoVPS(nn.Module):
 
         return self.inference_video_vps_save_results(pred_cls, pred_masks, interim_size, image_size, out_size)
 
+    @profiled("matching")
+    @autocast_fp32
     def match_from_embds(self, tgt_embds, cur_embds):
         cur_embds = cur_embds / cur_embds.norm(dim=1)[:, None]
         tgt_embds = tgt_embds / tgt_embds.norm(dim=1)[:, None]
@@ -301,7 +297,8 @@ class InferenceVideoVPS(nn.Module):
         C = 1.0 * cost_embd
         C = C.cpu()
 
-        indices = linear_sum_assignment(C.transpose(0, 1))  # target x current
+        with profile_region("matching"):
+            indices = linear_sum_assignment(C.transpose(0, 1))  # target x current
         indices = indices[1]  # permutation that makes current aligns to target
 
         return indices
@@ -359,8 +356,15 @@ class InferenceVideoVPS(nn.Module):
             cur_mask_ids = F.interpolate(
                 cur_mask_ids.float().unsqueeze(0), size=out_size, mode="nearest", 
             ).long().squeeze(0)
+            # the areas of all masks at once (the background is -1), masks that win no pixel
+            # in the argmax are never pasted, thus they are not upsampled at all
+            mask_areas = torch.bincount(cur_mask_ids.flatten() + 1, minlength=len(cur_masks) + 1)[1:].tolist()
             stuff_memory_list = {}
             for k in range(cur_classes.shape[0]):
+                mask_area = mask_areas[k]
+                if mask_area == 0:
+                    continue
+
                 # memory friendly
                 cur_masks_k = F.interpolate(
                     cur_masks[k].unsqueeze(0), size=out_size, mode="bilinear", align_corners=False
@@ -370,7 +374,6 @@ class InferenceVideoVPS(nn.Module):
                 isthing = pred_class in self.metadata.thing_dataset_id_to_contiguous_id.keys()
                 
                 # filter out the unstable segmentation results
-                mask_area = (cur_mask_ids == k).sum().item()
                 original_area = (cur_masks_k >= 0.5).sum().item()
                 mask = (cur_mask_ids == k) & (cur_masks_k >= 0.5)
                 if mask_area > 0 and original_area > 0 and mask.sum().item() > 0:
@@ -106,7 +106,7 @@ class visualization_query_embds:
 
     def visualization_query_embds_PCA(self, data, video_name, output_dir):
         N, T, C = data.shape
-        data = data.flatten(0, -2).cpu().numpy()
+        data = data.flatten(0, -2).float().cpu().numpy()
 
         c = sum([[Colors[i]]*T for i in range(N)], [])
 
@@ -138,7 +138,7 @@ class visualization_query_embds:
         data: N x T x C, where N is the number of objects, and T is the number of frames in the video
         '''
         N, T, C = data.shape
-        data = data.flatten(0, -2).cpu().numpy()
+        data = data.flatten(0, -2).float().cpu().numpy()
 
         c = sum([[Colors[i]]*T for i in range(N)], [])
 
@@ -176,7 +176,7 @@ class visualization_query_embds:
             if s < self.apply_cls_thres:
                 continue
 
-            embds_np = embds.t().cpu().numpy()
+            embds_np = embds.t().float().cpu().numpy()
 
             save_by_category = True
             if save_by_category:
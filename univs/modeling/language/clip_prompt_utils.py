@@ -420,8 +420,8 @@ def pre_tokenize(class_names):
     :param tokenizer: Tokenizer, SimpleTokenizer()
     :return: Tensor, containing all prompts for all classes, [#cls, #prompts, context_length]
     """
-    # tokenizer
-    tokenizer = SimpleTokenizer()
+    # tokenizer, shared to avoid rebuilding the BPE vocabulary per call
+    tokenizer = _tokenizer
     sot_token = tokenizer.encoder["<|startoftext|>"]
     eot_token = tokenizer.encoder["<|endoftext|>"]    
 
@@ -455,8 +455,8 @@ def pre_tokenize_expression(expressions):
     :param tokenizer: Tokenizer, SimpleTokenizer()
     :return: Tensor, containing all prompts for all classes, [#cls, #prompts, context_length]
     """
-    # tokenizer
-    tokenizer = SimpleTokenizer()
+    # tokenizer, shared to avoid rebuilding the BPE vocabulary per call
+    tokenizer = _tokenizer
     sot_token = tokenizer.encoder["<|startoftext|>"]
     eot_token = tokenizer.encoder["<|endoftext|>"]
 
@@ -8,7 +8,6 @@ import torch
 from torch import nn
 from torch.nn import functional as F
 from torch.nn.init import xavier_uniform_, constant_, uniform_, normal_
-from torch.cuda.amp import autocast
 
 from detectron2.config import configurable
 from detectron2.layers import Conv2d, ShapeSpec, get_norm
@@ -18,6 +17,8 @@ from mask2former.modeling.transformer_decoder.position_encoding import PositionE
 from mask2former.modeling.transformer_decoder.transformer import _get_clones, _get_activation_fn
 from mask2former.modeling.pixel_decoder.ops.modules import MSDeformAttn
 
+from univs.utils.comm import get_inference_dtype
+
 from .vision_lang_biattn_layers import VLFuse
 
 
@@ -192,6 +193,7 @@ class MSDeformAttnPixelDecoderVL(nn.Module):
         # deformable transformer encoder args
         transformer_in_features: List[str],
         common_stride: int,
+        inference_precision: str = "fp32",
     ):
         """
         NOTE: this interface is experimental.
@@ -204,8 +206,10 @@ class MSDeformAttnPixelDecoderVL(nn.Module):
             conv_dims: number of output channels for the intermediate conv layers.
             mask_dim: number of output channels for the final conv layer.
             norm (str or callable): normalization for all conv layers
+            inference_precision: "fp32", "fp16" or "bf16", the precision of the FPN layers at inference
         """
         super().__init__()
+        self.inference_dtype = get_inference_dtype(inference_precision)
         transformer_input_shape = {
             k: v for k, v in input_shape.items() if k in transformer_in_features
         }
@@ -325,10 +329,45 @@ class MSDeformAttnPixelDecoderVL(nn.Module):
         ] = cfg.MODEL.SEM_SEG_HEAD.TRANSFORMER_ENC_LAYERS  # a separate config
         ret["transformer_in_features"] = cfg.MODEL.SEM_SEG_HEAD.DEFORMABLE_TRANSFORMER_ENCODER_IN_FEATURES
         ret["common_stride"] = cfg.MODEL.SEM_SEG_HEAD.COMMON_STRIDE
+        ret["inference_precision"] = cfg.MODEL.UniVS.TEST.PRECISION
         return ret
 
-    @autocast(enabled=False)
     def forward_features(self, features, lang_features):
+        device_type = features[self.transformer_in_features[0]].device.type
+        # deformable detr does not support half precision, the encoder always runs in fp32
+        with torch.autocast(device_type, enabled=False):
+            lang_features, out = self.forward_encoder(features, lang_features)
+
+        # FPN layers run in fp32, unless a reduced precision is configured for inference,
+        # see MODEL.UniVS.TEST.PRECISION
+        if self.training or self.inference_dtype is None:
+            fpn_context = torch.autocast(device_type, enabled=False)
+        else:
+            fpn_context = torch.autocast(device_type, dtype=self.inference_dtype)
+
+        with fpn_context:
+            # append `out` with extra FPN levels
+            # Reverse feature maps into top-down order (from low to high resolution)
+            for idx, f in enumerate(self.in_features[:self.num_fpn_levels][::-1]):
+                x = features[f].float()
+                lateral_conv = self.lateral_convs[idx]
+                output_conv = self.output_convs[idx]
+                cur_fpn = lateral_conv(x)
+                # Following FPN implementation, we use nearest upsampling here
+                y = cur_fpn + F.interpolate(out[-1], size=cur_fpn.shape[-2:], mode="bilinear", align_corners=False)
+                y = output_conv(y)
+                out.append(y)
+
+            multi_scale_features = []
+            num_cur_levels = 0
+            for o in out:
+                if num_cur_levels < self.maskformer_num_feature_levels:
+                    multi_scale_features.append(o)
+                    num_cur_levels += 1
+
+            return self.mask_features(out[-1]), out[-1], out[0], multi_scale_features, lang_features
+
+    def forward_encoder(self, features, lang_features):
         srcs = []
         pos = []
         # Reverse feature maps into top-down order (from low to high resolution)
@@ -337,6 +376,9 @@ class MSDeformAttnPixelDecoderVL(nn.Module):
             srcs.append(self.input_proj[idx](x))
             pos.append(self.pe_layer(x))
 
+        if lang_features is not None:
+            # text features may be in half precision when they are encoded under autocast
+            lang_features = lang_features.float()
         lang_features, y, spatial_shapes, level_start_index = self.transformer(lang_features, srcs, pos)
         bs = y.shape[0]
 
@@ -349,26 +391,7 @@ class MSDeformAttnPixelDecoderVL(nn.Module):
         y = torch.split(y, split_size_or_sections, dim=1)
 
         out = []
-        multi_scale_features = []
-        num_cur_levels = 0
         for i, z in enumerate(y):
             out.append(z.transpose(1, 2).view(bs, -1, spatial_shapes[i][0], spatial_shapes[i][1]))
 
-        # append `out` with extra FPN levels
-        # Reverse feature maps into top-down order (from low to high resolution)
-        for idx, f in enumerate(self.in_features[:self.num_fpn_levels][::-1]):
-            x = features[f].float()
-            lateral_conv = self.lateral_convs[idx]
-            output_conv = self.output_convs[idx]
-            cur_fpn = lateral_conv(x)
-            # Following FPN implementation, we use nearest upsampling here
-            y = cur_fpn + F.interpolate(out[-1], size=cur_fpn.shape[-2:], mode="bilinear", align_corners=False)
-            y = output_conv(y)
-            out.append(y)
-
-        for o in out:
-            if num_cur_levels < self.maskformer_num_feature_levels:
-                multi_scale_features.append(o)
-                num_cur_levels += 1
-
-        return self.mask_features(out[-1]), out[-1], out[0], multi_scale_features, lang_features
+        return lang_features, out
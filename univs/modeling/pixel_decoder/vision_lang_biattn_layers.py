@@ -17,7 +17,11 @@ class BiMultiHeadAttention(nn.Module):
         stable_softmax_2d: bool=False,
         clamp_min_for_underflow: bool=True,
         clamp_max_for_overflow: bool=True,
+        chunk_size: int=4096,
     ):
+        """
+        chunk_size: the number of image tokens per chunk during inference, 0 to disable chunking
+        """
         super(BiMultiHeadAttention, self).__init__()
 
         self.embed_dim = embed_dim
@@ -43,6 +47,7 @@ class BiMultiHeadAttention(nn.Module):
         self.stable_softmax_2d = stable_softmax_2d
         self.clamp_min_for_underflow = clamp_min_for_underflow
         self.clamp_max_for_overflow = clamp_max_for_overflow
+        self.chunk_size = chunk_size
 
         self._reset_parameters()
 
@@ -63,6 +68,19 @@ class BiMultiHeadAttention(nn.Module):
     def _shape(self, tensor: torch.Tensor, seq_len: int, bsz: int):
         return tensor.view(bsz, seq_len, self.num_heads, self.head_dim).transpose(1, 2).contiguous()
 
+    def _clamp_logits(self, attn_weights):
+        if self.stable_softmax_2d:
+            attn_weights = attn_weights - attn_weights.max()
+
+        # Do not increase -50000/50000, data type half has quite limited range
+        min_value = -50000 if self.clamp_min_for_underflow else None
+        max_value = 50000 if self.clamp_max_for_overflow else None
+        if min_value is None and max_value is None:
+            return attn_weights
+        if torch.is_grad_enabled():
+            return torch.clamp(attn_weights, min=min_value, max=max_value)
+        return attn_weights.clamp_(min=min_value, max=max_value)
+
     def forward(self, v, l, attention_mask_l=None):
         bsz, tgt_len, embed_dim = v.size()
 
@@ -78,52 +96,40 @@ class BiMultiHeadAttention(nn.Module):
         value_l_states = value_l_states.view(*proj_shape)
 
         src_len = key_states.size(1)
-        attn_weights = torch.bmm(query_states, key_states.transpose(1, 2)) # (bs * 8, seq_len_img, seq_len_text)
-
-        if attn_weights.size() != (bsz * self.num_heads, tgt_len, src_len):
-            raise ValueError(
-                f"Attention weights should be of size {(bsz * self.num_heads, tgt_len, src_len)}, but is {attn_weights.size()}"
-            )
-
-        # attn_weights_l = nn.functional.softmax(attn_weights.transpose(1, 2), dim=-1)
 
-        if self.stable_softmax_2d:
-            attn_weights = attn_weights - attn_weights.max()
-        
-        if self.clamp_min_for_underflow:
-            attn_weights = torch.clamp(attn_weights, min=-50000) # Do not increase -50000, data type half has quite limited range
-        if self.clamp_max_for_overflow:
-            attn_weights = torch.clamp(attn_weights, max=50000) # Do not increase 50000, data type half has quite limited range
-
-        attn_weights_T = attn_weights.transpose(1, 2)  # (bs * 8, seq_len_text, seq_len_img)
-        attn_weights_l = (attn_weights_T - torch.max(attn_weights_T, dim=-1, keepdim=True)[0])
-        if self.clamp_min_for_underflow:
-            attn_weights_l = torch.clamp(attn_weights_l, min=-50000) # Do not increase -50000, data type half has quite limited range
-        if self.clamp_max_for_overflow:
-            attn_weights_l = torch.clamp(attn_weights_l, max=50000) # Do not increase 50000, data type half has quite limited range
-
-        attn_weights_l = attn_weights_l.softmax(dim=-1)
-        # assert attention_mask_l.dtype == torch.int64
+        # padded text tokens, which are broadcast to all heads and image tokens rather than expanded
+        mask_l = None
         if attention_mask_l is not None:
             assert (attention_mask_l.dim() == 2) # (bs, seq_len)
-            attention_mask = attention_mask_l.unsqueeze(1).unsqueeze(1) # (bs, 1, 1, seq_len)
-            attention_mask = attention_mask.expand(bsz, 1, tgt_len, src_len)
-            attention_mask = attention_mask.masked_fill(attention_mask == 0, -9e15)
+            mask_l = (attention_mask_l == 0).view(bsz, 1, 1, src_len)
+
+        if self.chunk_size > 0 and tgt_len > self.chunk_size and not self.stable_softmax_2d \
+                and not self.training and not torch.is_grad_enabled():
+            attn_output_v, attn_output_l = self._forward_chunked(
+                query_states, key_states, value_v_states, value_l_states, mask_l, bsz
+            )
+        else:
+            attn_weights = torch.bmm(query_states, key_states.transpose(1, 2)) # (bs * 8, seq_len_img, seq_len_text)
 
-            if attention_mask.size() != (bsz, 1, tgt_len, src_len):
+            if attn_weights.size() != (bsz * self.num_heads, tgt_len, src_len):
                 raise ValueError(
-                    f"Attention mask should be of size {(bsz, 1, tgt_len, src_len)}"
+                    f"Attention weights should be of size {(bsz * self.num_heads, tgt_len, src_len)}, but is {attn_weights.size()}"
                 )
-            attn_weights = attn_weights.view(bsz, self.num_heads, tgt_len, src_len) + attention_mask
-            attn_weights = attn_weights.view(bsz * self.num_heads, tgt_len, src_len)
+            attn_weights = self._clamp_logits(attn_weights)
 
-        attn_weights_v = nn.functional.softmax(attn_weights, dim=-1)
+            # both directions share the logits: softmax over image tokens for the language direction, 
+            # which equals to the softmax of the transposed logits after subtracting their max values
+            attn_weights_l = attn_weights.softmax(dim=1)
+            if mask_l is not None:
+                attn_weights = attn_weights.view(bsz, self.num_heads, tgt_len, src_len).masked_fill(mask_l, -9e15)
+                attn_weights = attn_weights.view(bsz * self.num_heads, tgt_len, src_len)
+            attn_weights_v = attn_weights.softmax(dim=-1)
 
-        attn_probs_v = F.dropout(attn_weights_v, p=self.dropout, training=self.training)
-        attn_probs_l = F.dropout(attn_weights_l, p=self.dropout, training=self.training)
+            attn_probs_v = F.dropout(attn_weights_v, p=self.dropout, training=self.training)
+            attn_probs_l = F.dropout(attn_weights_l, p=self.dropout, training=self.training)
 
-        attn_output_v = torch.bmm(attn_probs_v, value_l_states)
-        attn_output_l = torch.bmm(attn_probs_l, value_v_states)
+            attn_output_v = torch.bmm(attn_probs_v, value_l_states)
+            attn_output_l = torch.bmm(attn_probs_l.transpose(1, 2), value_v_states)
 
         if attn_output_v.size() != (bsz * self.num_heads, tgt_len, self.head_dim):
             raise ValueError(
@@ -148,6 +154,44 @@ class BiMultiHeadAttention(nn.Module):
 
         return attn_output_v, attn_output_l
 
+    @torch.no_grad()
+    def _forward_chunked(self, query_states, key_states, value_v_states, value_l_states, mask_l, bsz):
+        """
+        Inference only, the image tokens are processed chunk by chunk, where the softmax over 
+        image tokens for the language direction is accumulated online with running max and sum.
+        """
+        bh, tgt_len, _ = query_states.shape
+        src_len = key_states.shape[1]
+        if mask_l is not None:
+            mask_l = mask_l.expand(bsz, self.num_heads, 1, src_len).reshape(bh, 1, src_len)
+
+        attn_output_v = query_states.new_empty((bh, tgt_len, self.head_dim))
+        attn_output_l = query_states.new_zeros((bh, src_len, self.head_dim))
+        max_l = query_states.new_full((bh, 1, src_len), float("-inf"))
+        sum_l = query_states.new_zeros((bh, 1, src_len))
+        for start in range(0, tgt_len, self.chunk_size):
+            end = min(start + self.chunk_size, tgt_len)
+            attn_weights = torch.bmm(query_states[:, start:end], key_states.transpose(1, 2))
+            attn_weights = self._clamp_logits(attn_weights)
+
+            # language to vision
+            new_max_l = torch.maximum(max_l, attn_weights.max(dim=1, keepdim=True)[0])
+            rescale = (max_l - new_max_l).exp()
+            exp_l = (attn_weights - new_max_l).exp_()
+            sum_l = sum_l * rescale + exp_l.sum(dim=1, keepdim=True)
+            attn_output_l = attn_output_l * rescale.transpose(1, 2) \
+                + torch.bmm(exp_l.transpose(1, 2), value_v_states[:, start:end])
+            max_l = new_max_l
+            del exp_l
+
+            # vision to language
+            if mask_l is not None:
+                attn_weights.masked_fill_(mask_l, -9e15)
+            attn_output_v[:, start:end] = torch.bmm(attn_weights.softmax(dim=-1), value_l_states)
+
+        attn_output_l = attn_output_l / sum_l.transpose(1, 2)
+        return attn_output_v, attn_output_l
+
 class BiAttentionBlockForCheckpoint(nn.Module):
     def __init__(
         self, 
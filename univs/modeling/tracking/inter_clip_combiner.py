@@ -9,6 +9,9 @@ from detectron2.config import configurable
 from detectron2.structures import Instances
 from detectron2.utils.memory import retry_if_cuda_oom
 
+from univs.utils.comm import autocast_fp32, get_inference_dtype
+from univs.utils.profiling import profile_region, profiled
+
 
 class FastOverTracker_DET:
     """
@@ -26,7 +29,8 @@ class FastOverTracker_DET:
             clip_stride,
             embed_dim,
             apply_cls_thres,
-            mask_classification
+            mask_classification,
+            memory_dtype=torch.float,
     ):
         self.num_classes = num_classes
         self.num_frames = num_frames
@@ -34,6 +38,9 @@ class FastOverTracker_DET:
         self.clip_stride = clip_stride
         self.embed_dim = embed_dim
         self.apply_cls_thres = apply_cls_thres
+        # mask logits and clip-level embeddings in the memory pool can be stored in fp16/bf16,
+        # they are cast back to fp32 before computing the matching scores
+        self.memory_dtype = memory_dtype
         self.mask_classification = mask_classification
 
         self.mem_length = num_frames_window_track + num_frames + 1
@@ -74,6 +81,7 @@ class FastOverTracker_DET:
             "embed_dim": cfg.MODEL.MASK_FORMER.HIDDEN_DIM,
             "apply_cls_thres": cfg.MODEL.BoxVIS.TEST.APPLY_CLS_THRES,
             "mask_classification": True,
+            "memory_dtype": get_inference_dtype(cfg.MODEL.UniVS.TEST.PRECISION) or torch.float,
         }
 
     def init_memory(self, num_insts=0, is_first=False, image_size=None, device=None, num_classes=None):
@@ -99,7 +107,7 @@ class FastOverTracker_DET:
             self.saved_idx_set = set(range(self.num_frames - 1))
 
         self.saved_logits = torch.zeros((self.num_clips, self.num_max_inst, self.mem_length, *self.image_size),
-                                        dtype=torch.float, device=self.device)
+                                        dtype=self.memory_dtype, device=self.device)
 
         self.saved_valid = torch.zeros((self.num_clips, self.num_max_inst, self.mem_length),
                                        dtype=torch.bool, device=self.device)
@@ -107,7 +115,7 @@ class FastOverTracker_DET:
         self.saved_cls = torch.zeros((self.num_clips, self.num_max_inst, self.num_classes),
                                         dtype=torch.float, device=self.device)
         self.saved_query_embeds = torch.zeros((self.num_clips, self.num_max_inst, self.embed_dim),
-                                              dtype=torch.float, device=self.device)
+                                              dtype=self.memory_dtype, device=self.device)
 
         self.saved_untracked_frames_mem = torch.zeros(self.num_max_inst,
                                                       dtype=torch.float, device=self.device)
@@ -116,13 +124,13 @@ class FastOverTracker_DET:
 
     def _expand_memory(self, num_expand_inst):
         expand_logits = torch.zeros((self.num_clips, num_expand_inst, self.mem_length, *self.image_size),
-                                    dtype=torch.float, device=self.device)
+                                    dtype=self.memory_dtype, device=self.device)
         expand_valid = torch.zeros((self.num_clips, num_expand_inst, self.mem_length),
                                    dtype=torch.bool, device=self.device)
         expand_cls = torch.zeros((self.num_clips, num_expand_inst, self.num_classes),
                                  dtype=torch.float, device=self.device)
         expand_query_embeds = torch.zeros((self.num_clips, num_expand_inst, self.embed_dim),
-                                          dtype=torch.float, device=self.device)
+                                          dtype=self.memory_dtype, device=self.device)
         expand_untracked_frames_mem = torch.zeros(num_expand_inst,
                                                   dtype=torch.float, device=self.device)
         expand_query_embeds_mem = torch.zeros((num_expand_inst, self.embed_dim),
@@ -151,17 +159,17 @@ class FastOverTracker_DET:
 
         assert len(r_idx) == len(c_idx), f"Length mismatch {len(r_idx)} and {len(c_idx)}"
         self.saved_logits[self.num_clip, r_idx, start_idx:end_idx + 1] = \
-            input_clip.mask_logits[c_idx].float()
+            input_clip.mask_logits[c_idx].to(self.memory_dtype)
         self.saved_valid[self.num_clip, r_idx, start_idx:end_idx + 1] = True
         self.saved_cls[self.num_clip, r_idx] = input_clip.cls_probs[c_idx].float()
-        self.saved_query_embeds[self.num_clip, r_idx] = input_clip.query_embeds[c_idx].float()
+        self.saved_query_embeds[self.num_clip, r_idx] = input_clip.query_embeds[c_idx].to(self.memory_dtype)
 
         # update mem pool
         self.saved_untracked_frames_mem += 1
         self.saved_untracked_frames_mem[r_idx] = 0
         if self.num_clip > 0 and self.weighted_manner:
             start_clip_idx = max(self.num_clip - 1, 0)
-            query_embed_mem = self.saved_query_embeds[start_clip_idx:self.num_clip + 1][:, r_idx]  # CxNxE
+            query_embed_mem = self.saved_query_embeds[start_clip_idx:self.num_clip + 1][:, r_idx].float()  # CxNxE
             w_mem = self.weights_mem[:query_embed_mem.shape[0]].reshape(-1, 1, 1).to(self.device)
             valid_mem = (query_embed_mem != 0).any(dim=-1)[..., None]  # CxNx1
             query_embed_mem_w = (query_embed_mem * w_mem).sum(dim=0)
@@ -207,6 +215,7 @@ class FastOverTracker_DET:
 
         return siou.to(self.device)
 
+    @profiled("tracker_update")
     def update(self, input_clip):
 
         if self.num_inst == 0:
@@ -237,7 +246,7 @@ class FastOverTracker_DET:
                     i_masks = input_clip.mask_logits[:, inter_input_idx].float()
                     s_masks = self.saved_logits[:self.num_clip, :self.num_inst, inter_saved_idx]
                     s_valid = self.saved_valid[:self.num_clip, :self.num_inst].any(dim=-1).to(s_masks.device)
-                    s_masks = (s_masks.sum(0) / s_valid.sum(0).clamp(min=1).reshape(-1, 1, 1, 1))
+                    s_masks = (s_masks.sum(0, dtype=torch.float) / s_valid.sum(0).clamp(min=1).reshape(-1, 1, 1, 1))
                     siou_scores = self._get_siou(s_masks.sigmoid(), i_masks.sigmoid())  # N_s, N_i
 
             # 3. Combine score matrix
@@ -247,7 +256,8 @@ class FastOverTracker_DET:
             above_thres = scores > match_threshold
             scores = scores * above_thres.float()
 
-            row_idx, col_idx = linear_sum_assignment(scores.cpu(), maximize=True)
+            with profile_region("matching"):
+                row_idx, col_idx = linear_sum_assignment(scores.cpu(), maximize=True)
 
             matched_ID, matched_idx = [], []
             for is_above, r, c in zip(above_thres[row_idx, col_idx], row_idx, col_idx):
@@ -290,7 +300,7 @@ class FastOverTracker_DET:
         mask_logits = self.saved_logits[:self.num_clip, :self.num_inst]  # CxNxTxHxW
         valid = self.saved_valid[:self.num_clip, :self.num_inst]  # CxNxT
 
-        mask_logits = mask_logits.sum(dim=0) / valid.sum(dim=0).clamp(min=1)[..., None, None].to(mask_logits.device)  # NxTxHxW
+        mask_logits = mask_logits.sum(dim=0, dtype=torch.float) / valid.sum(dim=0).clamp(min=1)[..., None, None].to(mask_logits.device)  # NxTxHxW
         len_frames = self.window_frames if not is_last_window else max(self.saved_idx_set) + 1
         out_masks = mask_logits[:, :len_frames]  # NxTxHxW
 
@@ -349,6 +359,7 @@ class FastOverTracker_DET:
         return {"pred_masks": out_masks, "pred_cls_scores": out_cls, "obj_ids": out_inst_id}
 
 
+@autocast_fp32
 def get_ctt_similarity(saved_query_embeds, input_query_embeds):
     # input_query_embeds: N_i, E
     # saved_query_embeds: N_s, E
@@ -454,6 +465,7 @@ class InterClipCombiner_SOT:
             self.valid[:-1, _ids_occur_mem, :-1] = copy.deepcopy(old_valid[1:, :, 1:])
             self.frame_idxs = range(frame_idx, frame_idx + self.num_frames_memory)
 
+    @profiled("tracker_update")
     def update_memory(self, frame_idx, cur_clip_out, is_first=False, is_last=False):
         self._init_memory(frame_idx, cur_clip_out, is_first=is_first)
 
@@ -8,6 +8,9 @@ from detectron2.config import configurable
 from detectron2.structures import Instances
 from detectron2.utils.memory import retry_if_cuda_oom
 
+from univs.utils.comm import autocast_fp32
+from univs.utils.profiling import profile_region, profiled
+
 
 class MDQE_OverTrackerEfficient:
     """
@@ -29,7 +32,8 @@ class MDQE_OverTrackerEfficient:
             embed_dim,
             apply_cls_thres,
             device,
-            data_name
+            data_name,
+            memory_dtype=torch.float,
     ):
         self.image_size = None
 
@@ -41,6 +45,9 @@ class MDQE_OverTrackerEfficient:
         self.clip_stride = clip_stride
         self.embed_dim = embed_dim
         self.apply_cls_thres = apply_cls_thres
+        # mask logits and clip-level embeddings in the memory pool can be stored in fp16/bf16,
+        # they are cast back to fp32 before computing the matching scores
+        self.memory_dtype = memory_dtype
 
         self.mem_length = num_frames_window_track + num_frames
         self.num_clips = num_frames_window_track // self.clip_stride + 2
@@ -92,13 +99,13 @@ class MDQE_OverTrackerEfficient:
             self.num_max_inst = int(1.5 * self.num_inst) if self.num_inst < 50 else int(1.2 * self.num_inst)
 
         self.saved_logits = torch.zeros((self.num_clips, self.num_max_inst, self.mem_length, *self.image_size),
-                                        dtype=torch.float, device=self.device)
+                                        dtype=self.memory_dtype, device=self.device)
         self.saved_valid = torch.zeros((self.num_clips, self.num_max_inst, self.mem_length),
                                        dtype=torch.bool, device=self.device)
         self.saved_cls = torch.zeros((self.num_clips, self.num_max_inst, self.num_classes),
                                      dtype=torch.float, device=self.device)
         self.saved_query_embeds = torch.zeros((self.num_clips, self.num_max_inst, self.embed_dim),
-                                              dtype=torch.float, device=self.device)
+                                              dtype=self.memory_dtype, device=self.device)
 
         self.saved_untracked_frames_mem = torch.zeros(self.num_max_inst,
                                                       dtype=torch.float, device=self.device)
@@ -107,13 +114,13 @@ class MDQE_OverTrackerEfficient:
 
     def _expand_memory(self, num_expand_inst):
         expand_logits = torch.zeros((self.num_clips, num_expand_inst, self.mem_length, *self.image_size),
-                                    dtype=torch.float, device=self.device)
+                                    dtype=self.memory_dtype, device=self.device)
         expand_valid = torch.zeros((self.num_clips, num_expand_inst, self.mem_length),
                                    dtype=torch.bool, device=self.device)
         expand_cls = torch.zeros((self.num_clips, num_expand_inst, self.num_classes),
                                  dtype=torch.float, device=self.device)
         expand_query_embeds = torch.zeros((self.num_clips, num_expand_inst, self.embed_dim),
-                                          dtype=torch.float, device=self.device)
+                                          dtype=self.memory_dtype, device=self.device)
 
         expand_untracked_frames_mem = torch.zeros(num_expand_inst,
                                                   dtype=torch.float, device=self.device)
@@ -143,17 +150,17 @@ class MDQE_OverTrackerEfficient:
 
         assert len(r_idx) == len(c_idx)
         self.saved_logits[self.num_clip, r_idx, start_idx:end_idx + 1] = \
-            input_clip.mask_logits[c_idx].float()
+            input_clip.mask_logits[c_idx].to(self.memory_dtype)
         self.saved_valid[self.num_clip, r_idx, start_idx:end_idx + 1] = True
-        self.saved_cls[self.num_clip, r_idx] = input_clip.cls_probs[c_idx]
-        self.saved_query_embeds[self.num_clip, r_idx] = input_clip.query_embeds[c_idx].float()
+        self.saved_cls[self.num_clip, r_idx] = input_clip.cls_probs[c_idx].float()
+        self.saved_query_embeds[self.num_clip, r_idx] = input_clip.query_embeds[c_idx].to(self.memory_dtype)
 
         # update query embeds in memory pool
         self.saved_untracked_frames_mem += 1
         self.saved_untracked_frames_mem[r_idx] = 0
         if self.num_clip > 0 and self.weighted_manner:
             start_clip_idx = max(self.num_clip - 1, 0)
-            query_embed_mem = self.saved_query_embeds[start_clip_idx:self.num_clip + 1][:, r_idx]  # CxNxE
+            query_embed_mem = self.saved_query_embeds[start_clip_idx:self.num_clip + 1][:, r_idx].float()  # CxNxE
             w_mem = self.weights_mem[:query_embed_mem.shape[0]].reshape(-1, 1, 1)
             valid_mem = (query_embed_mem != 0).any(dim=-1)[..., None]  # CxNx1
             query_embed_mem_w = (query_embed_mem * w_mem).sum(dim=0)
@@ -199,6 +206,7 @@ class MDQE_OverTrackerEfficient:
 
         return siou.to(self.device)
 
+    @profiled("tracker_update")
     def update(self, input_clip, is_first_clip=False):
         input_num_insts = len(input_clip.scores)
         if is_first_clip:
@@ -236,7 +244,7 @@ class MDQE_OverTrackerEfficient:
                     i_masks = input_clip.mask_logits[:, inter_input_idx].float()
                     s_masks = self.saved_logits[:self.num_clip, :self.num_inst, inter_saved_idx]
                     s_valid = self.saved_valid[:self.num_clip, :self.num_inst].any(dim=-1).to(s_masks.device)
-                    s_masks = (s_masks.sum(0) / s_valid.sum(0).clamp(min=1).reshape(-1, 1, 1, 1))
+                    s_masks = (s_masks.sum(0, dtype=torch.float) / s_valid.sum(0).clamp(min=1).reshape(-1, 1, 1, 1))
                     siou_scores = self._get_siou(s_masks.sigmoid(), i_masks.sigmoid())  # N_s, N_i
 
                 # 3. Combine score matrix
@@ -251,7 +259,8 @@ class MDQE_OverTrackerEfficient:
             above_thres = scores > match_threshold
             scores = scores * above_thres.float()
 
-            row_idx, col_idx = linear_sum_assignment(scores.cpu(), maximize=True)
+            with profile_region("matching"):
+                row_idx, col_idx = linear_sum_assignment(scores.cpu(), maximize=True)
 
             matched_ID, matched_idx = [], []
             for is_above, r, c in zip(above_thres[row_idx, col_idx], row_idx, col_idx):
@@ -300,7 +309,7 @@ class MDQE_OverTrackerEfficient:
         mask_logits = self.saved_logits[:self.num_clip, :self.num_inst]  # CxNxTxHxW
         valid = self.saved_valid[:self.num_clip, :self.num_inst]  # CxNxT
 
-        mask_logits = mask_logits.sum(0) / valid.sum(0).clamp(min=1)[..., None, None].to(mask_logits.device)  # NxTxHxW
+        mask_logits = mask_logits.sum(0, dtype=torch.float) / valid.sum(0).clamp(min=1)[..., None, None].to(mask_logits.device)  # NxTxHxW
         len_frames = self.window_frames if not is_last_clip else max(self.saved_idx_set) + 1
         out_masks = mask_logits[:, :len_frames]  # NxTxHxW
 
@@ -365,6 +374,7 @@ class MDQE_OverTrackerEfficient:
         return out_window
 
 
+@autocast_fp32
 def get_ctt_similarity(saved_query_embeds, input_query_embeds):
     # input_query_embeds: N_i, E
     # saved_query_embeds: N_s, E
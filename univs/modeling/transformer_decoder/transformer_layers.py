@@ -92,20 +92,65 @@ class CrossAttentionLayer(nn.Module):
     def with_pos_embed(self, tensor, pos: Optional[Tensor]):
         return tensor if pos is None else tensor + pos
 
+    def _is_head_shared_mask(self, query, memory_mask: Optional[Tensor]):
+        # memory_mask with shape (N, L, S) is shared by all heads, otherwise (N*num_heads, L, S)
+        return memory_mask is not None and memory_mask.dim() == 3 \
+            and self.multihead_attn.num_heads > 1 and memory_mask.shape[0] == query.shape[1]
+
+    def multihead_attn_sdpa(self, query, key, value,
+                            attn_mask: Tensor,
+                            key_padding_mask: Optional[Tensor] = None):
+        """
+        The same as self.multihead_attn without attention weights, but the bool attn_mask (N, L, S) 
+        is broadcast to all heads in F.scaled_dot_product_attention, instead of being repeated 
+        as (N*num_heads, L, S) for nn.MultiheadAttention.
+        """
+        mha = self.multihead_attn
+        L, N, E = query.shape
+        S = key.shape[0]
+        num_heads = mha.num_heads
+        head_dim = E // num_heads
+
+        w_q, w_k, w_v = mha.in_proj_weight.chunk(3)
+        b_q, b_k, b_v = mha.in_proj_bias.chunk(3)
+        # L x N x E -> N x h x L x E/h
+        q = F.linear(query, w_q, b_q).view(L, N, num_heads, head_dim).permute(1, 2, 0, 3)
+        k = F.linear(key, w_k, b_k).view(S, N, num_heads, head_dim).permute(1, 2, 0, 3)
+        v = F.linear(value, w_v, b_v).view(S, N, num_heads, head_dim).permute(1, 2, 0, 3)
+
+        # True means not allowed to attend in nn.MultiheadAttention, but allowed in sdpa
+        if key_padding_mask is not None:
+            attn_mask = attn_mask | key_padding_mask[:, None, :]
+        attn_mask = ~attn_mask[:, None]  # N x 1 x L x S
+
+        tgt = F.scaled_dot_product_attention(
+            q, k, v, attn_mask=attn_mask, dropout_p=mha.dropout if self.training else 0.
+        )
+        tgt = tgt.permute(2, 0, 1, 3).reshape(L, N, E)
+        return mha.out_proj(tgt)
+
+    def attention(self, query, key, value,
+                  attn_mask: Optional[Tensor] = None,
+                  key_padding_mask: Optional[Tensor] = None):
+        if self._is_head_shared_mask(query, attn_mask):
+            if not self.need_weights:
+                return self.multihead_attn_sdpa(query, key, value, attn_mask, key_padding_mask), None
+            attn_mask = attn_mask.repeat_interleave(self.multihead_attn.num_heads, dim=0)
+
+        outs = self.multihead_attn(query=query, key=key, value=value, attn_mask=attn_mask,
+                                   key_padding_mask=key_padding_mask, 
+                                   need_weights=self.need_weights)
+        return outs[0], outs[1] if self.need_weights else None
+
     def forward_post(self, tgt, memory,
                      memory_mask: Optional[Tensor] = None,
                      memory_key_padding_mask: Optional[Tensor] = None,
                      pos: Optional[Tensor] = None,
                      query_pos: Optional[Tensor] = None):
-        outs = self.multihead_attn(query=self.with_pos_embed(tgt, query_pos),
-                                   key=self.with_pos_embed(memory, pos),
-                                   value=memory, attn_mask=memory_mask,
-                                   key_padding_mask=memory_key_padding_mask, 
-                                   need_weights=self.need_weights)
-        if self.need_weights:
-            tgt2, attn_weights = outs[:2]
-        else:
-            tgt2 = outs[0]
+        tgt2, attn_weights = self.attention(query=self.with_pos_embed(tgt, query_pos),
+                                            key=self.with_pos_embed(memory, pos),
+                                            value=memory, attn_mask=memory_mask,
+                                            key_padding_mask=memory_key_padding_mask)
         tgt = tgt + self.dropout(tgt2)
         tgt = self.norm(tgt)
         
@@ -120,15 +165,10 @@ class CrossAttentionLayer(nn.Module):
                     pos: Optional[Tensor] = None,
                     query_pos: Optional[Tensor] = None):
         tgt2 = self.norm(tgt)
-        outs = self.multihead_attn(query=self.with_pos_embed(tgt2, query_pos),
-                                   key=self.with_pos_embed(memory, pos),
-                                   value=memory, attn_mask=memory_mask,
-                                   key_padding_mask=memory_key_padding_mask, 
-                                   need_weights=self.need_weights)
-        if self.need_weights:
-            tgt2, attn_weights = outs[:2]
-        else:
-            tgt2 = outs[0]
+        tgt2, attn_weights = self.attention(query=self.with_pos_embed(tgt2, query_pos),
+                                            key=self.with_pos_embed(memory, pos),
+                                            value=memory, attn_mask=memory_mask,
+                                            key_padding_mask=memory_key_padding_mask)
         tgt = tgt + self.dropout(tgt2)
 
         if self.need_weights:
@@ -21,6 +21,7 @@ from .position_encoding import PositionEmbeddingSine3D, PositionEmbeddingSine3DA
 from .transformer_layers import CrossAttentionLayer, SelfAttentionLayer, FFNLayer, MLP
 
 from univs.modeling.prompt_encoder import VisualPromptEncoder, VisualPromptSampler
+from univs.utils.profiling import profiled
 from datasets.concept_emb.combined_datasets_category_info import combined_datasets_category_info
 
 
@@ -83,6 +84,7 @@ class VideoMultiScaleMaskedTransformerDecoderUniVS(nn.Module):
         num_prev_frames_memory: int=5, 
         enabled_prev_frames_memory: bool=True,
         enabled_prev_visual_prompts_for_grounding: bool=False,
+        active_classes_only_test: bool=False,
         # semantic extraction parameters
         semantic_extraction_enable: bool=False,
     ):
@@ -193,6 +195,9 @@ class VideoMultiScaleMaskedTransformerDecoderUniVS(nn.Module):
         self.clip_cls_text_emb = torch.load(clip_class_embed_path, map_location=self.decoder_norm.weight.device)
         # vis2lang head and lang2vis head
         self.text_emb_dim = self.clip_cls_text_emb.shape[-1]
+        # normalized CLIP class embeddings, cached per (dataset, dtype, device)
+        self._clip_cls_emb_cache = {}
+        self._clip_cls_emb_stamp = None
         self.vis2text_projection = nn.Linear(hidden_dim, self.text_emb_dim)
         self.text_norm = nn.LayerNorm(self.text_emb_dim)
         self.text2vis_projection = nn.Linear(self.text_emb_dim, hidden_dim)
@@ -223,6 +228,7 @@ class VideoMultiScaleMaskedTransformerDecoderUniVS(nn.Module):
         self.num_prev_frames_memory = max(num_prev_frames_memory, num_frames)
         self.enabled_prev_frames_memory = enabled_prev_frames_memory
         self.enabled_prev_visual_prompts_for_grounding = enabled_prev_visual_prompts_for_grounding
+        self.active_classes_only_test = active_classes_only_test
 
         # semantic_extraction during inference only
         self.semantic_extraction_enable = semantic_extraction_enable
@@ -296,12 +302,14 @@ class VideoMultiScaleMaskedTransformerDecoderUniVS(nn.Module):
         ret["num_prev_frames_memory"] = cfg.MODEL.UniVS.TEST.NUM_PREV_FRAMES_MEMORY
         ret["enabled_prev_frames_memory"] = cfg.MODEL.UniVS.TEST.ENABLED_PREV_FRAMES_MEMORY
         ret["enabled_prev_visual_prompts_for_grounding"] = cfg.MODEL.UniVS.TEST.ENABLED_PREV_VISUAL_PROMPTS_FOR_GROUNDING
+        ret["active_classes_only_test"] = cfg.MODEL.UniVS.TEST.ACTIVE_CLASSES_ONLY
 
         # semantic extraction parameters
         ret["semantic_extraction_enable"] = cfg.MODEL.UniVS.TEST.SEMANTIC_EXTRACTION.ENABLE
 
         return ret
 
+    @profiled("transformer_decoder")
     def forward(self, x, mask_features, mask_features_bfe_conv=None, mask=None, targets=None):
         # if not self.training:
         #     self.plot_mask_features(mask_features, targets)
@@ -503,11 +511,24 @@ class VideoMultiScaleMaskedTransformerDecoderUniVS(nn.Module):
 
         outputs_class = self.vis2text_projection(decoder_output)
         if task != 'grounding':
-            CLIP_class = F.normalize(self.clip_cls_text_emb.to(output), p=2, dim=-1).detach()
+            dataset_name = targets[0]['dataset_name'] if targets is not None else None
+            active_only = self.active_classes_only_test and not self.training \
+                and dataset_name in combined_datasets_category_info
+            CLIP_class = self.get_normalized_clip_class_embeds(
+                output.dtype, output.device, dataset_name if active_only else None
+            )
             outputs_class = F.normalize(outputs_class, p=2, dim=-1)
             outputs_class = torch.einsum('bqc,kc->bqk', outputs_class, CLIP_class)
             outputs_class = rearrange(outputs_class, '(B T) Q C -> B T Q C', T=t).mean(1)
             outputs_class = outputs_class * self.cls_temp.weight.exp()
+            if active_only:
+                # keep the class dimension of the combined vocabulary for the subsequent slicing
+                num_classes, start_idx = combined_datasets_category_info[dataset_name]
+                outputs_class_full = outputs_class.new_full(
+                    (*outputs_class.shape[:-1], self.clip_cls_text_emb.shape[0]), float("-inf")
+                )
+                outputs_class_full[..., start_idx:start_idx + num_classes] = outputs_class
+                outputs_class = outputs_class_full
 
         else:
             CLIP_exp = torch.stack(
@@ -551,7 +572,7 @@ class VideoMultiScaleMaskedTransformerDecoderUniVS(nn.Module):
                 # outputs_mask[:, p_indices] = (outputs_mask[:, p_indices] + outputs_mask[:, l_indices]) / 2.
         
         # NOTE: prediction is of higher-resolution
-        # [B, Q, T, H, W] -> [BT, Q, H*W] -> [BT, h, Q, H*W] -> [B*T*h, Q, HW]
+        # [B, Q, T, H, W] -> [BT, Q, H*W], which is shared by all heads in cross-attention layers
         attn_mask = F.interpolate(
             outputs_mask.flatten(0, 1), 
             size=attn_mask_target_size, 
@@ -562,10 +583,31 @@ class VideoMultiScaleMaskedTransformerDecoderUniVS(nn.Module):
         attn_mask = rearrange(attn_mask, '(b q) t h w -> (b t) q (h w)', b=b)
         # must use bool type
         # If a BoolTensor is provided, positions with ``True`` are not allowed to attend while ``False`` values will be unchanged.
-        attn_mask = (attn_mask.sigmoid().unsqueeze(1).repeat(1, self.num_heads, 1, 1).flatten(0, 1) < 0.5).bool()
-        attn_mask = attn_mask.detach()
+        # sigmoid(x) < 0.5 <=> x < 0
+        attn_mask = (attn_mask < 0).detach()
         return outputs_class, outputs_mask, attn_mask, outputs_reid
     
+    def get_normalized_clip_class_embeds(self, dtype, device, dataset_name=None):
+        """
+        L2-normalized CLIP class embeddings of the combined vocabulary, or only the categories of
+        dataset_name if given, which are cached until self.clip_cls_text_emb is replaced or modified.
+        """
+        stamp = (id(self.clip_cls_text_emb), self.clip_cls_text_emb._version)
+        if self._clip_cls_emb_stamp != stamp:
+            self._clip_cls_emb_cache = {}
+            self._clip_cls_emb_stamp = stamp
+
+        key = (dataset_name, dtype, device)
+        if key not in self._clip_cls_emb_cache:
+            clip_cls_text_emb = self.clip_cls_text_emb
+            if dataset_name is not None:
+                num_classes, start_idx = combined_datasets_category_info[dataset_name]
+                clip_cls_text_emb = clip_cls_text_emb[start_idx:start_idx + num_classes]
+            clip_cls_text_emb = clip_cls_text_emb.to(device=device, dtype=dtype)
+            self._clip_cls_emb_cache[key] = F.normalize(clip_cls_text_emb, p=2, dim=-1).detach()
+
+        return self._clip_cls_emb_cache[key]
+
     def prompt_image_attention_mask(self, attn_mask, attn_mask_target_size, num_frames, targets):
         if 'masks' not in targets[0] or targets[0]['masks'].nelement() == 0:
             return attn_mask
@@ -590,12 +632,13 @@ class VideoMultiScaleMaskedTransformerDecoderUniVS(nn.Module):
         batch_idx = batch_idx[max_logits > 0]
         pixel_idxs = pixel_idxs[max_logits > 0]
         gt_masks[batch_idx, pixel_idxs] = 1.
-        # BT, Q_p, HW -> BTh, Q_p, HW
-        gt_masks_not = (gt_masks.reshape(BT, num_gt_insts, L).repeat(1,self.num_heads,1, 1).flatten(0, 1) < 0).bool()
+        # BT, Q_p, HW
+        gt_masks_not = (gt_masks.reshape(BT, num_gt_insts, L) < 0).bool()
         
         attn_mask[:, self.num_queries:] = gt_masks_not & attn_mask[:, self.num_queries:]
         return attn_mask.detach()
     
+    @profiled("prompt_encoder")
     def forward_prompt_encoder(
         self, src, pos, size_list, targets, num_frames=None, prompt_type=None, use_all_prev_frames=False
     ):
@@ -107,6 +107,56 @@ sigmoid_ce_with_weight_loss_jit = torch.jit.script(
 )  # type: torch.jit.ScriptModule
 
 
+def sigmoid_ce_loss_layers(
+        inputs: torch.Tensor,
+        targets: torch.Tensor,
+        num_masks: float,
+    ):
+    """
+    Same as `sigmoid_ce_loss`, but for the stacked point logits of all decoder layers.
+    Args:
+        inputs: A float tensor with shape (L, N, P), the point logits of L layers.
+        targets: A float tensor with shape (L, N, P), the point labels.
+        num_masks: the average number of masks in the mini-batch
+    Returns:
+        Loss tensor with shape (L,)
+    """
+    loss = F.binary_cross_entropy_with_logits(inputs, targets, reduction="none")
+
+    return loss.mean(2).sum(1) / num_masks
+
+
+sigmoid_ce_loss_layers_jit = torch.jit.script(
+    sigmoid_ce_loss_layers
+)  # type: torch.jit.ScriptModule
+
+
+def dice_loss_layers(
+        inputs: torch.Tensor,
+        targets: torch.Tensor,
+        num_masks: float,
+    ):
+    """
+    Same as `dice_loss`, but for the stacked point logits of all decoder layers.
+    Args:
+        inputs: A float tensor with shape (L, N, P), the point logits of L layers.
+        targets: A float tensor with shape (L, N, P), the point labels.
+        num_masks: the average number of masks in the mini-batch
+    Returns:
+        Loss tensor with shape (L,)
+    """
+    inputs = inputs.sigmoid()
+    numerator = 2 * (inputs * targets).sum(2)
+    denominator = inputs.sum(2) + targets.sum(2)
+    loss = 1 - (numerator + 1) / (denominator + 1)
+    return loss.sum(1) / num_masks
+
+
+dice_loss_layers_jit = torch.jit.script(
+    dice_loss_layers
+)  # type: torch.jit.ScriptModule
+
+
 def dice_coefficient_loss(
         inputs: torch.Tensor,
         targets: torch.Tensor,
@@ -315,6 +365,7 @@ class VideoSetCriterion(nn.Module):
     def __init__(self, num_classes, matcher, weight_dict, eos_coef, losses, num_frames, 
                  num_points, oversample_ratio, importance_sample_ratio, 
                  use_ctt_loss=True, max_num_masks: int=50, boxvis_enabled=False, 
+                 shared_point_sampling=False,
                  ):
         """Create the criterion.
         Parameters:
@@ -324,6 +375,8 @@ class VideoSetCriterion(nn.Module):
             eos_coef: relative classification weight applied to the no-object category
             losses: list of all the losses to be applied. See get_loss for list of available losses
             boxvis_enabled: It controls the annotation types: pixel-wise or box-level annotations for VIS task
+            shared_point_sampling: sample the points of gt masks once with the last layer, which are
+                shared by the mask losses of all decoder layers, see `sample_shared_points`
         """
         super().__init__()
         self.num_classes = num_classes
@@ -339,6 +392,7 @@ class VideoSetCriterion(nn.Module):
         self.oversample_ratio = oversample_ratio
         self.importance_sample_ratio = importance_sample_ratio
         self.max_num_masks = max_num_masks
+        self.shared_point_sampling = shared_point_sampling
 
         # box-supervised video instance segmentation
         self.boxvis_enabled = boxvis_enabled
@@ -615,6 +669,80 @@ class VideoSetCriterion(nn.Module):
         del target_masks
         return losses
 
+    @torch.no_grad()
+    def sample_shared_points(self, outputs, targets, indices):
+        """
+        Sample the points of all gt masks once, which are shared by the mask losses of all decoder layers.
+        The points of each gt mask are sampled by the uncertainty of its matched prediction in the last
+        layer; with uniform sampling (IMPORTANCE_SAMPLE_RATIO = 0), the points sampled by the matcher are reused.
+
+        Returns:
+            point_coords (Tensor): N_all x T x P x 2, where N_all is the number of gt masks in the batch
+            point_labels (Tensor): N_all x T x P
+        """
+        src_masks = outputs["pred_masks"]
+        target_masks = torch.cat([t['masks'] for t in targets]).to(src_masks)  # N_all x T x H x W
+        num_all, num_frames = target_masks.shape[:2]
+
+        matcher_coords = getattr(self.matcher, "last_point_coords", None)
+        if self.importance_sample_ratio == 0 and matcher_coords is not None \
+                and matcher_coords.shape[1] == self.num_points:
+            point_coords = matcher_coords.expand(num_all * num_frames, -1, -1).reshape(
+                num_all, num_frames, self.num_points, 2
+            )
+        else:
+            # the gt masks without matched predictions (only if there are more gt masks than queries)
+            point_coords = torch.rand(num_all, num_frames, self.num_points, 2, device=src_masks.device)
+            src_idx = self._get_src_permutation_idx(indices)
+            tgt_idx = self._get_tgt_global_idx(targets, indices)
+            if len(tgt_idx):
+                point_coords[tgt_idx] = get_uncertain_point_coords_with_randomness(
+                    src_masks[src_idx].flatten(0, 1)[:, None],
+                    lambda logits: calculate_uncertainty(logits),
+                    self.num_points,
+                    self.oversample_ratio,
+                    self.importance_sample_ratio,
+                ).reshape(-1, num_frames, self.num_points, 2)
+
+        point_labels = point_sample(
+            target_masks.flatten(0, 1)[:, None],
+            point_coords.flatten(0, 1),
+            align_corners=False,
+        ).reshape(num_all, num_frames, self.num_points)
+
+        return point_coords, point_labels
+
+    def loss_masks_shared_points(self, layer_outputs, targets, layer_indices, num_masks, shared_points):
+        """
+        Compute the mask losses of all decoder layers with the shared points from `sample_shared_points`,
+        where the losses of all layers are computed in a batch.
+        layer_outputs and layer_indices are ordered as [last layer, aux layer 0, aux layer 1, ...]
+        """
+        point_coords, point_labels = shared_points
+
+        point_logits, layer_point_labels = [], []
+        for outputs, indices in zip(layer_outputs, layer_indices):
+            src_idx = self._get_src_permutation_idx(indices)
+            tgt_idx = self._get_tgt_global_idx(targets, indices)
+            src_masks = outputs["pred_masks"][src_idx].flatten(0, 1)[:, None]  # NT x 1 x H x W
+            point_logits.append(point_sample(
+                src_masks,
+                point_coords[tgt_idx].flatten(0, 1),
+                align_corners=False,
+            ).squeeze(1))
+            layer_point_labels.append(point_labels[tgt_idx].flatten(0, 1))
+
+        # the number of matched pairs is the same in all layers
+        point_logits = torch.stack(point_logits)  # L x NT x P
+        layer_point_labels = torch.stack(layer_point_labels)
+        loss_mask = sigmoid_ce_loss_layers_jit(point_logits, layer_point_labels, num_masks)
+        loss_dice = dice_loss_layers_jit(point_logits, layer_point_labels, num_masks)
+
+        losses = {"loss_mask": loss_mask[0], "loss_dice": loss_dice[0]}
+        for i in range(1, len(layer_outputs)):
+            losses.update({f"loss_mask_{i-1}": loss_mask[i], f"loss_dice_{i-1}": loss_dice[i]})
+        return losses
+
     def loss_masks_with_box_supervised(self, outputs, targets, indices, num_masks, l_layer):
         """Compute the losses related to the masks with only box annotations: the projection loss.
         If enabling Teacher Net with EMA, the pseudo mask supervision includes the focal loss and the dice loss.
@@ -657,6 +785,13 @@ class VideoSetCriterion(nn.Module):
         src_idx = torch.cat([src for (src, _) in indices])
         return batch_idx, src_idx
 
+    def _get_tgt_global_idx(self, targets, indices):
+        # indices of the matched targets in the concatenated targets of the batch
+        offsets = [0]
+        for t in targets[:-1]:
+            offsets.append(offsets[-1] + len(t['masks']))
+        return torch.cat([tgt + offset for (_, tgt), offset in zip(indices, offsets)])
+
     def _get_tgt_permutation_idx(self, indices):
         # permute targets following indices
         batch_idx = torch.cat([torch.full_like(tgt, i) for i, (_, tgt) in enumerate(indices)])
@@ -705,8 +840,17 @@ class VideoSetCriterion(nn.Module):
         outputs_without_aux = {k: v for k, v in outputs.items() if k != "aux_outputs"}
         # Retrieve the matching between the outputs of the last layer and the targets
         indices = self.matcher(outputs_without_aux, targets)
+
+        # the mask losses of all layers are computed together with the shared points
+        shared_masks = self.shared_point_sampling and "masks" in self.losses and not self.boxvis_enabled
+        if shared_masks:
+            shared_points = self.sample_shared_points(outputs_without_aux, targets, indices)
+            layer_outputs, layer_indices = [outputs_without_aux], [indices]
+
         losses = {}
         for loss in self.losses:
+            if shared_masks and loss == "masks":
+                continue
             losses.update(self.get_loss(loss, outputs, targets, indices, num_masks, l_layer=9))
 
         # In case of auxiliary losses, we repeat this process with the output of each intermediate layer.
@@ -714,9 +858,19 @@ class VideoSetCriterion(nn.Module):
             for i, aux_outputs in enumerate(outputs["aux_outputs"]):
                 aux_indices = self.matcher(aux_outputs, targets)
                 for loss in self.losses:
+                    if shared_masks and loss == "masks":
+                        continue
                     l_dict = self.get_loss(loss, aux_outputs, targets, aux_indices, num_masks, l_layer=i)
                     l_dict = {k + f"_{i}": v for k, v in l_dict.items()}
                     losses.update(l_dict)
+                if shared_masks:
+                    layer_outputs.append(aux_outputs)
+                    layer_indices.append(aux_indices)
+
+        if shared_masks:
+            losses.update(
+                self.loss_masks_shared_points(layer_outputs, targets, layer_indices, num_masks, shared_points)
+            )
 
         return losses
 
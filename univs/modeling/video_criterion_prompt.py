@@ -17,6 +17,7 @@ from detectron2.projects.point_rend.point_features import (
 
 from mask2former_video.utils.misc import is_dist_avail_and_initialized, nested_tensor_from_tensor_list
 from datasets.concept_emb.combined_datasets_category_info import combined_datasets_category_info
+from .video_criterion import sigmoid_ce_loss_layers_jit, dice_loss_layers_jit
 
 
 def dice_loss(
@@ -277,7 +278,8 @@ class VideoSetCriterionPrompt(nn.Module):
     """
 
     def __init__(self, num_classes, matcher, weight_dict, eos_coef, losses, num_frames,
-                 num_points, oversample_ratio, importance_sample_ratio, use_ctt_loss=True
+                 num_points, oversample_ratio, importance_sample_ratio, use_ctt_loss=True,
+                 shared_point_sampling=False,
                  ):
         """Create the criterion.
         Parameters:
@@ -286,6 +288,8 @@ class VideoSetCriterionPrompt(nn.Module):
             weight_dict: dict containing as key the names of the losses and as values their relative weight
             eos_coef: relative classification weight applied to the no-object category
             losses: list of all the losses to be applied. See get_loss for list of available losses
+            shared_point_sampling: sample the points of gt masks once with the last layer, which are
+                shared by the mask losses of all decoder layers, see `loss_masks_shared_points`
         """
         super().__init__()
         self.num_classes = num_classes
@@ -300,6 +304,7 @@ class VideoSetCriterionPrompt(nn.Module):
         self.num_points = num_points
         self.oversample_ratio = oversample_ratio
         self.importance_sample_ratio = importance_sample_ratio
+        self.shared_point_sampling = shared_point_sampling
 
     def loss_labels_clip(self, outputs, targets, num_masks, l_layer):
         loss = []
@@ -428,19 +433,9 @@ class VideoSetCriterionPrompt(nn.Module):
         if outputs["pred_masks"].nelement() == 0: 
             src_masks = target_masks = outputs["pred_masks"][0]
         else:
-            tgt_idx = torch.stack([t['prompt_obj_ids'].clone() for t in targets]).to(device)  # BxQ_p
-            keep = tgt_idx >= 0  
-            tgt_idx = tgt_idx[keep]
-            batch_idx, src_idx = torch.nonzero(keep).t()
-            tgt_idx = [tgt_idx[batch_idx == i] for i in range(len(targets))]
-
+            batch_idx, src_idx, target_masks = self._get_prompt_target_masks(targets, device)
             src_masks = outputs["pred_masks"][batch_idx, src_idx]
-            if targets[0]["task"] == "detection" and targets[0]["prompt_type"] == "text":
-                check_len = [t['sem_masks'].shape[0] > max(tgt_i) for t, tgt_i in zip(targets, tgt_idx) if len(tgt_i) > 0]
-                assert False not in check_len
-                target_masks = torch.cat([t['sem_masks'][tgt_i] for t, tgt_i in zip(targets, tgt_idx) if len(tgt_i)]).to(src_masks)  # NTHW
-            else:
-                target_masks = torch.cat([t['masks'][tgt_i] for t, tgt_i in zip(targets, tgt_idx)]).to(src_masks)
+            target_masks = target_masks.to(src_masks)
 
         # No need to upsample predictions as we are using normalized coordinates :)
         # NT x 1 x H x W
@@ -486,6 +481,80 @@ class VideoSetCriterionPrompt(nn.Module):
 
         return losses
     
+    def _get_prompt_target_masks(self, targets, device):
+        # the prompt queries are matched with their gt objects by prompt_obj_ids
+        tgt_idx = torch.stack([t['prompt_obj_ids'].clone() for t in targets]).to(device)  # BxQ_p
+        keep = tgt_idx >= 0  
+        tgt_idx = tgt_idx[keep]
+        batch_idx, src_idx = torch.nonzero(keep).t()
+        tgt_idx = [tgt_idx[batch_idx == i] for i in range(len(targets))]
+
+        if targets[0]["task"] == "detection" and targets[0]["prompt_type"] == "text":
+            check_len = [t['sem_masks'].shape[0] > max(tgt_i) for t, tgt_i in zip(targets, tgt_idx) if len(tgt_i) > 0]
+            assert False not in check_len
+            target_masks = torch.cat([t['sem_masks'][tgt_i] for t, tgt_i in zip(targets, tgt_idx) if len(tgt_i)])  # NTHW
+        else:
+            target_masks = torch.cat([t['masks'][tgt_i] for t, tgt_i in zip(targets, tgt_idx)])
+
+        return batch_idx, src_idx, target_masks
+
+    def loss_masks_shared_points(self, layer_outputs, targets, num_masks):
+        """
+        Compute the mask losses of all decoder layers, where the points are sampled once by the uncertainty
+        of the last layer, the gt labels of points are sampled once, and the losses of all layers are computed
+        in a batch. layer_outputs is ordered as [last layer, aux layer 0, aux layer 1, ...]
+        """
+        device = layer_outputs[0]["pred_masks"].device
+        batch_idx, src_idx, target_masks = self._get_prompt_target_masks(targets, device)
+        src_masks = layer_outputs[0]["pred_masks"][batch_idx, src_idx]
+        # NT x 1 x H x W
+        target_masks = target_masks.to(src_masks).flatten(0, 1)[:, None]
+
+        with torch.no_grad():
+            # sample point_coords: NT x 12544 x 2
+            point_coords = get_uncertain_point_coords_with_randomness(
+                src_masks.flatten(0, 1)[:, None],
+                lambda logits: calculate_uncertainty(logits),
+                self.num_points,
+                self.oversample_ratio,
+                self.importance_sample_ratio,
+            )
+            # get gt labels
+            point_labels = point_sample(
+                target_masks,
+                point_coords,
+                align_corners=False,
+            ).squeeze(1)
+        del src_masks
+        del target_masks
+
+        point_logits = torch.stack([
+            point_sample(
+                outputs["pred_masks"][batch_idx, src_idx].flatten(0, 1)[:, None],
+                point_coords,
+                align_corners=False,
+            ).squeeze(1)
+            for outputs in layer_outputs
+        ])  # L x NT x P
+        point_labels = point_labels[None].expand_as(point_logits)
+        loss_mask = sigmoid_ce_loss_layers_jit(point_logits, point_labels, num_masks)
+        loss_dice = dice_loss_layers_jit(point_logits, point_labels, num_masks)
+
+        losses = {}
+        for i, outputs in enumerate(layer_outputs):
+            l_dict = {"loss_mask": loss_mask[i], "loss_dice": loss_dice[i]}
+            # semantic mask loss 
+            if targets[0]["task"] == 'detection' and targets[0]["prompt_type"] == "text":
+                l_layer = 9 if i == 0 else i - 1
+                l_dict["loss_mask"] = l_dict["loss_mask"] + self.loss_masks_sem(outputs, targets, num_masks, l_layer)
+            if l_dict["loss_mask"].isnan().any():
+                l_dict["loss_mask"] = l_dict["loss_mask"] * 0.  # odd error
+            if i > 0:
+                l_dict = {k + f"_{i-1}": v for k, v in l_dict.items()}
+            losses.update(l_dict)
+
+        return losses
+
     def loss_masks_sem(self, outputs, targets, num_masks, l_layer):
         assert targets[0]["task"] == 'detection' and targets[0]["prompt_type"] == "text"
         device = outputs["pred_masks"].device
@@ -624,17 +693,30 @@ class VideoSetCriterionPrompt(nn.Module):
         num_masks = num_masks * self.num_frames
 
         outputs_without_aux = {k: v for k, v in outputs.items() if k != "aux_outputs"}
+        layer_outputs = [outputs_without_aux] + list(outputs.get("aux_outputs", []))
+        # the prompt queries are matched with the same gt objects in all layers,
+        # so that the mask losses of all layers can be computed together with the shared points
+        shared_masks = self.shared_point_sampling and "masks" in self.losses \
+            and all(o["pred_masks"].nelement() > 0 for o in layer_outputs)
+
         losses = {}
         for loss in self.losses:
+            if shared_masks and loss == "masks":
+                continue
             losses.update(self.get_loss(loss, outputs_without_aux, targets, num_masks, l_layer=9))
 
         # In case of auxiliary losses, we repeat this process with the output of each intermediate layer.
         if "aux_outputs" in outputs:
             for i, aux_outputs in enumerate(outputs["aux_outputs"]):
                 for loss in self.losses:
+                    if shared_masks and loss == "masks":
+                        continue
                     l_dict = self.get_loss(loss, aux_outputs, targets, num_masks, l_layer=i)
                     l_dict = {k + f"_{i}": v for k, v in l_dict.items()}
                     losses.update(l_dict)
+
+        if shared_masks:
+            losses.update(self.loss_masks_shared_points(layer_outputs, targets, num_masks))
         
         if 'l2v_attn_weights' in outputs:
             if outputs['l2v_attn_weights'] is None:
@@ -65,6 +65,7 @@ class VideoSetCriterionUni(nn.Module):
             max_num_masks=cfg.MODEL.UniVS.NUM_POS_QUERIES,
             # boxvis parameters
             boxvis_enabled=cfg.MODEL.BoxVIS.BoxVIS_ENABLED,
+            shared_point_sampling=cfg.MODEL.MASK_FORMER.SHARED_POINT_SAMPLING,
         )
 
         if self.prompt_as_queries:
@@ -79,6 +80,7 @@ class VideoSetCriterionUni(nn.Module):
                 num_points=cfg.MODEL.MASK_FORMER.TRAIN_NUM_POINTS,
                 oversample_ratio=cfg.MODEL.MASK_FORMER.OVERSAMPLE_RATIO,
                 importance_sample_ratio=cfg.MODEL.MASK_FORMER.IMPORTANCE_SAMPLE_RATIO,
+                shared_point_sampling=cfg.MODEL.MASK_FORMER.SHARED_POINT_SAMPLING,
             )
 
     def forward(self, outputs, targets):
@@ -3,6 +3,8 @@
 """
 Modules to compute the matching cost and solve the corresponding LSAP.
 """
+from concurrent.futures import ThreadPoolExecutor
+
 import torch
 import torch.nn.functional as F
 from scipy.optimize import linear_sum_assignment
@@ -95,6 +97,60 @@ batch_dice_coefficient_loss_jit = torch.jit.script(
 )  # type: torch.jit.ScriptModule
 
 
+def batched_sigmoid_ce_loss(inputs: torch.Tensor, targets: torch.Tensor):
+    """
+    Same as `batch_sigmoid_ce_loss`, but for a batch of videos with padded targets.
+    Args:
+        inputs: A float tensor with shape (B, N, C), the predictions.
+        targets: A float tensor with shape (B, M, C), the binary labels.
+    Returns:
+        Loss tensor with shape (B, N, M)
+    """
+    hw = inputs.shape[-1]
+    # -y*log(x) - (1-y)*log(1-x) = (1-y)*softplus(x) + y*softplus(-x) = softplus(x) - y*x
+    neg = F.softplus(inputs)
+    loss = neg.sum(-1)[:, :, None] - torch.einsum("bnc,bmc->bnm", inputs, targets)
+
+    return loss / hw
+
+
+batched_sigmoid_ce_loss_jit = torch.jit.script(
+    batched_sigmoid_ce_loss
+)  # type: torch.jit.ScriptModule
+
+
+def batched_dice_loss(inputs: torch.Tensor, targets: torch.Tensor):
+    """
+    Same as `batch_dice_loss`, but for a batch of videos with padded targets.
+    Args:
+        inputs: A float tensor with shape (B, N, C), the predictions.
+        targets: A float tensor with shape (B, M, C), the binary labels.
+    Returns:
+        Loss tensor with shape (B, N, M)
+    """
+    inputs = inputs.sigmoid()
+    numerator = 2 * torch.einsum("bnc,bmc->bnm", inputs, targets)
+    denominator = inputs.sum(-1)[:, :, None] + targets.sum(-1)[:, None, :]
+    loss = 1 - (numerator + 1) / (denominator + 1)
+    return loss
+
+
+batched_dice_loss_jit = torch.jit.script(
+    batched_dice_loss
+)  # type: torch.jit.ScriptModule
+
+
+_LSA_EXECUTOR = None
+
+
+def _get_lsa_executor():
+    # a shared thread pool to solve the assignments of videos in a batch concurrently
+    global _LSA_EXECUTOR
+    if _LSA_EXECUTOR is None:
+        _LSA_EXECUTOR = ThreadPoolExecutor(max_workers=4, thread_name_prefix="linear_sum_assignment")
+    return _LSA_EXECUTOR
+
+
 class VideoHungarianMatcherUni(nn.Module):
     """This class computes an assignment between the targets and the predictions of the network
 
@@ -127,74 +183,94 @@ class VideoHungarianMatcherUni(nn.Module):
         assert cost_class != 0 or cost_mask != 0 or cost_dice != 0, "all costs cant be 0"
 
         self.num_points = num_points
+        # the points sampled in the last call, which can be reused by the mask losses
+        self.last_point_coords = None
         # boxvis
         self.boxvis_enabled = boxvis_enabled
 
     @torch.no_grad()
     def memory_efficient_forward(self, outputs, targets):
-        """More memory-friendly matching"""
+        """More memory-friendly matching, where the costs of all videos in a batch are computed together"""
         bs, num_queries = outputs["pred_masks"].shape[:2]
+        num_tgts = [len(t["labels"]) for t in targets]
+
+        if max(num_tgts, default=0) == 0 or outputs["pred_masks"].nelement() == 0:
+            return [(torch.as_tensor([], dtype=torch.int64), torch.as_tensor([], dtype=torch.int64))] * bs
+
+        out_mask = outputs["pred_masks"].flatten(0, 1)  # (bs*num_queries)xTxHpxWp
+        # all masks in the batch share the same set of points for efficient matching!
+        point_coords = torch.rand(1, self.num_points, 2, device=out_mask.device)
+        self.last_point_coords = point_coords
+        out_mask = point_sample(
+            out_mask,
+            point_coords.expand(out_mask.shape[0], -1, -1),
+            align_corners=False,
+        ).flatten(1).reshape(bs, num_queries, -1)
+
+        # gt masks are already padded when preparing target
+        tgt_masks = [t['masks'] for t in targets if len(t['masks'])]
+        if len(set(m.shape[1:] for m in tgt_masks)) == 1:
+            # sample points of the targets of all videos at once
+            tgt_masks = torch.cat(tgt_masks).to(out_mask)
+            tgt_masks = point_sample(
+                tgt_masks,
+                point_coords.expand(tgt_masks.shape[0], -1, -1),
+                align_corners=False,
+            ).flatten(1).split([n for n in num_tgts if n > 0])
+        else:
+            tgt_masks = [
+                point_sample(
+                    m.to(out_mask),
+                    point_coords.expand(m.shape[0], -1, -1),
+                    align_corners=False,
+                ).flatten(1)
+                for m in tgt_masks
+            ]
+
+        # pad the targets of videos to the same number, the padded costs are dropped before matching
+        tgt_mask = out_mask.new_zeros((bs, max(num_tgts), out_mask.shape[-1]))
+        tgt_masks = iter(tgt_masks)
+        for b, n in enumerate(num_tgts):
+            if n > 0:
+                tgt_mask[b, :n] = next(tgt_masks)
+
+        with autocast(enabled=False):
+            out_mask = out_mask.float()
+            tgt_mask = tgt_mask.float()
+            # Compute the focal loss between masks
+            cost_mask = batched_sigmoid_ce_loss_jit(out_mask, tgt_mask)
+
+            # Compute the dice loss between masks
+            cost_dice = batched_dice_loss_jit(out_mask, tgt_mask)
+
+        # Final cost matrix
+        C = self.cost_mask * cost_mask + self.cost_dice * cost_dice  # bs x num_queries x max_num_tgts
 
-        indices = []
-
-        # Iterate through batch size
         for b in range(bs):
-            out_mask = outputs["pred_masks"][b]  # [num_queries, h, w]
-            tgt_ids = targets[b]["labels"] - 1  # N
-
-            if len(tgt_ids) == 0 or out_mask.nelement() == 0:
-                indices.append(([], []))
-                continue
-            
             dataset_name = targets[b]["dataset_name"]
-            if dataset_name in combined_datasets_category_info and "pred_logits" in outputs:
-                # Compute the classification cost. Contrary to the loss, we don't use the NLL,
-                # but approximate it in 1 - proba[target class].
-                # The 1 is a constant that doesn't change the matching, it can be ommitted.
-                num_classes, start_idx = combined_datasets_category_info[dataset_name]
-                out_prob = outputs["pred_logits"][b][:, start_idx:start_idx+num_classes].sigmoid()
-                out_prob = (out_prob * 5).softmax(-1)  # [num_queries, num_classes]
-                cost_class = -out_prob[:, tgt_ids]
-            else: 
-                cost_class = 0
-
-            out_mask = outputs["pred_masks"][b]  # cQxTxHpxWp
-            # gt masks are already padded when preparing target
-            tgt_mask = targets[b]['masks'].to(out_mask)  # cQxTxHxW
-
-            # all masks share the same set of points for efficient matching!
-            point_coords = torch.rand(1, self.num_points, 2, device=out_mask.device)
-            # get gt labels
-            tgt_mask = point_sample(
-                tgt_mask,
-                point_coords.repeat(tgt_mask.shape[0], 1, 1),
-                align_corners=False,
-            ).flatten(1)
-
-            out_mask = point_sample(
-                out_mask,
-                point_coords.repeat(out_mask.shape[0], 1, 1),
-                align_corners=False,
-            ).flatten(1)
-
-            with autocast(enabled=False):
-                out_mask = out_mask.float()
-                tgt_mask = tgt_mask.float()
-                # Compute the focal loss between masks
-                cost_mask = batch_sigmoid_ce_loss_jit(out_mask, tgt_mask)
-
-                # Compute the dice loss between masks
-                cost_dice = batch_dice_loss_jit(out_mask, tgt_mask)
-
-            # Final cost matrix
-            C = (
-                self.cost_mask * cost_mask
-                + self.cost_dice * cost_dice
-                + self.cost_class * cost_class
-            )
-            C = C.reshape(num_queries, -1).cpu()
-
-            indices.append(linear_sum_assignment(C))
+            if num_tgts[b] == 0 or dataset_name not in combined_datasets_category_info or "pred_logits" not in outputs:
+                continue
+            # Compute the classification cost. Contrary to the loss, we don't use the NLL,
+            # but approximate it in 1 - proba[target class].
+            # The 1 is a constant that doesn't change the matching, it can be ommitted.
+            tgt_ids = targets[b]["labels"] - 1  # N
+            num_classes, start_idx = combined_datasets_category_info[dataset_name]
+            out_prob = outputs["pred_logits"][b][:, start_idx:start_idx+num_classes].float().sigmoid()
+            out_prob = (out_prob * 5).softmax(-1)  # [num_queries, num_classes]
+            C[b, :, :num_tgts[b]] -= self.cost_class * out_prob[:, tgt_ids]
+
+        # a single device-to-host copy for the whole batch
+        C = C.cpu()
+
+        def _solve(b):
+            if num_tgts[b] == 0:
+                return [], []
+            return linear_sum_assignment(C[b, :, :num_tgts[b]])
+
+        if bs > 1:
+            indices = list(_get_lsa_executor().map(_solve, range(bs)))
+        else:
+            indices = [_solve(0)]
 
         return [
             (torch.as_tensor(i, dtype=torch.int64), torch.as_tensor(j, dtype=torch.int64))
@@ -6,6 +6,7 @@ from detectron2.structures import Boxes, ImageList, Instances, BitMasks
 from detectron2.data import MetadataCatalog
 
 from datasets.concept_emb.combined_datasets_category_info import combined_datasets_category_info
+from univs.data.detection_utils import PackedBitMasks
 from univs.modeling.language import pre_tokenize_expression
 from univs.utils.comm import box_xyxy_to_cxcywh, convert_box_to_mask
 
@@ -170,6 +171,9 @@ class PrepareTargets:
                 if has_mask:
                     if isinstance(targets_per_frame.gt_masks, BitMasks):
                         gt_masks_per_video[:, f_i, :h, :w] = targets_per_frame.gt_masks.tensor
+                    elif isinstance(targets_per_frame.gt_masks, PackedBitMasks):
+                        # unpacked on GPU after the transfer
+                        gt_masks_per_video[:, f_i, :h, :w] = targets_per_frame.gt_masks.unpack()
                     else:  # polygon
                         gt_masks_per_video[:, f_i, :h, :w] = targets_per_frame.gt_masks
 
@@ -34,9 +34,12 @@ from univs import (
     InferenceVideoVPS,
     InferenceVideoVOS,
     InferenceVideoEntity,
-    InferenceVideoSemanticExtraction
+    InferenceVideoSemanticExtraction,
+    run_batched_inference,
     )
-from univs.utils.comm import convert_mask_to_box, calculate_mask_quality_scores
+from univs.utils.comm import convert_mask_to_box, calculate_mask_quality_scores, get_inference_dtype, inference_autocast
+from univs.data.augmentation import apply_clip_transforms_on_device
+from univs.utils.profiling import profiler
 
 from datasets.concept_emb.combined_datasets_category_info import combined_datasets_category_info
 from .prepare_targets import PrepareTargets
@@ -101,6 +104,7 @@ class UniVS_Prompt(nn.Module):
         gen_pseudo_mask: nn.Module,
         boxvis_enabled: bool,
         boxvis_ema_enabled: bool,
+        boxvis_ema_update_period: int = 1,
         # inference
         video_unified_inference_enable: bool,
         prompt_as_queries: bool,
@@ -114,6 +118,9 @@ class UniVS_Prompt(nn.Module):
         is_multi_cls: bool,
         apply_cls_thres: float,
         merge_on_cpu: bool,
+        inference_precision: str="fp32",
+        serving_max_batch_frames: int=32,
+        serving_max_wait_ms: float=20,
         # tracking
         num_frames_window_test: int=3,
         clip_stride: int=1,
@@ -136,6 +143,10 @@ class UniVS_Prompt(nn.Module):
             test_topk_per_image: int, instance segmentation parameter, keep topk instances per image
             boxvis_enabled: if True, use only box-level annotation; otherwise pixel-wise annotations
             boxvis_ema_enabled: Exponential Moving Average for training stable
+            boxvis_ema_update_period: update the teacher net with EMA every N iterations
+            inference_precision: "fp32", "fp16" or "bf16", autocast the backbone and decoders at inference
+            serving_max_batch_frames: the max number of frames per packed backbone forward in `forward_inference_videos`
+            serving_max_wait_ms: the max time a clip waits for the clips of other videos in `forward_inference_videos`
             custom_videos_enable: if True, eval on custom videos
             custom_videos_text: a list [], num_videos = len(CUSTOM_VIDEOS_TEXT), 
                                 [[vid1_obi1_exp, vid1_obj2_exp, ...], [vid2_obj1_exp, vid2_obj2_exp, ...]]
@@ -174,6 +185,7 @@ class UniVS_Prompt(nn.Module):
 
         self.boxvis_enabled = boxvis_enabled
         self.boxvis_ema_enabled = boxvis_ema_enabled
+        self.boxvis_ema_update_period = boxvis_ema_update_period
         if self.boxvis_ema_enabled:
             self._init_ema(backbone, sem_seg_head, gen_pseudo_mask)
 
@@ -191,6 +203,9 @@ class UniVS_Prompt(nn.Module):
         self.apply_cls_thres = apply_cls_thres
         self.window_inference = window_inference
         self.merge_on_cpu = merge_on_cpu
+        self.inference_dtype = get_inference_dtype(inference_precision)
+        self.serving_max_batch_frames = serving_max_batch_frames
+        self.serving_max_wait_ms = serving_max_wait_ms
         
         # clip-by-clip tracking
         self.tracker_type = tracker_type  # if 'ovis' in data_name and use swin large backbone => "mdqe"
@@ -210,6 +225,12 @@ class UniVS_Prompt(nn.Module):
         self.backbone_t.requires_grad_(False)
         self.sem_seg_head_t.requires_grad_(False)
         self.ema_shadow_decay = 0.9999
+        # the EMA weights are copied into the student net for inference only when the teacher net changes
+        self._ema_version = 0
+        self._ema_applied_version = -1
+        self._ema_step = 0
+        self._ema_param_pairs = None
+        self.register_load_state_dict_post_hook(self._bump_ema_version)
         if self.boxvis_enabled:
             self.gen_pseudo_mask = gen_pseudo_mask
         else:
@@ -329,6 +350,7 @@ class UniVS_Prompt(nn.Module):
             "gen_pseudo_mask": gen_pseudo_mask,
             'boxvis_enabled': cfg.MODEL.BoxVIS.BoxVIS_ENABLED,
             "boxvis_ema_enabled": cfg.MODEL.BoxVIS.EMA_ENABLED,
+            "boxvis_ema_update_period": cfg.MODEL.BoxVIS.EMA_UPDATE_PERIOD,
             # inference
             "video_unified_inference_enable": cfg.MODEL.UniVS.TEST.VIDEO_UNIFIED_INFERENCE_ENABLE,
             "prompt_as_queries": cfg.MODEL.UniVS.PROMPT_AS_QUERIES,
@@ -342,6 +364,9 @@ class UniVS_Prompt(nn.Module):
             "is_multi_cls": cfg.MODEL.BoxVIS.TEST.MULTI_CLS_ON,
             "apply_cls_thres": cfg.MODEL.BoxVIS.TEST.APPLY_CLS_THRES,
             "merge_on_cpu": cfg.MODEL.BoxVIS.TEST.MERGE_ON_CPU,
+            "inference_precision": cfg.MODEL.UniVS.TEST.PRECISION,
+            "serving_max_batch_frames": cfg.MODEL.UniVS.TEST.SERVING.MAX_BATCH_FRAMES,
+            "serving_max_wait_ms": cfg.MODEL.UniVS.TEST.SERVING.MAX_WAIT_MS,
             # tracking
             "num_frames_window_test": cfg.MODEL.BoxVIS.TEST.NUM_FRAMES_WINDOW,
             "clip_stride": cfg.MODEL.BoxVIS.TEST.CLIP_STRIDE,
@@ -371,11 +396,15 @@ class UniVS_Prompt(nn.Module):
             list[dict]: each dict has the results for one image.
         """
         if not self.training:
-            return self.forward_inference(batched_inputs)
+            with inference_autocast(self.device, self.inference_dtype):
+                return self.forward_inference(batched_inputs)
         
         if self.boxvis_ema_enabled:
             self.update_ema_parameters()
                     
+        # clips sampled with INPUT.GPU_AUGMENTATION are augmented after transferring to GPU
+        apply_clip_transforms_on_device(batched_inputs, self.device)
+
         images = []
         for video in batched_inputs:
             for frame in video["image"]:
@@ -416,20 +445,46 @@ class UniVS_Prompt(nn.Module):
     def forward_inference(self, batched_inputs):
         if self.boxvis_ema_enabled:
             self.replace_with_ema_parameters_inf()
-        
+
+        with profiler.video_inputs(batched_inputs[0]):
+            return self.get_inference_engine(batched_inputs).eval(self, batched_inputs)
+
+    @torch.no_grad()
+    def forward_inference_videos(self, videos):
+        """
+        Serving mode: run several independent videos (or images) of the same task at once. Each video keeps
+        its own prompts and tracker (memory pool) states, while the clips of all videos are packed into shared
+        backbone forward passes, which improves the accelerator utilization on short videos and images.
+
+        Args:
+            videos (list[dict]): each item is the input of one video, i.e. batched_inputs[0] in `forward`
+        Returns:
+            list: the results of each video, the same as `forward([video])`
+        """
+        if self.boxvis_ema_enabled:
+            self.replace_with_ema_parameters_inf()
+
+        return run_batched_inference(
+            self, videos, max_batch_frames=self.serving_max_batch_frames, max_wait_ms=self.serving_max_wait_ms
+        )
+
+    def get_inference_engine(self, batched_inputs):
+        """
+        Select the inference engine of the task and the dataset of the inputs.
+        """
         if self.semantic_extraction_enable:
-            return self.inference_video_semantic_extraction.eval(self, batched_inputs)
+            return self.inference_video_semantic_extraction
             
         dataset_name = batched_inputs[0]["dataset_name"]
         if dataset_name.startswith("coco") or dataset_name.startswith("ade20k"):
             # evaluation for images
-            return self.inference_img_generic_seg.eval(self, batched_inputs)
+            return self.inference_img_generic_seg
     
         else:
             
             if batched_inputs[0]['task'] in {"grounding", "sot"} or len(self.custom_videos_text):
                 # evaluation for prompt-specified VS tasks
-                return self.inference_video_vos.eval(self, batched_inputs)
+                return self.inference_video_vos
 
             else:
                 # evaluation for category-specified VS tasks
@@ -437,53 +492,75 @@ class UniVS_Prompt(nn.Module):
                     if dataset_name.startswith("ytvis") or dataset_name.startswith("ovis") \
                             or dataset_name.startswith("vipseg") or dataset_name.startswith("vspw") \
                             or self.custom_videos_enable:
-                        return self.inference_video_entity.eval(self, batched_inputs)
+                        return self.inference_video_entity
                     else:
                         raise ValueError(f"Not support to eval the dataset {dataset_name} yet")
                 else:
                     if dataset_name.startswith("ytvis") or dataset_name.startswith("ovis"):
                         if self.tracker_type == 'mdqe':  # mdqe
-                            return self.inference_video_vis.eval(self, batched_inputs)
+                            return self.inference_video_vis
                         else:  # minvis
-                            return self.inference_video_vis_fast.eval(self, batched_inputs)
+                            return self.inference_video_vis_fast
                     elif dataset_name.startswith("vipseg") or dataset_name.startswith("vpsw"):
-                        return self.inference_video_vps.eval(self, batched_inputs)
+                        return self.inference_video_vps
                     else:
                         raise ValueError(f"Not support to eval the dataset {dataset_name} yet")
 
+    @staticmethod
+    def _bump_ema_version(module, incompatible_keys):
+        # the teacher net is changed by loading a checkpoint
+        module._ema_version += 1
+
     def replace_with_ema_parameters_inf(self):
         # ---------------- using EMA parameters for Teacher net ---------------------
-        backbone_t, sem_seg_head_t = {}, {}
-        for name, param in self.backbone_t.named_parameters():
-            backbone_t[name] = param.data.detach()
+        if self._ema_applied_version == self._ema_version:
+            # the EMA weights have been applied since the last update of the teacher net
+            return
 
-        for name, param in self.sem_seg_head_t.named_parameters():
-            sem_seg_head_t[name] = param.data.detach()
+        backbone_t = dict(self.backbone_t.named_parameters())
+        sem_seg_head_t = dict(self.sem_seg_head_t.named_parameters())
 
         # apply weighted weights to the student net
-        for name, param in self.backbone.named_parameters():
-            if name in backbone_t and param.requires_grad:
-                param.data = backbone_t[name]
-        for name, param in self.sem_seg_head.named_parameters():
-            if name in sem_seg_head_t and param.requires_grad:
-                param.data = sem_seg_head_t[name] 
+        with torch.no_grad():
+            for name, param in self.backbone.named_parameters():
+                if name in backbone_t and param.requires_grad:
+                    param.copy_(backbone_t[name])
+            for name, param in self.sem_seg_head.named_parameters():
+                if name in sem_seg_head_t and param.requires_grad:
+                    param.copy_(sem_seg_head_t[name])
+        self._ema_applied_version = self._ema_version
     
+    def _get_ema_param_pairs(self):
+        # flat lists of (student, teacher) parameters and buffers, prepared once
+        if self._ema_param_pairs is None:
+            params, params_t, buffers, buffers_t = [], [], [], []
+            for module, module_t in [(self.backbone, self.backbone_t), (self.sem_seg_head, self.sem_seg_head_t)]:
+                named_params_t = dict(module_t.named_parameters())
+                for name, param in module.named_parameters():
+                    if param.requires_grad and name in named_params_t:
+                        params.append(param)
+                        params_t.append(named_params_t[name])
+                named_buffers_t = dict(module_t.named_buffers())
+                for name, buffer in module.named_buffers():
+                    if name in named_buffers_t:
+                        buffers.append(buffer)
+                        buffers_t.append(named_buffers_t[name])
+            self._ema_param_pairs = (params, params_t, buffers, buffers_t)
+        return self._ema_param_pairs
+
     def update_ema_parameters(self):
         # ----------------- prepare EMA for Teacher net ---------------------
-        backbone_shadow, sem_seg_head_shadow = {}, {}
-        for name, param in self.backbone.named_parameters():
-            if param.requires_grad:
-                backbone_shadow[name] = param.data.detach()
-
-        for name, param in self.sem_seg_head.named_parameters():
-            if param.requires_grad:
-                sem_seg_head_shadow[name] = param.data.detach()
-
-        w_shadow = 1.0 - self.ema_shadow_decay
-        # apply weighted weights to the teacher net
-        for name, param in self.backbone_t.named_parameters():
-            if name in backbone_shadow:
-                param.data = w_shadow * backbone_shadow[name] + (1-w_shadow) * param.data
-        for name, param in self.sem_seg_head_t.named_parameters():
-            if name in sem_seg_head_shadow:
-                param.data = w_shadow * sem_seg_head_shadow[name] + (1-w_shadow) * param.data
+        self._ema_step += 1
+        if self._ema_step % self.boxvis_ema_update_period != 0:
+            return
+
+        params, params_t, buffers, buffers_t = self._get_ema_param_pairs()
+        # the decay is compounded over the iterations between two updates
+        w_shadow = 1.0 - self.ema_shadow_decay ** self.boxvis_ema_update_period
+        # apply weighted weights to the teacher net in-place, teacher = teacher + w * (student - teacher)
+        with torch.no_grad():
+            if len(params_t):
+                torch._foreach_lerp_(params_t, params, w_shadow)
+            for buffer_t, buffer in zip(buffers_t, buffers):
+                buffer_t.copy_(buffer)
+        self._ema_version += 1
@@ -38,7 +38,8 @@ from univs import (
     InferenceVideoVOS,
     InferenceVideoEntity,
     )
-from univs.utils.comm import convert_mask_to_box, calculate_mask_quality_scores
+from univs.utils.comm import convert_mask_to_box, calculate_mask_quality_scores, get_inference_dtype, inference_autocast
+from univs.data.augmentation import apply_clip_transforms_on_device
 
 from datasets.concept_emb.combined_datasets_category_info import combined_datasets_category_info
 from .prepare_targets import PrepareTargets
@@ -130,6 +131,7 @@ class UniVS_Prompt_LongVideo(nn.Module):
         gen_pseudo_mask: nn.Module,
         boxvis_enabled: bool,
         boxvis_ema_enabled: bool,
+        boxvis_ema_update_period: int = 1,
         # inference
         video_unified_inference_enable: bool,
         prompt_as_queries: bool,
@@ -139,6 +141,7 @@ class UniVS_Prompt_LongVideo(nn.Module):
         is_multi_cls: bool,
         apply_cls_thres: float,
         merge_on_cpu: bool,
+        inference_precision: str="fp32",
     ):
         """
         Args:
@@ -155,6 +158,8 @@ class UniVS_Prompt_LongVideo(nn.Module):
             test_topk_per_image: int, instance segmentation parameter, keep topk instances per image
             boxvis_enabled: if True, use only box-level annotation; otherwise pixel-wise annotations
             boxvis_ema_enabled: Exponential Moving Average for training stable
+            boxvis_ema_update_period: update the teacher net with EMA every N iterations
+            inference_precision: "fp32", "fp16" or "bf16", autocast the backbone and decoders at inference
         """
         super().__init__()
 
@@ -191,6 +196,7 @@ class UniVS_Prompt_LongVideo(nn.Module):
 
         self.boxvis_enabled = boxvis_enabled
         self.boxvis_ema_enabled = boxvis_ema_enabled
+        self.boxvis_ema_update_period = boxvis_ema_update_period
         if self.boxvis_ema_enabled:
             self._init_ema(backbone, sem_seg_head, gen_pseudo_mask)
 
@@ -205,6 +211,7 @@ class UniVS_Prompt_LongVideo(nn.Module):
         self.is_multi_cls = is_multi_cls
         self.apply_cls_thres = apply_cls_thres
         self.merge_on_cpu = merge_on_cpu   
+        self.inference_dtype = get_inference_dtype(inference_precision)
     
     def _init_ema(self, backbone, sem_seg_head, gen_pseudo_mask):
         # Teacher Net
@@ -213,6 +220,12 @@ class UniVS_Prompt_LongVideo(nn.Module):
         self.backbone_t.requires_grad_(False)
         self.sem_seg_head_t.requires_grad_(False)
         self.ema_shadow_decay = 0.9999
+        # the EMA weights are copied into the student net for inference only when the teacher net changes
+        self._ema_version = 0
+        self._ema_applied_version = -1
+        self._ema_step = 0
+        self._ema_param_pairs = None
+        self.register_load_state_dict_post_hook(self._bump_ema_version)
         if self.boxvis_enabled:
             self.gen_pseudo_mask = gen_pseudo_mask
         else:
@@ -329,6 +342,7 @@ class UniVS_Prompt_LongVideo(nn.Module):
             "gen_pseudo_mask": gen_pseudo_mask,
             'boxvis_enabled': cfg.MODEL.BoxVIS.BoxVIS_ENABLED,
             "boxvis_ema_enabled": cfg.MODEL.BoxVIS.EMA_ENABLED,
+            "boxvis_ema_update_period": cfg.MODEL.BoxVIS.EMA_UPDATE_PERIOD,
             # inference
             "video_unified_inference_enable": cfg.MODEL.UniVS.TEST.VIDEO_UNIFIED_INFERENCE_ENABLE,
             "prompt_as_queries": cfg.MODEL.UniVS.PROMPT_AS_QUERIES,
@@ -338,6 +352,7 @@ class UniVS_Prompt_LongVideo(nn.Module):
             "is_multi_cls": cfg.MODEL.BoxVIS.TEST.MULTI_CLS_ON,
             "apply_cls_thres": cfg.MODEL.BoxVIS.TEST.APPLY_CLS_THRES,
             "merge_on_cpu": cfg.MODEL.BoxVIS.TEST.MERGE_ON_CPU,
+            "inference_precision": cfg.MODEL.UniVS.TEST.PRECISION,
         }
 
     @property
@@ -359,11 +374,15 @@ class UniVS_Prompt_LongVideo(nn.Module):
             list[dict]: each dict has the results for one image.
         """
         if not self.training:
-            return self.forward_inference(batched_inputs)
+            with inference_autocast(self.device, self.inference_dtype):
+                return self.forward_inference(batched_inputs)
         
         if self.boxvis_ema_enabled:
             self.update_ema_parameters()
 
+        # clips sampled with INPUT.GPU_AUGMENTATION are augmented after transferring to GPU
+        apply_clip_transforms_on_device(batched_inputs, self.device)
+
         images = []
         for video in batched_inputs:
             for frame in video["image"]:
@@ -588,39 +607,61 @@ class UniVS_Prompt_LongVideo(nn.Module):
             )
             targets_per_video["prompt_self_attn_masks"] = None 
     
+    @staticmethod
+    def _bump_ema_version(module, incompatible_keys):
+        # the teacher net is changed by loading a checkpoint
+        module._ema_version += 1
+
     def replace_with_ema_parameters_inf(self):
         # ---------------- using EMA parameters for Teacher net ---------------------
-        backbone_t, sem_seg_head_t = {}, {}
-        for name, param in self.backbone_t.named_parameters():
-            backbone_t[name] = param.data.detach()
+        if self._ema_applied_version == self._ema_version:
+            # the EMA weights have been applied since the last update of the teacher net
+            return
 
-        for name, param in self.sem_seg_head_t.named_parameters():
-            sem_seg_head_t[name] = param.data.detach()
+        backbone_t = dict(self.backbone_t.named_parameters())
+        sem_seg_head_t = dict(self.sem_seg_head_t.named_parameters())
 
         # apply weighted weights to the student net
-        for name, param in self.backbone.named_parameters():
-            if name in backbone_t and param.requires_grad:
-                param.data = backbone_t[name]
-        for name, param in self.sem_seg_head.named_parameters():
-            if name in sem_seg_head_t and param.requires_grad:
-                param.data = sem_seg_head_t[name] 
+        with torch.no_grad():
+            for name, param in self.backbone.named_parameters():
+                if name in backbone_t and param.requires_grad:
+                    param.copy_(backbone_t[name])
+            for name, param in self.sem_seg_head.named_parameters():
+                if name in sem_seg_head_t and param.requires_grad:
+                    param.copy_(sem_seg_head_t[name])
+        self._ema_applied_version = self._ema_version
     
+    def _get_ema_param_pairs(self):
+        # flat lists of (student, teacher) parameters and buffers, prepared once
+        if self._ema_param_pairs is None:
+            params, params_t, buffers, buffers_t = [], [], [], []
+            for module, module_t in [(self.backbone, self.backbone_t), (self.sem_seg_head, self.sem_seg_head_t)]:
+                named_params_t = dict(module_t.named_parameters())
+                for name, param in module.named_parameters():
+                    if param.requires_grad and name in named_params_t:
+                        params.append(param)
+                        params_t.append(named_params_t[name])
+                named_buffers_t = dict(module_t.named_buffers())
+                for name, buffer in module.named_buffers():
+                    if name in named_buffers_t:
+                        buffers.append(buffer)
+                        buffers_t.append(named_buffers_t[name])
+            self._ema_param_pairs = (params, params_t, buffers, buffers_t)
+        return self._ema_param_pairs
+
     def update_ema_parameters(self):
         # ----------------- prepare EMA for Teacher net ---------------------
-        backbone_shadow, sem_seg_head_shadow = {}, {}
-        for name, param in self.backbone.named_parameters():
-            if param.requires_grad:
-                backbone_shadow[name] = param.data.detach()
-
-        for name, param in self.sem_seg_head.named_parameters():
-            if param.requires_grad:
-                sem_seg_head_shadow[name] = param.data.detach()
-
-        w_shadow = 1.0 - self.ema_shadow_decay
-        # apply weighted weights to the teacher net
-        for name, param in self.backbone_t.named_parameters():
-            if name in backbone_shadow:
-                param.data = w_shadow * backbone_shadow[name] + (1-w_shadow) * param.data
-        for name, param in self.sem_seg_head_t.named_parameters():
-            if name in sem_seg_head_shadow:
-                param.data = w_shadow * sem_seg_head_shadow[name] + (1-w_shadow) * param.data
\ No newline at end of file
+        self._ema_step += 1
+        if self._ema_step % self.boxvis_ema_update_period != 0:
+            return
+
+        params, params_t, buffers, buffers_t = self._get_ema_param_pairs()
+        # the decay is compounded over the iterations between two updates
+        w_shadow = 1.0 - self.ema_shadow_decay ** self.boxvis_ema_update_period
+        # apply weighted weights to the teacher net in-place, teacher = teacher + w * (student - teacher)
+        with torch.no_grad():
+            if len(params_t):
+                torch._foreach_lerp_(params_t, params, w_shadow)
+            for buffer_t, buffer in zip(buffers_t, buffers):
+                buffer_t.copy_(buffer)
+        self._ema_version += 1
\ No newline at end of file
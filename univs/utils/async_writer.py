@@ -0,0 +1,99 @@
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+from PIL import Image
+
+from univs.utils.profiling import profiled
+
+__all__ = ["AsyncImageWriter"]
+
+
+class AsyncImageWriter:
+    """
+    A bounded pool of background threads to encode and save the per-frame outputs (masks,
+    visualizations), so that the inference loop only hands off CPU arrays instead of waiting
+    for the PNG compression and file I/O. PIL releases the GIL while encoding, thus threads
+    are enough here.
+
+    Args:
+        num_workers (int): the number of writer threads, 0 to save images synchronously
+        max_pending (int): the max number of images waiting to be saved, `write` blocks when
+            it is reached (back-pressure), which bounds the memory of the queued arrays
+    """
+
+    def __init__(self, num_workers=4, max_pending=64):
+        self.num_workers = num_workers
+        self._executor = None
+        if num_workers > 0:
+            self._executor = ThreadPoolExecutor(max_workers=num_workers, thread_name_prefix="univs_writer")
+        self._slots = threading.BoundedSemaphore(max(max_pending, 1))
+        # the futures of each calling thread, so that the videos of the serving mode, which share
+        # the writer of their engine, only wait for (and raise the failures of) their own images
+        self._pending = {}  # thread id -> list of futures
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _save(save_path, array, palette=None):
+        image = Image.fromarray(array)
+        if palette is not None:
+            image.putpalette(palette)
+        image.save(save_path)
+        image.close()
+
+    @profiled("output_writing")
+    def write(self, save_path, array, palette=None):
+        """
+        Save an image asynchronously, the parent directory should exist.
+        Args:
+            save_path (str): the path of the image, e.g. ".../00000.png"
+            array (ndarray or Tensor): uint8 image with shape (H, W) or (H, W, 3)
+            palette (list[int]): optional palette for "P" mode images
+        """
+        if not isinstance(array, np.ndarray):
+            array = array.cpu().numpy()
+        if array.dtype != np.uint8:
+            array = array.astype(np.uint8)
+
+        if self._executor is None:
+            self._save(save_path, array, palette)
+            return
+
+        self._slots.acquire()
+        try:
+            future = self._executor.submit(self._save, save_path, array, palette)
+        except BaseException:
+            self._slots.release()
+            raise
+        future.add_done_callback(lambda _: self._slots.release())
+        with self._lock:
+            pending = self._pending.setdefault(threading.get_ident(), [])
+            pending.append(future)
+            # drop the finished futures that have no errors to keep the list short
+            if len(pending) > 4 * self.num_workers:
+                pending[:] = [f for f in pending if not f.done() or f.exception() is not None]
+
+    @profiled("output_writing")
+    def flush(self, all_threads=False):
+        """
+        Block until the images submitted by the calling thread have been saved, and re-raise the
+        first failure. It should be called at the end of each video and before reading the saved images.
+        Args:
+            all_threads (bool): wait for the images submitted by all threads instead
+        """
+        with self._lock:
+            if all_threads:
+                pending = [f for futures in self._pending.values() for f in futures]
+                self._pending = {}
+            else:
+                pending = self._pending.pop(threading.get_ident(), [])
+        errors = [f.exception() for f in pending]  # wait for all of them
+        errors = [e for e in errors if e is not None]
+        if len(errors):
+            raise errors[0]
+
+    def close(self):
+        self.flush(all_threads=True)
+        if self._executor is not None:
+            self._executor.shutdown(wait=True)
+            self._executor = None
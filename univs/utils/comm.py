@@ -1,6 +1,9 @@
+import contextlib
+import functools
 import torch
 import torchvision
 from torch import Tensor
+from torch.nn import functional as F
 
 
 def convert_box_to_mask(outputs_box: torch.Tensor, h: int, w: int):
@@ -88,6 +91,40 @@ def calculate_mask_quality_scores(mask_pred, threshold=1):
     scores_mask = (mask_pred > threshold).flatten(1).sum(-1) / (mask_pred > -threshold).flatten(1).sum(-1).clamp(min=1)
     return scores_mask
 
+def upsample_mask_logits(
+    masks, out_size, interim_size=None, image_size=None, frame_chunk=10, binarize=False, out_device=None
+):
+    """
+    Upsample the mask logits of the selected queries to the output size frame chunk by frame chunk,
+    thus the full-resolution masks of all frames are never materialized at once.
+
+    Args:
+        masks: Q x T x h x w, mask logits
+        out_size: the output size (H_out, W_out)
+        interim_size: if given, masks are first upsampled to the padded input size and cropped to
+            `image_size`, the same as the two-step upsampling in the inference engines
+        binarize: return masks > 0 (bool) instead of logits, which is 4x smaller
+        out_device: the device of the output masks, e.g. "cpu" for long videos
+
+    Returns:
+        Q x T x H_out x W_out, on out_device
+    """
+    out_device = masks.device if out_device is None else out_device
+    out_dtype = torch.bool if binarize else masks.dtype
+    out = torch.zeros((*masks.shape[:2], *out_size), dtype=out_dtype, device=out_device)
+    if masks.shape[0] == 0:
+        return out
+
+    for t in range(0, masks.shape[1], frame_chunk):
+        m = masks[:, t:t + frame_chunk]
+        if interim_size is not None:
+            m = F.interpolate(m, size=interim_size, mode="bilinear", align_corners=False)
+            if image_size is not None:
+                m = m[:, :, : image_size[0], : image_size[1]]
+        m = F.interpolate(m, size=out_size, mode="bilinear", align_corners=False)
+        out[:, t:t + frame_chunk] = (m > 0.) if binarize else m
+    return out
+
 def box_cxcywh_to_xyxy(x):
     x_c, y_c, w, h = x.unbind(-1)
     b = [(x_c - 0.5 * w), (y_c - 0.5 * h),
@@ -224,4 +261,48 @@ def batched_pair_mask_iou(masks1, masks2):
 
     iou = inter / union
 
-    return iou
\ No newline at end of file
+    return iou
+
+def get_inference_dtype(precision: str):
+    """
+    precision: "fp32", "fp16" or "bf16"
+    out: the dtype of autocast at inference, None for fp32
+    """
+    precision = precision.lower()
+    if precision == "fp32":
+        return None
+    elif precision == "fp16":
+        return torch.float16
+    elif precision == "bf16":
+        return torch.bfloat16
+    else:
+        raise ValueError(f"Unsupported inference precision: {precision}")
+
+def inference_autocast(device, dtype=None):
+    """
+    Autocast the forward at inference to the given dtype. dtype=None means fp32, which
+    disables autocast, including an autocast region of the caller.
+    """
+    if dtype is None:
+        return torch.autocast(device_type=torch.device(device).type, enabled=False)
+    return torch.autocast(device_type=torch.device(device).type, dtype=dtype)
+
+def autocast_fp32(func):
+    """
+    Run `func` in fp32 even inside an autocast region, used for the numerically
+    sensitive steps at inference, such as matching and similarity computation.
+    Floating-point tensor arguments are cast to fp32 and autocast is disabled.
+    """
+    def _to_fp32(x):
+        if isinstance(x, Tensor) and x.is_floating_point():
+            return x.float()
+        return x
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        args = [_to_fp32(x) for x in args]
+        kwargs = {k: _to_fp32(v) for k, v in kwargs.items()}
+        with torch.autocast("cuda", enabled=False), torch.autocast("cpu", enabled=False):
+            return func(*args, **kwargs)
+
+    return wrapper
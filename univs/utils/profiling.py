@@ -0,0 +1,249 @@
+"""
+Opt-in timing regions and counters on the hot paths of inference, e.g. the backbone, the pixel decoder,
+the prompt encoder, the transformer decoder, the tracker update, the matching, the RLE encoding and the
+output writing. Disabled by default, then a region costs one attribute check and a shared null context.
+
+    from univs.utils.profiling import profiler, profile_region
+    profiler.enable(accurate=False)
+    with profiler.video(video_id, dataset_name):
+        with profile_region("backbone"):
+            features = backbone(images)
+        profiler.count("num_frames", len(images))
+    print(profiler.summary())
+
+Regions can be nested, each region records its inclusive time and its self time (without nested regions).
+CUDA kernels are asynchronous, so without `accurate` the time of a region is the launch time plus
+the time blocked by syncs inside it. In the accurate mode, the device is synchronized at both ends
+of each region, which serializes the GPU and slows down inference.
+Stats are aggregated per video and per dataset, the current video and the region stack are thread-local,
+thus the threads of the serving mode are attributed to their own videos.
+"""
+import contextlib
+import functools
+import threading
+import time
+from collections import defaultdict
+
+import torch
+
+__all__ = ["HotPathProfiler", "profiler", "profile_region", "profiled"]
+
+
+_NULL_CONTEXT = contextlib.nullcontext()
+
+
+def _new_stats():
+    return {"regions": defaultdict(lambda: [0, 0., 0.]), "counters": defaultdict(int), "num_videos": 0}
+
+
+class _Region:
+    __slots__ = ("profiler", "name", "start", "child_time")
+
+    def __init__(self, profiler, name):
+        self.profiler = profiler
+        self.name = name
+
+    def __enter__(self):
+        self.profiler._sync()
+        self.child_time = 0.
+        self.profiler._stack().append(self)
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.profiler._sync()
+        elapsed = time.perf_counter() - self.start
+        stack = self.profiler._stack()
+        stack.pop()
+        if len(stack):
+            stack[-1].child_time += elapsed
+        self.profiler._record(self.name, elapsed, elapsed - self.child_time)
+        return False
+
+
+class HotPathProfiler:
+    def __init__(self):
+        self.enabled = False
+        self.accurate = False
+        self.dataset_name = None
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self.reset()
+
+    def enable(self, accurate=False):
+        """
+        Args:
+            accurate (bool): synchronize the device at both ends of each region
+        """
+        self.accurate = accurate and torch.cuda.is_available()
+        self.enabled = True
+
+    def disable(self):
+        self.enabled = False
+
+    def reset(self, dataset_name=None):
+        """
+        Clear the stats of all datasets, or only those of `dataset_name`, e.g. before evaluating it again.
+        """
+        with self._lock:
+            if dataset_name is None:
+                self._videos = {}  # (dataset_name, video_id) -> stats
+                self._datasets = defaultdict(_new_stats)
+                return
+            self._datasets.pop(dataset_name, None)
+            for key in [key for key in self._videos if key[0] == dataset_name]:
+                del self._videos[key]
+
+    def region(self, name):
+        if not self.enabled:
+            return _NULL_CONTEXT
+        return _Region(self, name)
+
+    def count(self, name, n=1):
+        if not self.enabled:
+            return
+        with self._lock:
+            for stats in self._current_stats():
+                stats["counters"][name] += n
+
+    @contextlib.contextmanager
+    def video(self, video_id, dataset_name=""):
+        """
+        Attribute the regions and counters inside to a video of a dataset.
+        """
+        if not self.enabled:
+            yield
+            return
+
+        key = (dataset_name, str(video_id))
+        with self._lock:
+            if key not in self._videos:
+                self._videos[key] = _new_stats()
+                self._datasets[dataset_name]["num_videos"] += 1
+        prev_key = getattr(self._local, "video", None)
+        self._local.video = key
+        try:
+            with self.region("video"):
+                yield
+        finally:
+            self._local.video = prev_key
+
+    @contextlib.contextmanager
+    def video_inputs(self, video):
+        """
+        `video` for the input dict of a video (or an image) output by the dataset mappers,
+        which also counts its frames.
+        """
+        video_id = video.get("video_id", video.get("image_id", video.get("file_name", "")))
+        dataset_name = self.dataset_name if self.dataset_name is not None else video.get("dataset_name", "")
+        with self.video(video_id, dataset_name):
+            self.count("num_frames", len(video.get("image", [])))
+            yield
+
+    @contextlib.contextmanager
+    def evaluating(self, dataset_name):
+        """
+        Attribute all videos inside to the evaluated dataset, rather than the "dataset_name"
+        of their inputs (e.g. "sot_" + dataset_name for the prompt-guided tasks).
+        """
+        prev_name, self.dataset_name = self.dataset_name, dataset_name
+        try:
+            yield
+        finally:
+            self.dataset_name = prev_name
+
+    def _stack(self):
+        if not hasattr(self._local, "stack"):
+            self._local.stack = []
+        return self._local.stack
+
+    def _sync(self):
+        if self.accurate:
+            torch.cuda.synchronize()
+
+    def _current_stats(self):
+        key = getattr(self._local, "video", None)
+        if key is None:
+            return [self._datasets[""]]
+        return [self._videos[key], self._datasets[key[0]]]
+
+    def _record(self, name, elapsed, self_time):
+        with self._lock:
+            for stats in self._current_stats():
+                region = stats["regions"][name]
+                region[0] += 1
+                region[1] += elapsed
+                region[2] += self_time
+
+    @staticmethod
+    def _format(stats):
+        return {
+            "num_videos": stats["num_videos"],
+            "regions": {
+                name: {"calls": calls, "total_ms": total * 1000., "self_ms": self_time * 1000.}
+                for name, (calls, total, self_time) in sorted(stats["regions"].items())
+            },
+            "counters": dict(stats["counters"]),
+        }
+
+    def summary(self, dataset_name=None):
+        """
+        Returns:
+            dict: {"datasets": {dataset_name: stats}, "videos": {dataset_name: {video_id: stats}}},
+                where stats has "regions" ({name: {"calls", "total_ms", "self_ms"}}) and "counters",
+                only the given dataset if `dataset_name` is not None
+        """
+        with self._lock:
+            datasets = {
+                name: self._format(stats) for name, stats in self._datasets.items()
+                if dataset_name is None or name == dataset_name
+            }
+            videos = defaultdict(dict)
+            for (name, video_id), stats in self._videos.items():
+                if dataset_name is None or name == dataset_name:
+                    videos[name][video_id] = self._format(stats)
+        return {"datasets": datasets, "videos": dict(videos)}
+
+    def flat_summary(self, dataset_name):
+        """
+        The per-dataset stats as a flat {metric: value} dict, which is appended to the evaluation results.
+        """
+        stats = self.summary(dataset_name)["datasets"].get(dataset_name)
+        if stats is None:
+            return {}
+        num_videos = max(stats["num_videos"], 1)
+        results = {"num_videos": stats["num_videos"]}
+        for name, region in stats["regions"].items():
+            results[f"{name}/ms_per_video"] = region["total_ms"] / num_videos
+            results[f"{name}/self_ms_per_video"] = region["self_ms"] / num_videos
+            results[f"{name}/calls_per_video"] = region["calls"] / num_videos
+        for name, value in stats["counters"].items():
+            results[f"{name}/per_video"] = value / num_videos
+        return results
+
+
+profiler = HotPathProfiler()
+
+
+def profile_region(name):
+    """
+    A timing region of the global profiler, a null context when it is disabled.
+    """
+    if not profiler.enabled:
+        return _NULL_CONTEXT
+    return _Region(profiler, name)
+
+
+def profiled(name):
+    """
+    Decorate a function as a timing region of the global profiler.
+    """
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapped(*args, **kwargs):
+            if not profiler.enabled:
+                return func(*args, **kwargs)
+            with _Region(profiler, name):
+                return func(*args, **kwargs)
+        return wrapped
+    return decorator